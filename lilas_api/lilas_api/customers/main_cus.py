@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException, Query, Security
 from sqlalchemy.orm import Session
 from typing import Optional, List
-from customers.models_cus import Base, Customer, CustomerGroup
+from customers.models_cus import Customer, CustomerGroup
 from customers.schema_cus import (
     CustomerCreate, CustomerResponse, 
     CustomerGroupCreate, CustomerGroupResponse,
@@ -11,17 +11,19 @@ from fastapi.security import HTTPBearer
 from users.main import role_required 
 from users.models import User, Account
 from sqlalchemy import func, Integer, desc
-from database.main import engine  
-from users.dependencies import get_db 
-from sqlalchemy import or_, func
+from database.search import search_ids
+from database.sequences import next_id
+from database.cache import cached
+from users.dependencies import get_db, get_async_db
+from sqlalchemy import or_, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload
+from database.export import keyset_batches, export_response
 
 
 router = APIRouter()
 security_scheme = HTTPBearer()
 
-Base.metadata.create_all(bind=engine)
-
 
 @router.post("/customers", response_model=CustomerResponse, dependencies=[Security(security_scheme)])
 def create_customer(
@@ -58,11 +60,7 @@ def create_customer(
             raise HTTPException(status_code=500, detail="DEFAULT_GROUP_NOT_FOUND_KHACH_LE")
         customer.group_id = default_group.id
 
-    last_id = db.query(func.max(func.cast(func.substr(Customer.id, 3), Integer))).scalar()
-    if last_id:
-        new_id = f"KH{last_id + 1}"
-    else:
-        new_id = "KH1"
+    new_id = next_id(db, "KH", Customer)
 
     new_customer = Customer(id=new_id, **customer.dict())
     db.add(new_customer)
@@ -71,6 +69,32 @@ def create_customer(
     return CustomerResponse.from_orm(new_customer)
 
 
+CUSTOMER_EXPORT_HEADER = [
+    "Mã khách hàng", "Họ tên", "Số điện thoại", "Email", "Địa chỉ", "Phường/Xã", "Quận/Huyện", "Tỉnh/Thành",
+    "Nhóm", "Tổng chi tiêu", "Số đơn", "Công nợ", "Ngày tạo",
+]
+
+@router.get("/customers/export", dependencies=[Security(security_scheme)])
+def export_customers(
+    format: str = Query("csv", description="csv | xlsx"),
+    has_debt: bool = Query(False, description="Chỉ xuất khách đang có công nợ"),
+    current_user: Account = role_required(["admin"])
+):
+    statement = select(
+        Customer.id, Customer.full_name, Customer.phone, Customer.email, Customer.address, Customer.ward_name,
+        Customer.district_name, Customer.province, CustomerGroup.name, Customer.total_spending, Customer.total_order,
+        Customer.debt, Customer.created_at,
+    ).outerjoin(CustomerGroup, Customer.group_id == CustomerGroup.id).where(Customer.active == True, Customer.full_name != "Khách Trắng")
+    if has_debt:
+        statement = statement.where(Customer.debt != 0)
+
+    def rows():
+        for customers in keyset_batches(statement, (Customer.created_at, Customer.id)):
+            yield from customers
+
+    return export_response("khach_hang", format, CUSTOMER_EXPORT_HEADER, rows())
+
+
 @router.get("/customers/{customer_id}", response_model=CustomerResponse, dependencies=[Security(security_scheme)])
 def get_customer(
     customer_id: str, 
@@ -121,29 +145,31 @@ def update_customer(
 from suppliers.main_sup import normalize
 
 @router.get("/customers", response_model=CustomerListResponse, dependencies=[Security(security_scheme)])
-def list_customers(
+async def list_customers(
     limit: int = Query(10, description="Số lượng khách hàng trên mỗi trang"),
     skip: int = Query(0, description="Số lượng khách hàng bỏ qua"),
     search: Optional[str] = Query(None, description="Tìm kiếm theo tên, số điện thoại hoặc email"),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: Account = role_required(["admin", "staff", "collaborator"])
 ):
-    query = db.query(Customer).filter(Customer.active == True, Customer.full_name != "Khách Trắng")
-    customers = query.all()
+    query = select(Customer).filter(Customer.active == True, Customer.full_name != "Khách Trắng")
 
     if search:
         search_normalized = normalize(search)
-        customers = [
-            c for c in customers
-            if search_normalized in normalize(c.full_name)
-            or search_normalized in normalize(c.phone)
-            or search_normalized in normalize(c.email)
-            or (c.group and search_normalized in normalize(c.group.name))
-        ]
-    customers.sort(key=lambda c: c.full_name.split(' ')[-1].lower())  
-
-    total_customers = len(customers)
-    customers = customers[skip: skip + limit] 
+        # nhóm khách chỉ vài dòng: lấy id nhóm khớp trước, không normalize tên nhóm trên từng khách
+        group_ids = (await db.scalars(
+            select(CustomerGroup.id).filter(func.normalize(CustomerGroup.name).contains(search_normalized, autoescape=True))
+        )).all()
+        query = query.filter(or_(
+            Customer.id.in_(search_ids("customers", search_normalized)),
+            Customer.group_id.in_(group_ids)
+        ))
+
+    total_customers = await db.scalar(select(func.count()).select_from(query.subquery()))
+    # sắp xếp theo tên (từ cuối của họ tên)
+    customers = (await db.scalars(
+        query.options(joinedload(Customer.group)).order_by(func.last_name_key(Customer.full_name)).offset(skip).limit(limit)
+    )).all()
 
     result = [
         CustomerResponse(
@@ -171,6 +197,7 @@ def list_customers(
 
 
 @router.get("/top", response_model=List[CustomerResponse], dependencies=[Security(security_scheme)])
+@cached("top_customers", depends_on=("customers", "customer_groups"))
 def get_top_customers(
     limit: int = Query(5, description="Top 5 khách hàng"),
     db: Session = Depends(get_db),
@@ -187,7 +214,7 @@ def get_top_customers(
     if not top_customers:
         raise HTTPException(status_code=404, detail="NOT_FOUND")
 
-    return top_customers
+    return [CustomerResponse.from_orm(c) for c in top_customers]
 
 @router.put("/deactivate_customer/{customer_id}", dependencies=[Security(security_scheme)])
 def deactivate_customer(
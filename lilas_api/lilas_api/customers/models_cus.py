@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Date
+from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Date, Index
 from datetime import datetime, timezone
 from sqlalchemy.orm import relationship
 from database.main import Base, SessionLocal
@@ -8,11 +8,13 @@ import pytz
 vietnam_tz = pytz.timezone("Asia/Ho_Chi_Minh")
 class Customer(Base):
     __tablename__ = "customers"
+    # phân trang keyset khi xuất file (database/export.py)
+    __table_args__ = (Index("ix_customers_created_at_id", "created_at", "id"),)
 
     id = Column(String, primary_key=True, index=True)
     full_name = Column(String, nullable=False)
     address = Column(String, nullable=True)
-    phone = Column(String, nullable=False)
+    phone = Column(String, nullable=False, index=True)
     date_of_birth = Column(Date, nullable=True)
     email = Column(String, nullable=True)
     group_id = Column(Integer, ForeignKey("customer_groups.id"), nullable=True, default=1)
@@ -53,8 +55,8 @@ class Transaction(Base):
     __tablename__ = "transactions"
 
     id = Column(Integer, primary_key=True, index=True)
-    customer_id = Column(String, ForeignKey("customers.id"), nullable=False)
-    invoice_id = Column(String, ForeignKey("invoices.id"), nullable=True)
+    customer_id = Column(String, ForeignKey("customers.id"), nullable=False, index=True)
+    invoice_id = Column(String, ForeignKey("invoices.id"), nullable=True, index=True)
     amount = Column(Float, nullable=False)
     transaction_type = Column(String, nullable=False, default="refund")  
     note = Column(String, nullable=True)
@@ -0,0 +1,179 @@
+from collections import OrderedDict
+from functools import wraps
+import json
+import logging
+import os
+import threading
+import time
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import event
+from database.main import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# REDIS_URL=redis://localhost:6379/0 để dùng chung cache giữa nhiều worker, không đặt thì cache trong process.
+# Chạy nhiều worker (WEB_CONCURRENCY > 1) bắt buộc có Redis: generation của cache dashboard và bộ đếm đăng nhập sai
+# nằm trong process thì worker này ghi, worker khác không thấy (mainAPI từ chối khởi động)
+REDIS_URL = os.getenv("REDIS_URL")
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "512"))
+
+# namespace cache -> các bảng mà dữ liệu phụ thuộc, ghi vào bảng nào thì xóa cache namespace đó
+_dependencies = {}
+
+
+class MemoryBackend:
+    shared = False  # chỉ process hiện tại thấy
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def generation(self, namespace):
+        return self.generations.get(namespace, 0)
+
+    def bump(self, namespace):
+        with self.lock:
+            self.generations[namespace] = self.generations.get(namespace, 0) + 1
+            for key in [k for k in self.entries if k.startswith(f"{namespace}:")]:
+                del self.entries[key]
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def incr(self, key, ttl):
+        # bộ đếm hết hạn sau ttl giây kể từ lần tăng đầu tiên
+        with self.lock:
+            expires_at, value = self.entries.get(key, (0, 0))
+            if expires_at < time.monotonic():
+                expires_at, value = time.monotonic() + ttl, 0
+            self.entries[key] = (expires_at, value + 1)
+            self.entries.move_to_end(key)
+            return value + 1
+
+
+class RedisBackend:
+    shared = True
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+
+    def generation(self, namespace):
+        return int(self.client.get(f"cache:gen:{namespace}") or 0)
+
+    def bump(self, namespace):
+        self.client.incr(f"cache:gen:{namespace}")
+
+    def get(self, key):
+        value = self.client.get(f"cache:{key}")
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.setex(f"cache:{key}", ttl, json.dumps(value))
+
+    def delete(self, key):
+        self.client.delete(f"cache:{key}")
+
+    def incr(self, key, ttl):
+        self.client.set(f"cache:{key}", 0, ex=ttl, nx=True)
+        return self.client.incr(f"cache:{key}")
+
+
+backend = RedisBackend(REDIS_URL) if REDIS_URL else MemoryBackend(CACHE_MAX_ENTRIES)
+
+
+def check_workers():
+    if WEB_CONCURRENCY > 1 and not backend.shared:
+        raise RuntimeError(f"WEB_CONCURRENCY={WEB_CONCURRENCY} cần REDIS_URL để các worker dùng chung cache")
+
+
+def cached(namespace, ttl=60, depends_on=()):
+    """
+    Cache kết quả endpoint theo namespace + tham số query (bỏ qua db, current_user).
+    Kết quả được chuyển sang JSON nên endpoint phải trả về schema/dict chứ không phải object ORM.
+    """
+    _dependencies[namespace] = set(depends_on)
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            params = {k: v for k, v in kwargs.items() if k not in ("db", "current_user")}
+            try:
+                key = f"{namespace}:{backend.generation(namespace)}:{json.dumps(jsonable_encoder(params), sort_keys=True)}"
+                value = backend.get(key)
+            except Exception as e:
+                logger.warning("Cache không khả dụng (%s), tính trực tiếp", e)
+                return func(*args, **kwargs)
+            if value is not None:
+                return value
+
+            value = jsonable_encoder(func(*args, **kwargs))
+            try:
+                backend.set(key, value, ttl)
+            except Exception as e:
+                logger.warning("Không ghi được cache %s: %s", namespace, e)
+            return value
+        return wrapper
+    return decorator
+
+
+def invalidate_tables(tables):
+    for namespace, depends_on in _dependencies.items():
+        if depends_on & set(tables):
+            try:
+                backend.bump(namespace)
+            except Exception as e:
+                logger.warning("Không xóa được cache %s: %s", namespace, e)
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def collect_changed_tables(session, flush_context):
+    tables = session.info.setdefault("cache_changed_tables", set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(obj, "__tablename__", None)
+        if table:
+            tables.add(table)
+
+
+@event.listens_for(SessionLocal, "do_orm_execute")
+def collect_bulk_changes(orm_execute_state):
+    # query(...).update() / delete() không đi qua flush
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and orm_execute_state.bind_mapper:
+        tables = orm_execute_state.session.info.setdefault("cache_changed_tables", set())
+        tables.add(orm_execute_state.bind_mapper.local_table.name)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def invalidate_after_commit(session):
+    tables = session.info.pop("cache_changed_tables", None)
+    if tables:
+        invalidate_tables(tables)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def discard_changed_tables(session):
+    session.info.pop("cache_changed_tables", None)
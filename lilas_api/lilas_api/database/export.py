@@ -0,0 +1,179 @@
+from datetime import date, datetime
+from xml.sax.saxutils import escape
+import csv
+import io
+import os
+import re
+import zipfile
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import tuple_, and_, or_
+from database.main import SessionLocal
+
+# số dòng đọc mỗi lô khi xuất file, mỗi lô 1 session ngắn nên không giữ transaction suốt lúc tải
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+# gom output tới khoảng này rồi mới gửi 1 chunk
+CHUNK_SIZE = 64 * 1024
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# ký tự điều khiển không hợp lệ trong XML
+_ILLEGAL_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def _after(keys, last):
+    # SQLite xếp NULL trước mọi giá trị, còn (NULL, id) > (...) luôn ra NULL: dòng cuối lô có cột đầu NULL
+    # thì lấy tiếp các dòng NULL có khóa sau lớn hơn, rồi tới mọi dòng có giá trị
+    first, *rest = keys
+    if last[0] is None:
+        return or_(first.isnot(None), and_(first.is_(None), tuple_(*rest) > tuple_(*last[1:])))
+    return tuple_(*keys) > tuple_(*last)
+
+
+def keyset_batches(statement, keys, details=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Đọc `statement` (select) theo từng lô sắp theo `keys` (cột cuối phải duy nhất, vd (created_at, id)):
+    lô sau lấy các dòng có khóa lớn hơn dòng cuối lô trước thay vì OFFSET.
+    `details(db, rows)` chạy trong session của lô (vd lấy các dòng chi tiết) và trả về các dòng thay cho `rows`.
+    Mỗi lô được đọc hết rồi đóng session trước khi yield, không giữ kết nối trong lúc client tải.
+    """
+    last = None
+    while True:
+        with SessionLocal() as db:
+            batch = statement
+            if last is not None:
+                batch = batch.where(_after(keys, last))
+            rows = db.execute(batch.order_by(*keys).limit(batch_size)).all()
+            output = details(db, rows) if details and rows else rows
+        if not rows:
+            return
+        yield output
+        if len(rows) < batch_size:
+            return
+        last = tuple(rows[-1]._mapping[key] for key in keys)
+
+
+def _text(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+def _safe_text(value):
+    # Excel coi ô bắt đầu bằng = + - @ là công thức
+    text = _text(value)
+    if isinstance(value, str) and text[:1] in ("=", "+", "-", "@"):
+        return "'" + text
+    return text
+
+
+def csv_chunks(header, rows):
+    buffer = io.StringIO()
+    buffer.write("\ufeff")  # BOM để Excel đọc đúng tiếng Việt
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow([_safe_text(value) for value in row])
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+class _Sink(io.RawIOBase):
+    # file chỉ ghi, không seek được: zipfile sẽ ghi kích thước sau mỗi file (data descriptor) nên stream được
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        self.size = 0
+        return data
+
+
+def _cell(value):
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f"<c><v>{value}</v></c>"
+    if value is None:
+        return "<c/>"
+    text = escape(_ILLEGAL_XML.sub("", _text(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _row(values):
+    return "<row>" + "".join(_cell(value) for value in values) + "</row>"
+
+
+def xlsx_chunks(header, rows, sheet_name="Sheet1"):
+    """File .xlsx 1 sheet, chuỗi ghi inline (không cần sharedStrings) để ghi tuần tự từng dòng."""
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '</Types>'
+        ))
+        archive.writestr("_rels/.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>'
+        ))
+        archive.writestr("xl/workbook.xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{escape(sheet_name)}" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>'
+        ))
+        archive.writestr("xl/_rels/workbook.xml.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+            '</Relationships>'
+        ))
+        with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                + _row(header)
+            ).encode("utf-8"))
+            for row in rows:
+                sheet.write(_row(row).encode("utf-8"))
+                if sink.size >= CHUNK_SIZE:
+                    yield sink.take()
+            sheet.write(b"</sheetData></worksheet>")
+    yield sink.take()
+
+
+def export_response(name, format, header, rows):
+    """StreamingResponse CSV/XLSX từ iterator các dòng (list giá trị theo thứ tự `header`)."""
+    if format == "csv":
+        body, media_type = csv_chunks(header, rows), "text/csv; charset=utf-8"
+    elif format == "xlsx":
+        body, media_type = xlsx_chunks(header, rows, name), XLSX_MEDIA_TYPE
+    else:
+        raise HTTPException(status_code=400, detail="INVALID_EXPORT_FORMAT")
+    filename = f"{name}_{datetime.now():%Y%m%d_%H%M}.{format}"
+    return StreamingResponse(body, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
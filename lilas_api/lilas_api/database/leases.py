@@ -0,0 +1,40 @@
+import time
+
+from sqlalchemy import Column, String, Integer, update, insert, or_
+from sqlalchemy.exc import IntegrityError
+from database.main import Base, engine
+
+
+class Lease(Base):
+    __tablename__ = "leases"
+
+    name = Column(String, primary_key=True)  # "scheduler"
+    owner = Column(String, nullable=False)  # host:pid:... của process đang giữ
+    expires_at = Column(Integer, nullable=False)  # unix timestamp
+
+
+def acquire_lease(name, owner, seconds, bind=engine):
+    """
+    Giữ (hoặc gia hạn) lease `name` trong `seconds` giây. Trả về True nếu process này đang giữ lease.
+    Chỉ 1 owner giữ được tại 1 thời điểm; lease hết hạn thì process khác lấy được.
+    """
+    now = int(time.time())
+    with bind.begin() as connection:
+        updated = connection.execute(
+            update(Lease)
+            .where(Lease.name == name, or_(Lease.owner == owner, Lease.expires_at <= now))
+            .values(owner=owner, expires_at=now + seconds)
+        ).rowcount
+    if updated:
+        return True
+    try:
+        with bind.begin() as connection:
+            connection.execute(insert(Lease).values(name=name, owner=owner, expires_at=now + seconds))
+        return True
+    except IntegrityError:
+        return False  # lease đang thuộc process khác
+
+
+def release_lease(name, owner, bind=engine):
+    with bind.begin() as connection:
+        connection.execute(update(Lease).where(Lease.name == name, Lease.owner == owner).values(expires_at=0))
@@ -1,12 +1,94 @@
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from unidecode import unidecode
+
+# DATABASE_URL=sqlite:///đường/dẫn/site.db để đổi vị trí file DB. Chỉ hỗ trợ SQLite: tìm kiếm dùng FTS5,
+# SQL dùng strftime và các hàm Python normalize/last_name_key đăng ký trên kết nối SQLite
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./database/site.db")
+
+if make_url(DATABASE_URL).get_backend_name() != "sqlite":
+    raise RuntimeError(f"DATABASE_URL phải là SQLite (sqlite:///...), nhận được {make_url(DATABASE_URL).get_backend_name()}")
+
 
-DATABASE_URL = "sqlite:///./database/site.db"
+CONNECT_ARGS = {"check_same_thread": False}
 
-engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}
-)
+
+engine = create_engine(DATABASE_URL, connect_args=CONNECT_ARGS)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
+
+
+def normalize_sql(text):
+    return unidecode(text).lower() if text else ""
+
+
+def last_name_key(full_name):
+    return full_name.split(' ')[-1].lower() if full_name else ""
+
+
+# normalize() giống suppliers.main_sup.normalize để tìm kiếm không dấu ngay trong SQL
+def register_sql_functions(dbapi_connection, connection_record):
+    dbapi_connection.create_function("normalize", 1, normalize_sql, deterministic=True)
+    dbapi_connection.create_function("last_name_key", 1, last_name_key, deterministic=True)
+
+
+# Cấu hình SQLite cho production: WAL để đọc không chặn ghi, chờ khóa thay vì báo "database is locked"
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000")),  # ms
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),  # bytes
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-65536")),  # số âm = KiB (64MB)
+    "temp_store": os.getenv("SQLITE_TEMP_STORE", "MEMORY"),
+}
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+def sqlite_settings():
+    """Giá trị pragma đang có hiệu lực (để log lúc khởi động)."""
+    with engine.connect() as connection:
+        return {
+            name: connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+            for name in SQLITE_PRAGMAS
+        }
+
+
+def optimize_sqlite():
+    # cập nhật thống kê cho query planner, nên chạy định kỳ với kết nối sống lâu
+    with engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA optimize")
+
+
+event.listen(engine, "connect", register_sql_functions)
+event.listen(engine, "connect", apply_sqlite_pragmas)
+
+
+# Engine async (aiosqlite) cho các handler `async def`, chỉ tạo khi được dùng lần đầu
+async_engine = None
+AsyncSessionLocal = None
+
+
+def async_database_url(url=DATABASE_URL):
+    return make_url(url).set(drivername="sqlite+aiosqlite")
+
+
+def get_async_sessionmaker():
+    global async_engine, AsyncSessionLocal
+    if AsyncSessionLocal is None:
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+        async_engine = create_async_engine(async_database_url(), connect_args=CONNECT_ARGS)
+        event.listen(async_engine.sync_engine, "connect", register_sql_functions)
+        event.listen(async_engine.sync_engine, "connect", apply_sqlite_pragmas)
+        AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    return AsyncSessionLocal
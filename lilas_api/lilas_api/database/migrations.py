@@ -0,0 +1,182 @@
+from datetime import datetime
+import logging
+
+from sqlalchemy import Column, Integer, String, DateTime, func, select, insert, inspect, text
+from sqlalchemy.exc import IntegrityError
+from database.main import Base, engine
+
+# import đủ các model để Base.metadata có toàn bộ bảng
+import users.models  # noqa: F401
+import customers.models_cus  # noqa: F401
+import products.models  # noqa: F401
+import suppliers.models_sup  # noqa: F401
+import imports_inspection.models  # noqa: F401
+import invoice.models  # noqa: F401
+import delivery.models  # noqa: F401
+import database.sequences  # noqa: F401
+import database.leases  # noqa: F401
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String, nullable=False)
+    applied_at = Column(DateTime, default=datetime.now)
+
+
+# (version, mô tả, hàm nhận connection) - chỉ thêm migration mới vào cuối, không sửa migration đã chạy
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+
+@migration(1, "Tạo các bảng theo model")
+def create_tables(connection):
+    # DB mới sẽ có luôn cột/index của các migration sau, nên các migration sau phải chạy lại được (checkfirst)
+    Base.metadata.create_all(connection)
+
+
+@migration(2, "Thêm cột giá vốn invoice_items.cost")
+def add_item_cost(connection):
+    # DB cũ chưa có cột invoice_items.cost: thêm cột và lấy price_import hiện tại làm giá vốn
+    columns = [column["name"] for column in inspect(connection).get_columns("invoice_items")]
+    if "cost" not in columns:
+        connection.execute(text("ALTER TABLE invoice_items ADD COLUMN cost FLOAT"))
+        connection.execute(text("""
+            UPDATE invoice_items SET cost = (SELECT price_import FROM products WHERE products.id = invoice_items.product_id)
+            WHERE cost IS NULL
+        """))
+
+
+@migration(3, "Index cho các cột lọc/sắp xếp thường dùng")
+def add_query_indexes(connection):
+    indexes = {index.name: index for table in Base.metadata.tables.values() for index in table.indexes}
+    for name in (
+        "ix_invoices_created_at",
+        "ix_invoices_payment_status_created_at",
+        "ix_invoices_status_created_at",
+        "ix_invoices_branch_created_at",
+        "ix_invoices_customer_id_created_at",
+        "ix_invoice_items_invoice_id",
+        "ix_invoice_items_product_id",
+        "ix_invoice_service_items_invoice_id",
+        "ix_transactions_invoice_id",
+        "ix_transactions_customer_id",
+        "ix_customers_phone",
+        "ix_products_barcode",
+        "ix_products_group_name",
+        "ix_import_bill_items_import_bill_id",
+        "ix_inspection_reports_items_inspection_report_id",
+    ):
+        indexes[name].create(connection, checkfirst=True)
+
+
+@migration(4, "Bảng revoked_tokens cho token đã signout")
+def add_revoked_tokens(connection):
+    users.models.RevokedToken.__table__.create(connection, checkfirst=True)
+
+
+@migration(5, "Bảng ghn_master_data lưu tỉnh/quận/phường của GHN")
+def add_ghn_master_data(connection):
+    users.models.GhnMasterData.__table__.create(connection, checkfirst=True)
+
+
+@migration(6, "Bảng leases để chỉ 1 process chạy scheduler")
+def add_leases(connection):
+    database.leases.Lease.__table__.create(connection, checkfirst=True)
+
+
+@migration(7, "Cột ảnh thu nhỏ của product_images")
+def add_image_variants(connection):
+    columns = [column["name"] for column in inspect(connection).get_columns("product_images")]
+    for name in ("thumbnail_url", "list_url", "detail_url"):
+        if name not in columns:
+            connection.execute(text(f"ALTER TABLE product_images ADD COLUMN {name} VARCHAR"))
+
+
+@migration(8, "Bảng stock_movements ghi sổ biến động tồn kho")
+def add_stock_movements(connection):
+    products.models.StockMovement.__table__.create(connection, checkfirst=True)
+
+
+@migration(9, "Bảng stock_snapshots chốt tồn kho định kỳ")
+def add_stock_snapshots(connection):
+    products.models.StockSnapshot.__table__.create(connection, checkfirst=True)
+    products.models.StockSnapshotItem.__table__.create(connection, checkfirst=True)
+
+
+@migration(10, "Index (created_at, id) để xuất file theo keyset")
+def add_export_indexes(connection):
+    indexes = {index.name: index for table in Base.metadata.tables.values() for index in table.indexes}
+    for name in ("ix_products_created_at_id", "ix_customers_created_at_id", "ix_import_bills_created_at_id"):
+        indexes[name].create(connection, checkfirst=True)
+
+
+@migration(11, "Dựng lại revenue_rollups, sales_facts")
+def rebuild_rollups(connection):
+    # trước đây chỉ process web cập nhật rollup, ghi từ process khác (scheduler...) bị bỏ sót
+    from invoice.rollup import rebuild_revenue_rollups, rebuild_sales_facts
+    rebuild_revenue_rollups(connection)
+    rebuild_sales_facts(connection)
+
+
+@migration(12, "Bảng FTS tìm kiếm, dựng lại toàn bộ index")
+def add_search_indexes(connection):
+    # trước đây bảng FTS tạo lúc web khởi động và chỉ process web cập nhật index
+    from database.search import create_search_indexes
+    create_search_indexes(connection)
+
+
+@migration(13, "Bảng delivery_events nhận callback trạng thái giao hàng")
+def add_delivery_events(connection):
+    invoice.models.DeliveryEvent.__table__.create(connection, checkfirst=True)
+
+
+@migration(14, "Index tìm kiếm hóa đơn (kèm tên, số điện thoại khách)")
+def add_invoice_search_index(connection):
+    from database.search import create_search_indexes
+    create_search_indexes(connection, ["invoices"])
+
+
+def current_version(connection):
+    SchemaVersion.__table__.create(connection, checkfirst=True)
+    return connection.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+
+def pending_migrations(bind=engine):
+    with bind.begin() as connection:
+        version = current_version(connection)
+    return [number for number, _, _ in MIGRATIONS if number > version]
+
+
+def upgrade(bind=engine):
+    """Chạy các migration chưa áp dụng, mỗi migration 1 transaction. Trả về version hiện tại."""
+    with bind.begin() as connection:
+        version = current_version(connection)
+
+    for number, description, apply in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if number <= version:
+            continue
+        try:
+            with bind.begin() as connection:
+                apply(connection)
+                connection.execute(insert(SchemaVersion).values(version=number, description=description))
+            logger.info("Migration %s: %s", number, description)
+        except IntegrityError:
+            logger.info("Migration %s đã được process khác áp dụng", number)
+        version = number
+    return version
+
+
+if __name__ == "__main__":
+    # python -m database.migrations : nâng cấp schema lên version mới nhất, chạy 1 lần trước khi start các worker
+    logging.basicConfig(level=logging.INFO)
+    logger.info("Schema version %s", upgrade())
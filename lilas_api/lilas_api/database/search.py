@@ -0,0 +1,221 @@
+from collections import defaultdict
+from itertools import count
+import logging
+
+from sqlalchemy import event, text, bindparam, column, inspect, String
+from database.main import engine, SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Mỗi thực thể có 1 bảng FTS5 (tokenizer trigram) chứa nội dung đã normalize (bỏ dấu + chữ thường),
+# nên tìm "sua rua" hay "sữa rửa" đều khớp chuỗi con giống normalize() trong Python.
+SEARCH_INDEXES = {
+    "products": {
+        "columns": ["name", "brand", "barcode", "group_name"],
+        "source": """
+            SELECT p.id, normalize(p.name), normalize(p.brand), normalize(p.barcode), normalize(p.group_name)
+            FROM products p
+        """,
+        "key": "p.id",
+    },
+    "customers": {
+        "columns": ["full_name", "phone", "email"],
+        "source": """
+            SELECT c.id, normalize(c.full_name), normalize(c.phone), normalize(c.email)
+            FROM customers c
+        """,
+        "key": "c.id",
+    },
+    "suppliers": {
+        "columns": ["contact_name", "phone", "email", "address"],
+        "source": """
+            SELECT s.id, normalize(s.contact_name), normalize(s.phone), normalize(s.email), normalize(s.address)
+            FROM suppliers s
+        """,
+        "key": "s.id",
+    },
+    "import_bills": {
+        "columns": ["code", "note", "branch", "status", "product_ids"],
+        "source": """
+            SELECT b.id, normalize(b.id), normalize(b.note), normalize(b.branch), normalize(b.status),
+                   (SELECT group_concat(normalize(i.product_id), ' ') FROM import_bill_items i WHERE i.import_bill_id = b.id)
+            FROM import_bills b
+        """,
+        "key": "b.id",
+    },
+    "transaction_tranfers": {
+        "columns": ["code", "from_warehouse", "to_warehouse", "note", "user_id"],
+        "source": """
+            SELECT t.id, normalize(t.id), normalize(t.from_warehouse), normalize(t.to_warehouse),
+                   normalize(t.note), normalize(t.user_id)
+            FROM transaction_tranfers t
+        """,
+        "key": "t.id",
+    },
+    "product_groups": {
+        "columns": ["name", "description"],
+        "source": """
+            SELECT g.name, normalize(g.name), normalize(g.description)
+            FROM product_groups g
+        """,
+        "key": "g.name",
+    },
+    # tên / số điện thoại khách được chép vào index hóa đơn, xem CASCADE_TABLES
+    "invoices": {
+        "columns": ["code", "branch", "note", "status", "customer_name", "customer_phone"],
+        "source": """
+            SELECT i.id, normalize(i.id), normalize(i.branch), normalize(i.note), normalize(i.status),
+                   normalize(c.full_name), normalize(c.phone)
+            FROM invoices i LEFT JOIN customers c ON c.id = i.customer_id
+        """,
+        "key": "i.id",
+    },
+}
+
+# bảng ORM -> (index cần cập nhật, thuộc tính chứa khóa của index)
+TRACKED_TABLES = {
+    "products": [("products", "id")],
+    "customers": [("customers", "id")],
+    "suppliers": [("suppliers", "id")],
+    "import_bills": [("import_bills", "id")],
+    "import_bill_items": [("import_bills", "import_bill_id")],
+    "transaction_tranfers": [("transaction_tranfers", "id")],
+    "product_groups": [("product_groups", "name")],
+    "invoices": [("invoices", "id")],
+}
+
+# bảng ORM -> (index, cột trong source để lọc, thuộc tính chứa giá trị lọc, các thuộc tính được chép vào index):
+# chỉ khi các thuộc tính đó đổi mới index lại (khách đổi công nợ/tổng chi tiêu không phải index lại mọi hóa đơn)
+CASCADE_TABLES = {
+    "customers": [("invoices", "i.customer_id", "id", ("full_name", "phone"))],
+}
+
+_param_counter = count()
+
+
+def fts_table(index):
+    return f"{index}_fts"
+
+
+def _create_index_table(connection, index):
+    columns = ", ".join(SEARCH_INDEXES[index]["columns"])
+    connection.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table(index)} "
+        f"USING fts5(id UNINDEXED, {columns}, tokenize='trigram')"
+    ))
+
+
+def refresh_search_index(connection, index, ids=None):
+    """Ghi lại các dòng của index từ bảng gốc; ids=None thì dựng lại toàn bộ."""
+    config = SEARCH_INDEXES[index]
+    table = fts_table(index)
+    columns = ", ".join(["id"] + config["columns"])
+
+    if ids is None:
+        connection.execute(text(f"DELETE FROM {table}"))
+        connection.execute(text(f"INSERT INTO {table} ({columns}) {config['source']}"))
+        return
+
+    ids = [i for i in ids if i is not None]
+    if not ids:
+        return
+    connection.execute(
+        text(f"DELETE FROM {table} WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+        {"ids": ids},
+    )
+    connection.execute(
+        text(f"INSERT INTO {table} ({columns}) {config['source']} WHERE {config['key']} IN :ids")
+        .bindparams(bindparam("ids", expanding=True)),
+        {"ids": ids},
+    )
+
+
+def create_search_indexes(connection, indexes=SEARCH_INDEXES):
+    """Tạo các bảng FTS và dựng lại toàn bộ index (migration)."""
+    for index in indexes:
+        _create_index_table(connection, index)
+        refresh_search_index(connection, index)
+
+
+def check_search_indexes(bind=engine, fix=True):
+    """So số dòng mỗi index với bảng gốc, lệch thì log và dựng lại index đó. Trả về số index lệch."""
+    stale = []
+    with bind.begin() as connection:
+        for index, config in SEARCH_INDEXES.items():
+            indexed = connection.execute(text(f"SELECT count(*) FROM {fts_table(index)}")).scalar()
+            expected = connection.execute(text(f"SELECT count(*) FROM ({config['source']})")).scalar()
+            if indexed != expected:
+                stale.append(index)
+                logger.warning("Index tìm kiếm %s có %s dòng, bảng gốc %s dòng", index, indexed, expected)
+                if fix:
+                    refresh_search_index(connection, index)
+    return len(stale)
+
+
+def search_ids(index, term, columns=None):
+    """
+    Trả về SELECT id khớp `term` (đã normalize) để dùng trong Model.id.in_(...).
+    Từ khóa >= 3 ký tự dùng MATCH trên index trigram, ngắn hơn thì LIKE trên bảng FTS.
+    """
+    config = SEARCH_INDEXES[index]
+    table = fts_table(index)
+    columns = columns or config["columns"]
+
+    # tên tham số riêng cho mỗi lần gọi để nhiều subquery trong cùng 1 câu lệnh không đè nhau
+    param = f"{index}_term_{next(_param_counter)}"
+
+    if len(term) >= 3:
+        phrase = '"' + term.replace('"', '""') + '"'
+        stmt = text(f"SELECT id FROM {table} WHERE {table} MATCH :{param}").bindparams(
+            **{param: "{" + " ".join(columns) + "} : " + phrase}
+        )
+    else:
+        pattern = "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        where = " OR ".join(f"{c} LIKE :{param} ESCAPE '\\'" for c in columns)
+        stmt = text(f"SELECT id FROM {table} WHERE {where}").bindparams(**{param: pattern})
+
+    return stmt.columns(column("id", String))
+
+
+def _cascade_ids(connection, index, by, values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return []
+    return connection.execute(
+        text(f"SELECT id FROM ({SEARCH_INDEXES[index]['source']} WHERE {by} IN :values)")
+        .bindparams(bindparam("values", expanding=True)),
+        {"values": values},
+    ).scalars().all()
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def sync_search_indexes(session, flush_context):
+    changed = defaultdict(set)
+    cascades = defaultdict(set)
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(obj, "__tablename__", None)
+        state = inspect(obj)
+        for index, attr in TRACKED_TABLES.get(table, []):
+            # lấy cả giá trị cũ của khóa (đổi tên nhóm, chuyển item sang phiếu khác)
+            history = state.attrs[attr].history
+            changed[index].update(history.added or [getattr(obj, attr, None)])
+            changed[index].update(history.deleted or [])
+        for index, by, attr, copied in CASCADE_TABLES.get(table, []):
+            if obj in session.dirty and not any(state.attrs[name].history.has_changes() for name in copied):
+                continue
+            cascades[(index, by)].add(getattr(obj, attr, None))
+
+    if changed or cascades:
+        connection = session.connection()
+        for (index, by), values in cascades.items():
+            changed[index].update(_cascade_ids(connection, index, by, values))
+        for index, ids in changed.items():
+            refresh_search_index(connection, index, ids)
+
+
+if __name__ == "__main__":
+    # python -m database.search : dựng lại toàn bộ index tìm kiếm
+    logging.basicConfig(level=logging.INFO)
+    with engine.begin() as connection:
+        create_search_indexes(connection)
+    logger.info("Đã dựng index tìm kiếm %s", ", ".join(SEARCH_INDEXES))
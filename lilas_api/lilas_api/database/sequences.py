@@ -0,0 +1,44 @@
+from sqlalchemy import Column, String, Integer, func, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from database.main import Base
+
+
+class Sequence(Base):
+    __tablename__ = "sequences"
+
+    prefix = Column(String, primary_key=True)  # "DH", "KH", "NCC", ...
+    value = Column(Integer, nullable=False, default=0)
+
+
+def _increment(db: Session, prefix: str):
+    return db.execute(
+        update(Sequence)
+        .where(Sequence.prefix == prefix)
+        .values(value=Sequence.value + 1)
+        .returning(Sequence.value)
+    ).scalar()
+
+
+def next_id(db: Session, prefix: str, model) -> str:
+    """
+    Cấp mã mới dạng <prefix><số> (DH12, NCC3...) bằng 1 lệnh UPDATE ... RETURNING trên bảng sequences.
+    Lệnh UPDATE giữ khóa ghi đến hết transaction nên 2 request đồng thời không thể nhận cùng 1 mã.
+    Lần đầu dùng prefix thì khởi tạo bộ đếm từ mã lớn nhất đang có trong bảng của model.
+    """
+    value = _increment(db, prefix)
+    if value is None:
+        last_id = db.query(func.max(func.cast(func.substr(model.id, len(prefix) + 1), Integer))).scalar()
+        try:
+            with db.begin_nested():
+                db.add(Sequence(prefix=prefix, value=last_id or 0))
+        except IntegrityError:
+            pass  # request khác vừa khởi tạo bộ đếm
+        value = _increment(db, prefix)
+
+    new_id = f"{prefix}{value}"
+    # bỏ qua mã đã bị chèn tay (ngoài bộ đếm) để không trùng khóa chính
+    while db.get(model, new_id) is not None:
+        value = _increment(db, prefix)
+        new_id = f"{prefix}{value}"
+    return new_id
@@ -1,13 +1,14 @@
 from fastapi import APIRouter, Depends, HTTPException, Security, Query, Body
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload, contains_eager
 from suppliers.models_sup import Supplier, SupplierTransaction
-from imports_inspection.models import Base
 from products.models import Product
+from products.stock import WAREHOUSES, Move, apply_moves, stock_column
 from users.main import role_required 
 from users.models import User, Account
 from fastapi.security import HTTPBearer
-from sqlalchemy import func, desc
-from database.main import engine  
+from sqlalchemy import func, desc, select
+from database.search import search_ids
+from database.sequences import next_id
 from users.dependencies import get_db 
 from sqlalchemy import or_, func, Integer
 from typing import Optional, List
@@ -18,8 +19,9 @@ from imports_inspection.schema import (
     InspectionReportCreate, InspectionReportResponse,InspectionReportUpdate, InspectionReportListResponse, InspectionReportHistoryResponse, ReturnBillCreate, ReturnBillUpdate, ReturnBillResponse, 
     ReturnBillListResponse, ReturnBillItemCreate
 )
-from datetime import timedelta, datetime
-Base.metadata.create_all(bind=engine)
+from database.export import keyset_batches, export_response
+from collections import defaultdict
+from datetime import timedelta, datetime, date
 security_scheme = HTTPBearer()
 
 router = APIRouter()
@@ -54,6 +56,9 @@ def create_import_bill(
         else:
             raise HTTPException(status_code=400, detail="IMPORT_BILL_MUST_HAVE_USER.")
 
+        if data.branch not in WAREHOUSES:
+            raise HTTPException(status_code=400, detail="BRANCH_NOT_SUPPORTED")
+
         valid_products = []
         for item_data in data.items:
             product = db.query(Product).filter(
@@ -66,15 +71,6 @@ def create_import_bill(
                 raise HTTPException(status_code=404, detail=f"PRODUCT_{item_data.product_id}_IS_NOT_AVAILABLE.")
 
             valid_products.append(product)
-            if data.branch == "Terra":
-                product.pending_arrival_terra += item_data.quantity
-            elif data.branch == "Thợ Nhuộm":
-                product.pending_arrival_thonhuom += item_data.quantity
-            else:
-                raise HTTPException(status_code=400, detail="BRANCH_NOT_SUPPORTED")
-                
-            db.commit()
-            db.refresh(product)
         
         total_value = sum((item_data.price * item_data.quantity) - item_data.discount for item_data in data.items)
         total_value += (data.extra_fee) - (data.discount)
@@ -82,11 +78,7 @@ def create_import_bill(
         if data.paid_amount and data.paid_amount > total_value:
             raise HTTPException(status_code=400, detail="PAID_AMOUNT_CANNOT_EXCEED_TOTAL_VALUE.")
 
-        last_id = db.query(func.max(func.cast(func.substr(ImportBill.id, 3), Integer))).scalar()
-        if last_id:
-            new_id = f"PN{last_id + 1}"
-        else:
-            new_id = "PN1"
+        new_id = next_id(db, "PN", ImportBill)
 
         new_bill = ImportBill(
             id=new_id,
@@ -100,6 +92,8 @@ def create_import_bill(
             delivery_date=data.delivery_date
         )
         db.add(new_bill)
+        # hàng đang chờ về, chuyển sang tồn khi hoàn tất phiếu kiểm
+        apply_moves(db, [Move(item_data.product_id, data.branch, "pending_arrival", item_data.quantity) for item_data in data.items], new_id, "import_bill_create")
         db.commit()
         db.refresh(new_bill)
         for item_data, product in zip(data.items, valid_products):
@@ -152,27 +146,62 @@ def list_import_bills(
 ):
     query = db.query(ImportBill).join(Supplier, isouter=True).filter(ImportBill.active == True)
     if search:
-        bills = query.all()  
         search_normalized = normalize(search)
-        filtered_bills = [
-                bill for bill in bills
-                if search_normalized in normalize(bill.note)
-                or search_normalized in normalize(bill.id)
-                or search_normalized in normalize(bill.branch)
-                or search_normalized in normalize(bill.status)
-                or (bill.supplier and search_normalized in normalize(bill.supplier.contact_name))
-                or any(search_normalized in normalize(item.product.id) for item in bill.items)
-            ]
-    else:
-         filtered_bills = query.all()
-
-    sorted_imports = sorted(filtered_bills, key=lambda bill: bill.created_at, reverse=True)
-    total_import_bills = len(filtered_bills)
-    bills = sorted_imports[skip: skip + limit]  
+        query = query.filter(or_(
+            ImportBill.id.in_(search_ids("import_bills", search_normalized)),
+            ImportBill.supplier_id.in_(search_ids("suppliers", search_normalized, ["contact_name"]))
+        ))
+
+    total_import_bills = query.count()
+    bills = query.options(
+        contains_eager(ImportBill.supplier),
+        selectinload(ImportBill.user),
+        selectinload(ImportBill.items).selectinload(ImportBillItem.product).selectinload(Product.images),
+        selectinload(ImportBill.returns)
+    ).order_by(desc(ImportBill.created_at)).offset(skip).limit(limit).all()
     return {
          "total_import_bills": total_import_bills,
          "import_bills": bills
      }
+IMPORT_BILL_EXPORT_HEADER = [
+    "Mã phiếu nhập", "Ngày tạo", "Nhà cung cấp", "Chi nhánh", "Trạng thái", "Tổng tiền", "Đã trả",
+    "Mã sản phẩm", "Tên sản phẩm", "Số lượng", "Đơn giá", "Chiết khấu (%)", "Thành tiền",
+]
+
+@router.get("/import_bills/export", dependencies=[Security(security_scheme)])
+def export_import_bills(
+    format: str = Query("csv", description="csv | xlsx"),
+    start_date: Optional[date] = Query(None),
+    end_date: Optional[date] = Query(None),
+    current_user: Account = role_required(["admin", "warehouse_staff"])
+):
+    statement = select(
+        ImportBill.id, ImportBill.created_at, Supplier.contact_name, ImportBill.branch, ImportBill.status,
+        ImportBill.total_value, ImportBill.paid_amount,
+    ).outerjoin(Supplier, ImportBill.supplier_id == Supplier.id).where(ImportBill.active == True)
+    if start_date:
+        statement = statement.where(ImportBill.created_at >= start_date)
+    if end_date:
+        statement = statement.where(ImportBill.created_at < end_date + timedelta(days=1))
+
+    def with_items(db, bills):
+        items = defaultdict(list)
+        for item in db.execute(
+            select(ImportBillItem.import_bill_id, ImportBillItem.product_id, Product.name, ImportBillItem.quantity,
+                   ImportBillItem.price, ImportBillItem.discount, ImportBillItem.total_line)
+            .outerjoin(Product, ImportBillItem.product_id == Product.id)
+            .where(ImportBillItem.import_bill_id.in_([bill.id for bill in bills]))
+            .order_by(ImportBillItem.id)
+        ):
+            items[item.import_bill_id].append(list(item[1:]))
+        return [list(bill) + item for bill in bills for item in items.get(bill.id) or [[None] * 6]]
+
+    def rows():
+        for batch in keyset_batches(statement, (ImportBill.created_at, ImportBill.id), with_items):
+            yield from batch
+
+    return export_response("phieu_nhap", format, IMPORT_BILL_EXPORT_HEADER, rows())
+
 @router.get("/import_bills/{bill_id}", response_model=ImportBillResponse, dependencies=[Security(security_scheme)])
 def get_import_bill(
     bill_id: str,
@@ -214,17 +243,9 @@ def update_import_bill(
         if key != "items":
             setattr(bill, key, value)
     old_items = db.query(ImportBillItem).filter(ImportBillItem.import_bill_id == bill_id).all()
-
-    for old_item in old_items:
-        product = db.query(Product).filter(Product.id == old_item.product_id).first()
-        if product:
-            if old_branch == "Terra":  
-                product.pending_arrival_terra -= old_item.quantity
-            elif old_branch == "Thợ Nhuộm":
-                product.pending_arrival_thonhuom -= old_item.quantity
+    moves = [Move(old_item.product_id, old_branch, "pending_arrival", -old_item.quantity) for old_item in old_items]
 
     db.query(ImportBillItem).filter(ImportBillItem.import_bill_id == bill_id).delete()
-    db.commit()
 
     new_items = []
     for item_data in data.items:
@@ -240,12 +261,9 @@ def update_import_bill(
             discount=item_data.discount,
         )
         new_items.append(new_item)
+        moves.append(Move(product.id, bill.branch, "pending_arrival", item_data.quantity))
 
-        if data.branch == "Terra":
-            product.pending_arrival_terra += item_data.quantity
-        elif data.branch == "Thợ Nhuộm":
-            product.pending_arrival_thonhuom += item_data.quantity
-
+    apply_moves(db, moves, bill.id, "import_bill_update")
     db.add_all(new_items)
     db.commit()
 
@@ -335,10 +353,6 @@ def confirm_import_bill(
         supplier.total_import_value += float(bill.total_value)
         supplier.total_import_orders += 1
 
-    db.commit()
-    db.refresh(bill)
-    db.refresh(supplier)
-
     # new_price
     total_line_value = 0
     for it in bill.items:
@@ -375,6 +389,9 @@ def confirm_import_bill(
         print(f"  - Giá vốn/SLnhập: {cost_in_unit} = {cost_in_total}/ {it.quantity}")
         
         update_price_import_for_product(db, product, it.quantity, cost_in_unit)
+
+    # trạng thái phiếu, công nợ NCC và giá vốn lưu trong 1 transaction
+    db.commit()
     db.refresh(bill)
     return bill
 
@@ -431,11 +448,7 @@ def create_inspection_report(
         if existing_report:
             raise HTTPException(status_code=400, detail="INSPECTION_REPORT_ALREADY_EXISTS")
 
-        last_id = db.query(func.max(func.cast(func.substr(InspectionReport.id, 3), Integer))).scalar()    
-        if last_id: 
-            new_id = f"PK{last_id + 1}"
-        else:
-            new_id = "PK1"
+        new_id = next_id(db, "PK", InspectionReport)
 
         new_inspection_report = InspectionReport(
             id=new_id,
@@ -612,29 +625,13 @@ def complete_inspection_reports(
     if not report:
         raise HTTPException(status_code=404, detail="NOT_FOUND")
 
-    # Cập nhật can_sell cho từng sản phẩm trong phiếu kiểm
+    # Cập nhật tồn/can_sell theo số thực nhận, trừ hàng đang chờ về
+    moves = []
     for item in report.items:
-        product = db.query(Product).filter(Product.id == item.product_id).first()
-        if product:
-            if report.branch == "Terra":
-                product.terra_stock += item.actual_quantity
-                product.terra_can_sell+= item.actual_quantity
-                # product.pending_arrival_terra -= item.actual_quantity
-                product.pending_arrival_terra -= item.actual_quantity
-            elif report.branch == "Thợ Nhuộm":
-                product.thonhuom_stock += item.actual_quantity
-                product.thonhuom_can_sell+= item.actual_quantity
-                # product.pending_arrival_thonhuom -= item.actual_quantity
-                product.pending_arrival_thonhuom -= item.actual_quantity
-            else:
-                raise HTTPException(status_code=400, detail="BRANCH_NOT_FOUND")
-            
-            # product.can_sell += item.actual_quantity
-            # product.pending_arrival -= item.actual_quantity
- 
-
-            db.commit()
-            db.refresh(product)
+        moves.append(Move(item.product_id, report.branch, "stock", item.actual_quantity))
+        moves.append(Move(item.product_id, report.branch, "can_sell", item.actual_quantity))
+        moves.append(Move(item.product_id, report.branch, "pending_arrival", -item.actual_quantity))
+    apply_moves(db, moves, report.id, "inspection_complete")
 
     report.status = "checked"
     report.complete_at = datetime.utcnow()
@@ -701,10 +698,7 @@ def create_return_bill(
     if not data.branch:
         raise HTTPException(status_code=400, detail="BRANCH_REQUIRED")
 
-    last_id = db.query(
-        func.max(func.cast(func.substr(ReturnBill.id, 3), Integer))
-    ).scalar()
-    new_id = f"TH{last_id + 1}" if last_id else "TH1"
+    new_id = next_id(db, "TH", ReturnBill)
 
     new_return_bill = ReturnBill(
         id=new_id,
@@ -896,25 +890,19 @@ def confirm_return_bill(
         raise HTTPException(status_code=400, detail="ONLY_RETURNING_BILL_CAN_BE_CONFIRMED")
 
     calculate_return_total(db, return_bill)
+    if return_bill.branch not in WAREHOUSES:
+        raise HTTPException(status_code=400, detail="BRANCH_NOT_SUPPORTED")
+    stock_field = stock_column(return_bill.branch, "stock")
     for item in return_bill.items:
         product = item.product
         if not product:
             raise HTTPException(status_code=400, detail=f"PRODUCT_{item.product_id}_NOT_FOUND")
 
-        if return_bill.branch == "Terra":
-            if product.terra_stock < item.quantity:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"STOCK_NOT_ENOUGH_FOR_PRODUCT_{product.id}"
-                )
-        elif return_bill.branch == "Thợ Nhuộm":
-            if product.thonhuom_stock < item.quantity:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"STOCK_NOT_ENOUGH_FOR_PRODUCT_{product.id}"
-                )
-        else:
-            raise HTTPException(status_code=400, detail="BRANCH_NOT_SUPPORTED")
+        if getattr(product, stock_field) < item.quantity:
+            raise HTTPException(
+                status_code=400,
+                detail=f"STOCK_NOT_ENOUGH_FOR_PRODUCT_{product.id}"
+            )
 
     # new_price
     total_line_value = 0
@@ -949,15 +937,14 @@ def confirm_return_bill(
         # reduce_price_import_for_product(db, product, item.quantity, item.price)
         reduce_price_import_for_product(db, product, item.quantity, cost_in_unit)
 
-        if return_bill.branch == "Terra":
-            product.terra_stock = max(product.terra_stock - item.quantity, 0)
-            product.terra_can_sell = max(product.terra_can_sell - item.quantity, 0)
-        else:
-            product.thonhuom_stock = max(product.thonhuom_stock - item.quantity, 0)
-            product.thonhuom_can_sell = max(product.thonhuom_can_sell - item.quantity, 0)
-        
-        db.commit()
-        db.refresh(product)
+    # giá vốn tính trên tồn trước khi trả nên trừ kho sau cùng; can_sell có thể đã giữ cho đơn khác nên chỉ trừ về 0
+    apply_moves(
+        db,
+        [Move(item.product_id, return_bill.branch, field, -item.quantity) for item in return_bill.items for field in ("stock", "can_sell")],
+        return_bill.id,
+        "return_bill_confirm",
+        clamp=True,
+    )
 
     supplier = db.query(Supplier).filter(Supplier.id == return_bill.supplier_id).first()
     if supplier:
@@ -967,9 +954,6 @@ def confirm_return_bill(
         supplier.total_return_orders += 1
         supplier.total_return_value += float(return_bill.total_value)
 
-        db.commit()
-        db.refresh(supplier)
-
     return_bill.status = "returned"
     db.commit()
     db.refresh(return_bill)
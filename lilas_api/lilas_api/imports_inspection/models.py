@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Text, Index
 from datetime import datetime, timezone, date
 from sqlalchemy.orm import relationship
 from database.main import Base
@@ -10,6 +10,8 @@ import pytz
 vietnam_tz = pytz.timezone("Asia/Ho_Chi_Minh")
 class ImportBill(Base):
     __tablename__ = "import_bills"
+    # phân trang keyset khi xuất file (database/export.py)
+    __table_args__ = (Index("ix_import_bills_created_at_id", "created_at", "id"),)
 
     id = Column(String, primary_key=True, index=True)
     created_at = Column(DateTime, default=lambda: datetime.now(vietnam_tz))
@@ -40,7 +42,7 @@ class ImportBillItem(Base):
     __tablename__ = "import_bill_items"
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    import_bill_id = Column(String, ForeignKey("import_bills.id", ondelete="CASCADE"), nullable=False)
+    import_bill_id = Column(String, ForeignKey("import_bills.id", ondelete="CASCADE"), nullable=False, index=True)
     product_id = Column(String, ForeignKey("products.id", ondelete="SET NULL"), nullable=True)
 
     quantity = Column(Integer, default=1)
@@ -49,7 +51,7 @@ class ImportBillItem(Base):
     total_line = Column(Float, default=0.0)  # thành tiền dòng
 
     import_bill = relationship("ImportBill", back_populates="items")
-    product = relationship("Product", lazy="joined")
+    product = relationship("Product", lazy="selectin")
 
     def __repr__(self):
         return f"<ImportBillItem(id={self.id}, product_id={self.product_id})>"
@@ -79,7 +81,7 @@ class InspectionReportItem(Base):
     __tablename__ = "inspection_reports_items"
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    inspection_report_id = Column(String, ForeignKey("inspection_reports.id", ondelete="CASCADE"), nullable=False)
+    inspection_report_id = Column(String, ForeignKey("inspection_reports.id", ondelete="CASCADE"), nullable=False, index=True)
     product_id = Column(String, ForeignKey("products.id", ondelete="SET NULL"), nullable=True)
     quantity = Column(Integer, default=1)
     actual_quantity = Column(Integer, default=0)
@@ -87,7 +89,7 @@ class InspectionReportItem(Base):
     note = Column(Text, nullable=True)  
 
     inspection_report = relationship("InspectionReport", back_populates="items")
-    product = relationship("Product", lazy="joined")
+    product = relationship("Product", lazy="selectin")
     created_at = Column(DateTime, default=lambda: datetime.now(vietnam_tz))
     def __repr__(self):
         return f"<InspectionReportItem(id={self.id}, product_id={self.product_id}, quantity={self.quantity}, actual_quantity={self.actual_quantity})>"
@@ -123,7 +125,7 @@ class ImportBillReturn(Base):
     created_at = Column(DateTime, default=lambda: datetime.now(vietnam_tz))
 
     import_bill = relationship("ImportBill", back_populates="returns")
-    product = relationship("Product", lazy="joined")
+    product = relationship("Product", lazy="selectin")
 
 class ReturnBill(Base):
     __tablename__ = "return_bills"
@@ -168,7 +170,7 @@ class ReturnBillItem(Base):
     created_at = Column(DateTime, default=lambda: datetime.now(vietnam_tz))
 
     return_bill = relationship("ReturnBill", back_populates="items")
-    product = relationship("Product", lazy="joined")
+    product = relationship("Product", lazy="selectin")
 
     def __repr__(self):
         return f"<ReturnBillItem(id={self.id}, product_id={self.product_id}, quantity={self.quantity})>"
\ No newline at end of file
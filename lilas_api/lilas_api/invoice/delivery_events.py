@@ -0,0 +1,144 @@
+import hashlib
+import hmac
+import logging
+import os
+from datetime import datetime, timedelta
+
+import pydantic
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload
+
+from delivery.models import Delivery
+from invoice.models import DeliveryEvent, vietnam_tz
+from invoice.schema import DeliveryCallback
+from users.dependencies import get_async_db
+
+logger = logging.getLogger(__name__)
+
+# Callback trạng thái đơn của hãng vận chuyển: nhận -> ghi vào hàng đợi delivery_events (bỏ trùng theo event_id)
+# -> job leader áp dụng theo lô vào deliveries / invoices. Polling GHN chỉ còn là đối soát định kỳ.
+
+# khóa ký HMAC-SHA256 thân request, gửi trong header X-Signature (hex). Chưa cấu hình thì từ chối mọi callback
+DELIVERY_WEBHOOK_SECRET = os.getenv("DELIVERY_WEBHOOK_SECRET")
+DELIVERY_EVENT_BATCH = int(os.getenv("DELIVERY_EVENT_BATCH", "200"))
+# giữ event đã áp dụng để bỏ trùng callback gửi lại và so thứ tự event đến muộn
+DELIVERY_EVENT_RETENTION_DAYS = int(os.getenv("DELIVERY_EVENT_RETENTION_DAYS", "30"))
+
+router = APIRouter()
+
+
+def sign(body: bytes, secret=None):
+    return hmac.new((secret or DELIVERY_WEBHOOK_SECRET).encode(), body, hashlib.sha256).hexdigest()
+
+
+def event_id(callback: DeliveryCallback):
+    # GHN không gửi id cho từng callback: cùng đơn + trạng thái + thời điểm là cùng 1 event
+    key = f"{callback.OrderCode}|{callback.Status}|{callback.Time.isoformat()}|{callback.Type or ''}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def local_time(value: datetime):
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(vietnam_tz).replace(tzinfo=None)
+
+
+@router.post("/ghn/callback")
+async def ghn_callback(
+    request: Request,
+    x_signature: str = Header(None),
+    db: AsyncSession = Depends(get_async_db),
+):
+    if not DELIVERY_WEBHOOK_SECRET:
+        raise HTTPException(status_code=503, detail="DELIVERY_WEBHOOK_DISABLED")
+    body = await request.body()
+    if not x_signature or not hmac.compare_digest(sign(body), x_signature):
+        raise HTTPException(status_code=401, detail="INVALID_SIGNATURE")
+    try:
+        callback = DeliveryCallback.parse_raw(body)
+    except pydantic.ValidationError:
+        raise HTTPException(status_code=422, detail="INVALID_PAYLOAD")
+
+    # hãng gửi lại callback khi timeout: event đã có thì bỏ qua, vẫn trả 200 để hãng không gửi tiếp
+    result = await db.execute(
+        insert(DeliveryEvent)
+        .values(
+            event_id=event_id(callback),
+            order_code=callback.OrderCode,
+            status=callback.Status,
+            event_time=local_time(callback.Time),
+            received_at=datetime.now(vietnam_tz),
+        )
+        .on_conflict_do_nothing(index_elements=["event_id"])
+    )
+    await db.commit()
+    return {"queued": result.rowcount == 1}
+
+
+def apply_delivery_events(db: Session, batch_size=DELIVERY_EVENT_BATCH):
+    """
+    Áp dụng các event chưa xử lý theo lô `batch_size`, mỗi lô 1 transaction. Trả về số event đã xử lý.
+    Mỗi đơn chỉ lấy event mới nhất (theo event_time); event cũ hơn trạng thái đã áp dụng (đến muộn) bị bỏ qua.
+    """
+    processed = 0
+    while True:
+        events = (
+            db.query(DeliveryEvent)
+            .filter(DeliveryEvent.applied_at.is_(None))
+            .order_by(DeliveryEvent.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not events:
+            return processed
+
+        latest = {}
+        for event in events:
+            current = latest.get(event.order_code)
+            if current is None or event.event_time > current.event_time:
+                latest[event.order_code] = event
+
+        applied_times = dict(
+            db.query(DeliveryEvent.order_code, func.max(DeliveryEvent.event_time))
+            .filter(DeliveryEvent.order_code.in_(latest), DeliveryEvent.applied_at.isnot(None))
+            .group_by(DeliveryEvent.order_code)
+        )
+        deliveries = (
+            db.query(Delivery)
+            .options(joinedload(Delivery.invoice))
+            .filter(Delivery.order_code.in_(latest))
+            .all()
+        )
+        for delivery in deliveries:
+            event = latest[delivery.order_code]
+            applied_time = applied_times.get(delivery.order_code)
+            if applied_time is not None and event.event_time <= applied_time:
+                continue
+            delivery.status = event.status
+            if delivery.invoice is not None:
+                delivery.invoice.status = event.status
+
+        unknown = set(latest) - {delivery.order_code for delivery in deliveries}
+        if unknown:
+            # đơn chưa có trong deliveries: polling đối soát sẽ cập nhật sau
+            logger.warning("Callback cho %s mã vận đơn không có trong deliveries, ví dụ: %s", len(unknown), sorted(unknown)[:5])
+
+        now = datetime.now(vietnam_tz)
+        for event in events:
+            event.applied_at = now
+        db.commit()
+        processed += len(events)
+
+
+def prune_delivery_events(db: Session, days=DELIVERY_EVENT_RETENTION_DAYS):
+    cutoff = datetime.now(vietnam_tz) - timedelta(days=days)
+    deleted = (
+        db.query(DeliveryEvent)
+        .filter(DeliveryEvent.applied_at.isnot(None), DeliveryEvent.applied_at < cutoff)
+        .delete(synchronize_session=False)
+    )
+    db.commit()
+    return deleted
@@ -1,13 +1,15 @@
 from fastapi import APIRouter, Depends, HTTPException, Security, Query
-from sqlalchemy.orm import Session
-from invoice.models import Invoice, InvoiceItem, InvoiceServiceItem, Base
+from sqlalchemy.orm import Session, selectinload
+from invoice.models import Invoice, InvoiceItem, InvoiceServiceItem, RevenueRollup, RevenueRollupCustomer, SalesFact
 from users.main import role_required 
 from users.models import User
 from fastapi.security import HTTPBearer
 from sqlalchemy import func
-from database.main import engine  
+from database.sequences import next_id
+from database.cache import cached
+from database.search import search_ids
 from users.dependencies import get_db 
-from sqlalchemy import or_, func, Integer, desc
+from sqlalchemy import or_, and_, func, Integer, desc, true, select
 from typing import Optional, List
 from users.models import Account
 from users.main import update_user_stats
@@ -15,15 +17,17 @@ from invoice.schema import (
     InvoiceCreate, InvoiceResponse, InvoiceListResponse, InvoiceUpdate
 )
 from products.models import Product
+from products.stock import Move, apply_moves, stock_column
 from invoice.models import Invoice, InvoiceItem, InvoiceServiceItem
 from users.utils import calculate_invoice_total_and_status
 from customers.models_cus import Customer, Transaction
-from datetime import datetime, timedelta, timezone
+from database.export import keyset_batches, export_response
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone, date
 import logging
 
 logger = logging.getLogger(__name__)
 
-Base.metadata.create_all(bind=engine)
 security_scheme = HTTPBearer()
 
 router = APIRouter()
@@ -52,31 +56,30 @@ def create_invoice(
         else:
             pass
 
+        stock_field = stock_column(data.branch, "stock")
+
+        # lấy + khóa tất cả sản phẩm của đơn trong 1 truy vấn
+        product_ids = {item.product_id for item in data.items}
+        products = {
+            product.id: product
+            for product in db.query(Product)
+            .filter(Product.id.in_(product_ids), Product.active == True)
+            .with_for_update()
+            .all()
+        }
+
         invoice_items = []
         for item in data.items:
-            product = db.query(Product).filter(Product.id == item.product_id, Product.active == True).first()
+            product = products.get(item.product_id)
             
             if not product:
                 raise HTTPException(status_code=404, detail=f"NOT_FOUND_PRODUCT_BY_ID_{item.product_id}.")
 
-            print(f"Checking product {product.name}: dry_stock={product.dry_stock}, quantity={item.quantity}")
-
             if not product.dry_stock:
                 raise HTTPException(status_code=400, detail=f"'{product.name}'_STOP_SELLING.")
 
-            if data.branch == "Terra":
-                if product.terra_stock < item.quantity:
-                    db.rollback()
-                    raise HTTPException(status_code=400, detail=f"PRODUCT_'{product.name}'_NOT_ENOUGH_IN_{data.branch}.")
-
-            elif data.branch == "Thợ Nhuộm":
-                if product.thonhuom_stock < item.quantity:
-                    db.rollback()
-                    raise HTTPException(status_code=400, detail=f"PRODUCT_'{product.name}'_NOT_ENOUGH_IN_{data.branch}.")
-
-            else:
-                db.rollback()
-                raise HTTPException(status_code=400, detail="BRANCH_NOT_FOUND")
+            if getattr(product, stock_field) < item.quantity:
+                raise HTTPException(status_code=400, detail=f"PRODUCT_'{product.name}'_NOT_ENOUGH_IN_{data.branch}.")
             
             # price = product.price_retail
             if customer.group_id == 1 or customer.group_id == 4:
@@ -124,56 +127,20 @@ def create_invoice(
         calculate_invoice_total_and_status(invoice)
         
 
-        last_id = db.query(func.max(func.cast(func.substr(Invoice.id, 3), Integer))).scalar()
-        if last_id: 
-            new_id = f"DH{last_id + 1}"
-        else:
-            new_id = "DH1"
-
-
-        invoice.id = new_id
+        invoice.id = next_id(db, "DH", Invoice)
 
         db.add(invoice)
-        db.commit()
-        db.refresh(invoice)
-        if invoice.status == "delivered" and invoice.payment_status == "paid":
-            for item in invoice_items:
-                product = db.query(Product).filter(Product.id == item.product_id).first()
-                if product:
-                    if data.branch == "Terra":
-                        if product.terra_stock < item.quantity:
-                            db.rollback()
-                            raise HTTPException(status_code=400, detail=f"PRODUCT_'{product.name}'_NOT_ENOUGH_IN_{data.branch}.")
-                        product.terra_stock -= item.quantity
-                        # product.terra_can_sell -= item.quantity
-
-                    elif data.branch == "Thợ Nhuộm":
-                        if product.thonhuom_stock < item.quantity:
-                            db.rollback()
-                            raise HTTPException(status_code=400, detail=f"PRODUCT_'{product.name}'_NOT_ENOUGH_IN_{data.branch}.")
-                        product.thonhuom_stock -= item.quantity
-                        # product.thonhuom_can_sell -= item.quantity
-                    else:
-                        db.rollback()
-                        raise HTTPException(status_code=400, detail="BRANCH_NOT_FOUND")
-
-        for item in invoice_items:
-            product = db.query(Product).filter(Product.id == item.product_id).first()
-            if product:
-                if data.branch == "Terra":
-                    if product.terra_can_sell < item.quantity:
-                        db.rollback()
-                        raise HTTPException(status_code=400, detail=f"PRODUCT_'{product.name}'_NOT_ENOUGH_IN_{data.branch}.")
-                    product.terra_can_sell -= item.quantity
-
-                elif data.branch == "Thợ Nhuộm":
-                    if product.thonhuom_can_sell < item.quantity:
-                        db.rollback()
-                        raise HTTPException(status_code=400, detail=f"PRODUCT_'{product.name}'_NOT_ENOUGH_IN_{data.branch}.")
-                    product.thonhuom_can_sell -= item.quantity
-                else:
-                    db.rollback()
-                    raise HTTPException(status_code=400, detail="BRANCH_NOT_FOUND")
+        db.flush()
+
+        # trừ tồn kho / có thể bán trong cùng transaction của đơn, lỗi ở bước này thì rollback cả đơn
+        fields = ["stock", "can_sell"] if invoice.status == "delivered" and invoice.payment_status == "paid" else ["can_sell"]
+        apply_moves(
+            db,
+            [Move(item.product_id, data.branch, field, -item.quantity) for item in invoice_items for field in fields],
+            invoice.id,
+            "invoice_create",
+            not_enough=lambda product, warehouse, field: f"PRODUCT_'{product.name}'_NOT_ENOUGH_IN_{warehouse}.",
+        )
 
         transaction_amount = 0  
         if invoice.payment_status == "partial_payment":
@@ -212,7 +179,6 @@ def create_invoice(
 
 
 #confirm -> add total
-        user = db.query(User).filter(User.id == invoice.user_id).first()  
         # if invoice.is_delivery == 0:
         #     customer.total_spending += invoice.total_value
         #     user.total_revenue += invoice.total_value
@@ -260,27 +226,7 @@ def confirm_invoice(
         invoice.status = "delivered"
         invoice.payment_status = "paid"
 
-        for item in invoice.items:
-            product = db.query(Product).filter(Product.id == item.product_id).first()
-            if product:
-                if invoice.branch == "Terra":
-                    if product.terra_stock < item.quantity:
-                        db.rollback()
-                        raise HTTPException(
-                            status_code=400,
-                            detail=f"PRODUCT_{product.name}_NOT_ENOUGH_IN_{invoice.branch}"
-                        )
-                    product.terra_stock -= item.quantity
-                elif invoice.branch == "Thợ Nhuộm":
-                    if product.thonhuom_stock < item.quantity:
-                        db.rollback()
-                        raise HTTPException(
-                            status_code=400,
-                            detail=f"PRODUCT_{product.name}_NOT_ENOUGH_IN_{invoice.branch}"
-                        )
-                    product.thonhuom_stock -= item.quantity
-                else:
-                    raise HTTPException(status_code=400, detail="BRANCH_NOT_FOUND")
+        apply_moves(db, [Move(item.product_id, invoice.branch, "stock", -item.quantity) for item in invoice.items], invoice.id, "invoice_confirm")
 
         if not invoice.is_delivery:
             customer = db.query(Customer).filter(Customer.id == invoice.customer_id).first()
@@ -317,6 +263,52 @@ def confirm_invoice(
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
+INVOICE_EXPORT_HEADER = [
+    "Mã hóa đơn", "Ngày tạo", "Chi nhánh", "Khách hàng", "Số điện thoại", "Trạng thái", "Thanh toán", "Tổng tiền",
+    "Mã sản phẩm", "Tên sản phẩm", "Số lượng", "Đơn giá", "Chiết khấu", "Loại chiết khấu",
+]
+
+@router.get("/invoices/export", dependencies=[Security(security_scheme)])
+def export_invoices(
+    format: str = Query("csv", description="csv | xlsx"),
+    start_date: Optional[date] = Query(None),
+    end_date: Optional[date] = Query(None),
+    status: Optional[str] = Query(None),
+    branch: Optional[str] = Query(None),
+    current_user: Account = role_required(["admin"])
+):
+    # mỗi dòng sản phẩm 1 dòng file, hóa đơn không có sản phẩm vẫn có 1 dòng
+    statement = select(
+        Invoice.id, Invoice.created_at, Invoice.branch, Customer.full_name, Customer.phone,
+        Invoice.status, Invoice.payment_status, Invoice.total_value,
+    ).outerjoin(Customer, Invoice.customer_id == Customer.id)
+    if start_date:
+        statement = statement.where(Invoice.created_at >= start_date)
+    if end_date:
+        statement = statement.where(Invoice.created_at < end_date + timedelta(days=1))
+    if status:
+        statement = statement.where(Invoice.status == status)
+    if branch:
+        statement = statement.where(Invoice.branch == branch)
+
+    def with_items(db, invoices):
+        items = defaultdict(list)
+        for item in db.execute(
+            select(InvoiceItem.invoice_id, InvoiceItem.product_id, Product.name, InvoiceItem.quantity,
+                   InvoiceItem.price, InvoiceItem.discount, InvoiceItem.discount_type)
+            .outerjoin(Product, InvoiceItem.product_id == Product.id)
+            .where(InvoiceItem.invoice_id.in_([invoice.id for invoice in invoices]))
+            .order_by(InvoiceItem.id)
+        ):
+            items[item.invoice_id].append(list(item[1:]))
+        return [list(invoice) + item for invoice in invoices for item in items.get(invoice.id) or [[None] * 6]]
+
+    def rows():
+        for batch in keyset_batches(statement, (Invoice.created_at, Invoice.id), with_items):
+            yield from batch
+
+    return export_response("hoa_don", format, INVOICE_EXPORT_HEADER, rows())
+
 @router.get("/invoices/{invoice_id}", response_model=InvoiceResponse, dependencies=[Security(security_scheme)])
 def get_invoice(invoice_id: str, db: Session = Depends(get_db),
                 current_user: Account = role_required(["admin", "staff"])):
@@ -381,7 +373,7 @@ def list_invoices(
     db: Session = Depends(get_db),
     current_user: Account = role_required(["admin", "staff", "collaborator", "warehouse_staff"])
 ):
-    query = db.query(Invoice).join(Customer, Invoice.customer_id == Customer.id, isouter=True).join(User, Invoice.user_id == User.id, isouter=True)
+    query = db.query(Invoice)
 
     PAY_MAPPING = {
         "unpaid": 'unpaid',
@@ -390,30 +382,26 @@ def list_invoices(
     }
 
     if search:
-        search_normalized = normalize(search)
         search_terms = [normalize(term.strip()) for term in search.split(',')]
 
-        invoices = query.all()
-        filtered_invoices = [
-            invoice for invoice in invoices
-            if any([
-                any(term in normalize(invoice.branch) for term in search_terms),
-                any(term in normalize(invoice.id) for term in search_terms),
-                any(term in normalize(invoice.note) for term in search_terms),
-                any(term in normalize(invoice.status) for term in search_terms), 
-                any(term == normalize(PAY_MAPPING.get(invoice.payment_status)) and 
-                    not (term == normalize('unpaid') and invoice.status == 'cancel') 
-                    for term in search_terms),             
-                any(term in normalize(invoice.customer.full_name) for term in search_terms) if invoice.customer else False,
-                any(term in normalize(invoice.customer.phone) for term in search_terms) if invoice.customer else False
-            ])
-        ]
-    else:
-        filtered_invoices = query.all()
+        conditions = []
+        for term in search_terms:
+            # mã, chi nhánh, ghi chú, trạng thái, tên và số điện thoại khách
+            conditions.append(Invoice.id.in_(search_ids("invoices", term)))
+            if term in PAY_MAPPING:
+                if term == normalize('unpaid'):
+                    conditions.append(and_(Invoice.payment_status == PAY_MAPPING[term], Invoice.status != 'cancel'))
+                else:
+                    conditions.append(Invoice.payment_status == PAY_MAPPING[term])
+
+        query = query.filter(or_(*conditions))
 
-    sorted_invoices = sorted(filtered_invoices, key=lambda bill: bill.created_at, reverse=True)
-    total_invoices = len(filtered_invoices)
-    invoices = sorted_invoices[skip: skip + limit]
+    total_invoices = query.count()
+    invoices = query.options(
+        selectinload(Invoice.customer),
+        selectinload(Invoice.user),
+        selectinload(Invoice.items).selectinload(InvoiceItem.product).selectinload(Product.images)
+    ).order_by(desc(Invoice.created_at)).offset(skip).limit(limit).all()
 
     return {
         "total_invoices": total_invoices,
@@ -468,6 +456,7 @@ def update_invoice(
         print(f"Invoice status : {invoice.status}")
         print(f"Received items: {data.items}") 
 
+        old_branch = invoice.branch
         if data.payment_status is not None:
             invoice.payment_status = data.payment_status
         if data.discount is not None:
@@ -492,15 +481,8 @@ def update_invoice(
             if len(data.items) == 0:
                 raise HTTPException(status_code=400, detail="INVOICE_NO_PRODUCT")
 
-            for old_item in invoice.items:
-                product = db.query(Product).filter(Product.id == old_item.product_id).first()
-                if product:
-                    if invoice.branch == "Terra":
-                        product.terra_can_sell += old_item.quantity
-                    elif invoice.branch == "Thợ Nhuộm":
-                        product.thonhuom_can_sell += old_item.quantity
-                    else:
-                        raise HTTPException(status_code=400, detail="BRANCH_NOT_FOUND")
+            # trả lại can_sell của các dòng cũ (theo chi nhánh cũ) rồi giữ hàng cho các dòng mới, kiểm tra trên số gộp
+            moves = [Move(old_item.product_id, old_branch, "can_sell", old_item.quantity) for old_item in invoice.items]
 
             new_ids = [it.id for it in data.items if it.id is not None and it.id > 0]
             old_items = db.query(InvoiceItem).filter(InvoiceItem.invoice_id == invoice.id).all()
@@ -516,28 +498,9 @@ def update_invoice(
                         detail=f"{item_update.product_id}_QUANTITY_MUST_BE_GT_0"
                     )
 
-                product = db.query(Product).filter(Product.id == item_update.product_id).first()
-                if not product:
-                    raise HTTPException(status_code=404, detail=f"PRODUCT_{item_update.product_id}_NOT_FOUND")
+                moves.append(Move(item_update.product_id, invoice.branch, "can_sell", -item_update.quantity))
 
                 if not item_update.id or item_update.id <= 0:
-                    if invoice.branch == "Terra":
-                        if product.terra_can_sell < item_update.quantity:
-                            raise HTTPException(
-                                status_code=400,
-                                detail=f"PRODUCT_{product.name}_NOT_ENOUGH_IN_{invoice.branch}"
-                            )
-                        product.terra_can_sell -= item_update.quantity
-                    elif invoice.branch == "Thợ Nhuộm":
-                        if product.thonhuom_can_sell < item_update.quantity:
-                            raise HTTPException(
-                                status_code=400,
-                                detail=f"PRODUCT_{product.name}_NOT_ENOUGH_IN_{invoice.branch}"
-                            )
-                        product.thonhuom_can_sell -= item_update.quantity
-                    else:
-                        raise HTTPException(status_code=400, detail="BRANCH_NOT_FOUND")
-
                     new_item = InvoiceItem(
                         invoice_id=invoice.id,
                         product_id=item_update.product_id,
@@ -559,30 +522,13 @@ def update_invoice(
                             detail=f"InvoiceItem_ID={item_update.id}_NOT_FOUND"
                         )
 
-                    if invoice.branch == "Terra":
-                        if product.terra_can_sell < item_update.quantity:
-                            raise HTTPException(
-                                status_code=400,
-                                detail=f"PRODUCT_{product.name}_NOT_ENOUGH_IN_{invoice.branch}"
-                            )
-                        product.terra_can_sell += existing_item.quantity
-                        product.terra_can_sell -= item_update.quantity
-                    elif invoice.branch == "Thợ Nhuộm":
-                        if product.thonhuom_can_sell < item_update.quantity:
-                            raise HTTPException(
-                                status_code=400,
-                                detail=f"PRODUCT_{product.name}_NOT_ENOUGH_IN_{invoice.branch}"
-                            )
-                        product.thonhuom_can_sell += existing_item.quantity
-                        product.thonhuom_can_sell -= item_update.quantity
-                    else:
-                        raise HTTPException(status_code=400, detail="BRANCH_NOT_FOUND")
-
                     existing_item.quantity = item_update.quantity
                     existing_item.price = item_update.price
                     existing_item.discount = item_update.discount
                     existing_item.discount_type = item_update.discount_type
 
+            apply_moves(db, moves, invoice.id, "invoice_update")
+
             if data.service_items is not None:
                 invoice.service_items.clear()
                 for sitem in data.service_items:
@@ -893,16 +839,7 @@ def cancel_invoice(
         if invoice.status not in ["ready_to_pick", "picking"]:
             raise HTTPException(status_code=400, detail="IN_SHIPPING_NO_CANCELLATION")
 
-        for item in invoice.items:
-            product = db.query(Product).filter(Product.id == item.product_id).first()
-            if product:
-                if invoice.branch == "Terra":
-                    product.terra_can_sell += item.quantity  
-                elif invoice.branch == "Thợ Nhuộm":
-                    product.thonhuom_can_sell += item.quantity
-                else:
-                    raise HTTPException(status_code=400, detail="BRANCH_NOT_FOUND")
-                
+        apply_moves(db, [Move(item.product_id, invoice.branch, "can_sell", item.quantity) for item in invoice.items], invoice.id, "invoice_cancel")
 
         invoice.status = "cancel"
         invoice.payment_status = "unpaid"
@@ -945,18 +882,14 @@ def return_invoice(
         invoice = db.query(Invoice).filter(Invoice.id == invoice_id, Invoice.active == True,Invoice.is_delivery == 0).first()
         if not invoice:
             raise HTTPException(status_code=404, detail="NOT_FOUND")
-        for item in invoice.items:
-            product = db.query(Product).filter(Product.id == item.product_id).first()
-            if product:
-                if invoice.branch == "Terra":
-                    product.terra_can_sell += item.quantity  
-                    product.terra_stock += item.quantity
-                elif invoice.branch == "Thợ Nhuộm":
-                    product.thonhuom_can_sell += item.quantity
-                    product.thonhuom_stock += item.quantity
-                else:
-                    raise HTTPException(status_code=400, detail="BRANCH_NOT_FOUND")
-                invoice.stock_restored = True
+        apply_moves(
+            db,
+            [Move(item.product_id, invoice.branch, field, item.quantity) for item in invoice.items for field in ("stock", "can_sell")],
+            invoice.id,
+            "invoice_return",
+        )
+        if invoice.items:
+            invoice.stock_restored = True
         invoice.status = "return_at_counter"
         invoice.active = False
         customer = db.query(Customer).filter(Customer.id == invoice.customer_id).first()
@@ -975,165 +908,84 @@ def return_invoice(
         db.rollback()    
     
 @router.get("/revenue", dependencies=[Security(security_scheme)])
+@cached("revenue", depends_on=("invoices",))
 def revenue_summary(
     days: int = Query(0, description="1: Hôm nay theo giờ, 7/30/365: Theo ngày/tháng/năm, 0: Toàn thời gian"),
     db: Session = Depends(get_db),
 ):
     today = datetime.now(timezone.utc)
 
+    # đọc từ bảng revenue_rollups (invoice/rollup.py) thay vì group strftime trên invoices
     if days == 1:
         start_date = today.replace(hour=0, minute=0, second=0, microsecond=0)
-        end_date = today.replace(hour=23, minute=59, second=59, microsecond=999999)
         date_range_str = f"Doanh thu theo giờ - {start_date.strftime('%Y-%m-%d')}"
-
-        total_payment = (
-            db.query(func.sum(Invoice.total_value))
-            .filter(
-                Invoice.payment_status == "paid",
-                Invoice.created_at.between(start_date, end_date)
-            )
-            .scalar() or 0)
-        wait_for_payment = (
-            db.query(func.sum(Invoice.total_value))
-            .filter(
-                Invoice.payment_status == "unpaid",
-                Invoice.status != "cancel",
-                Invoice.created_at.between(start_date, end_date)
-            )
-            .scalar() or 0)
-        waiting_percentage = (
-            (wait_for_payment / (total_payment + wait_for_payment)) * 100
-            if (total_payment + wait_for_payment) > 0 else 0)
-        revenue_query = (
-            db.query(
-                func.strftime('%H', Invoice.created_at).label("hour"),
-                func.sum(Invoice.total_value).label("total_revenue")
-            )
-            .filter(
-                Invoice.payment_status == "paid",
-                Invoice.created_at.between(start_date, end_date)
-            )
-            .group_by("hour")
-            .order_by("hour")
-            .all()
-        )
-
-        revenue_dict = {record.hour: record.total_revenue for record in revenue_query}
-        revenue_breakdown = {f"{hour:02d}:00": revenue_dict.get(f"{hour:02d}", 0) for hour in range(24)}
-        total_invoices = (
-            db.query(func.count(Invoice.id))
-            .filter(Invoice.created_at.between(start_date, end_date))
-            .scalar() or 0
-        )
-        total_customers = (
-            db.query(func.count(func.distinct(Invoice.customer_id)))
-            .filter(Invoice.created_at.between(start_date, end_date))
-            .scalar() or 0
-        )
-        branch_revenue = db.query(
-            Invoice.branch,
-            func.sum(Invoice.total_value)
-        ).filter(
-            Invoice.payment_status == "paid",
-            Invoice.created_at.between(start_date, end_date)
-        ).group_by(Invoice.branch).all()
-
-        total_revenue_for_branches = sum(value for branch, value in branch_revenue) or 1
-        branch_percentage = {
-            branch: round((value / total_revenue_for_branches) * 100, 2)
-            for branch, value in branch_revenue
-        }
-
-        return {
-            "date_range": date_range_str,
-            "total_payment": total_payment,
-            "branch_percentage": branch_percentage,
-            "revenue_breakdown": revenue_breakdown,
-            "wait_for_payment": wait_for_payment,
-            "waiting_percentage": round(waiting_percentage, 2),
-            "total_customers": total_customers,
-            "total_invoices": total_invoices
-        }
-
-    if days in [7, 30]:
+        grain = "hour"
+        in_range = lambda bucket: bucket.startswith(start_date.strftime('%Y-%m-%d '))
+        period_of = lambda bucket: f"{bucket[-2:]}:00"
+        date_labels = [f"{hour:02d}:00" for hour in range(24)]
+    elif days in [7, 30]:
         start_date = today - timedelta(days=days - 1)
         date_range_str = f"Last {days} days"
-        grouping_func = func.strftime('%Y-%m-%d', Invoice.created_at)
+        grain = "day"
+        in_range = lambda bucket: bucket >= start_date.strftime('%Y-%m-%d')
+        period_of = lambda bucket: bucket
         date_labels = [
             (start_date + timedelta(days=i)).strftime('%Y-%m-%d')
             for i in range(days)
         ]
     elif days == 365:
-        start_date = today.replace(month=1, day=1)
         date_range_str = "This year (monthly)"
-        grouping_func = func.strftime('%Y-%m', Invoice.created_at)
+        grain = "month"
+        in_range = lambda bucket: bucket >= today.strftime('%Y-01')
+        period_of = lambda bucket: bucket
         date_labels = [today.replace(month=m, day=1).strftime('%Y-%m') for m in range(1, 13)]
     else:
         date_range_str = "All time (by year)"
-        grouping_func = func.strftime('%Y', Invoice.created_at)
-        min_year = db.query(func.min(func.strftime('%Y', Invoice.created_at))).scalar()
-        max_year = db.query(func.max(func.strftime('%Y', Invoice.created_at))).scalar()
-        if min_year and max_year:
-            date_labels = [str(year) for year in range(int(min_year), int(max_year) + 1)]
-        else:
-            date_labels = []
-        start_date = None
-
-    if start_date:
-        start_date_filter = Invoice.created_at >= start_date
-    else:
-        start_date_filter = True
-
-    total_payment = db.query(func.sum(Invoice.total_value)).filter(
-        Invoice.payment_status == "paid",
-        start_date_filter
-    ).scalar() or 0
-
-    revenue_query = (
-        db.query(
-            grouping_func.label("period"),
-            func.sum(Invoice.total_value).label("total_revenue")
-        )
-        .filter(
-            Invoice.payment_status == "paid",
-            start_date_filter
-        )
-        .group_by("period")
-        .order_by("period")
-        .all()
-    )
-    revenue_dict = {record.period: record.total_revenue for record in revenue_query}
+        grain = "month"
+        in_range = lambda bucket: true()
+        period_of = lambda bucket: bucket[:4]
+        date_labels = None
+
+    rows = db.query(RevenueRollup).filter(RevenueRollup.grain == grain, in_range(RevenueRollup.bucket)).all()
+
+    total_payment = 0
+    wait_for_payment = 0
+    total_invoices = 0
+    revenue_dict = {}
+    branch_revenue = {}
+    for row in rows:
+        total_invoices += row.invoice_count
+        if row.payment_status == "paid":
+            period = period_of(row.bucket)
+            branch = row.branch or None
+            total_payment += row.revenue
+            revenue_dict[period] = revenue_dict.get(period, 0) + row.revenue
+            branch_revenue[branch] = branch_revenue.get(branch, 0) + row.revenue
+        elif row.payment_status == "unpaid" and not row.cancelled:
+            wait_for_payment += row.revenue
+
+    total_payment = total_payment or 0
+    wait_for_payment = wait_for_payment or 0
+
+    if date_labels is None:
+        years = sorted({int(row.bucket[:4]) for row in rows})
+        date_labels = [str(year) for year in range(years[0], years[-1] + 1)] if years else []
     revenue_breakdown = {label: revenue_dict.get(label, 0) for label in date_labels}
 
-    branch_revenue = db.query(
-        Invoice.branch,
-        func.sum(Invoice.total_value)
-    ).filter(
-        Invoice.payment_status == "paid",
-        start_date_filter
-    ).group_by(Invoice.branch).all()
-    total_revenue_for_branches = sum(value for branch, value in branch_revenue) or 1
-    branch_percentage = {
-        branch: round((value / total_revenue_for_branches) * 100, 2)
-        for branch, value in branch_revenue
-    }
-
-    wait_for_payment = db.query(func.sum(Invoice.total_value)).filter(
-        Invoice.payment_status == "unpaid",
-        Invoice.status != "cancel",
-        start_date_filter
-    ).scalar() or 0
-
     waiting_percentage = (
         (wait_for_payment / (total_payment + wait_for_payment)) * 100
         if (total_payment + wait_for_payment) > 0 else 0
     )
 
-    total_customers = db.query(func.count(func.distinct(Invoice.customer_id))).filter(
-        start_date_filter
-    ).scalar() or 0
-    total_invoices = db.query(func.count(Invoice.id)).filter(
-        start_date_filter
+    total_revenue_for_branches = sum(branch_revenue.values()) or 1
+    branch_percentage = {
+        branch: round((value / total_revenue_for_branches) * 100, 2)
+        for branch, value in sorted(branch_revenue.items(), key=lambda item: item[0] or "")
+    }
+
+    total_customers = db.query(func.count(func.distinct(RevenueRollupCustomer.customer_id))).filter(
+        RevenueRollupCustomer.grain == grain,
+        in_range(RevenueRollupCustomer.bucket)
     ).scalar() or 0
 
     return {
@@ -1147,7 +999,6 @@ def revenue_summary(
         "total_invoices": total_invoices
     }
 
-
 # @router.get("/top_revenue")
 # def top_revenue(
 #     date: int = Query(0, description="Số ngày cần tính top SP (0: tất cả, 7, 30, 365)"),
@@ -1223,6 +1074,7 @@ def revenue_summary(
 #     }
 
 @router.get("/top_revenue", dependencies=[Security(security_scheme)])
+@cached("top_revenue", depends_on=("invoices", "invoice_items", "products"))
 def top_revenue(
     date: int = Query(0, description="Số ngày cần tính top SP (0: tất cả, 1: theo giờ, 7, 30, 365)"),
     db: Session = Depends(get_db),
@@ -1230,75 +1082,81 @@ def top_revenue(
 ):
     today = datetime.now(timezone.utc)
 
+    # doanh thu / số đơn giao từ revenue_rollups, giá vốn + top sản phẩm từ sales_facts (invoice/rollup.py)
     if date == 1:
         start_date = today.replace(hour=0, minute=0, second=0, microsecond=0)
-        date_format = "%H:00"
-        grouping_func = func.strftime('%H:00', Invoice.created_at)
+        grain = "hour"
+        rollup_start = start_date.strftime('%Y-%m-%d 00')
+        period_of = lambda bucket: f"{bucket[-2:]}:00"
         date_labels = [f"{hour:02d}:00" for hour in range(24)]
     elif date in [7, 30]:
         start_date = today - timedelta(days=date - 1)
-        date_format = "%Y-%m-%d"
-        grouping_func = func.strftime('%Y-%m-%d', Invoice.created_at)
-        date_labels = [(start_date + timedelta(days=i)).strftime(date_format) for i in range(date)]
+        grain = "day"
+        rollup_start = start_date.strftime('%Y-%m-%d')
+        period_of = lambda bucket: bucket
+        fact_period = SalesFact.day
+        date_labels = [(start_date + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(date)]
     elif date == 365:
         start_date = today.replace(month=1, day=1)
-        date_format = "%Y-%m"
-        grouping_func = func.strftime('%Y-%m', Invoice.created_at)
-        date_labels = [today.replace(month=m, day=1).strftime(date_format) for m in range(1, 13)]
+        grain = "month"
+        rollup_start = start_date.strftime('%Y-%m')
+        period_of = lambda bucket: bucket
+        fact_period = func.substr(SalesFact.day, 1, 7)
+        date_labels = [today.replace(month=m, day=1).strftime("%Y-%m") for m in range(1, 13)]
     else:
-        date_format = "%Y"
-        grouping_func = func.strftime('%Y', Invoice.created_at)
-        min_year = db.query(func.min(func.strftime('%Y', Invoice.created_at))).scalar()
-        max_year = db.query(func.max(func.strftime('%Y', Invoice.created_at))).scalar()
-        date_labels = [str(year) for year in range(int(min_year), int(max_year) + 1)] if min_year and max_year else []
         start_date = None
-
-    from sqlalchemy.sql import true
-    start_date_filter = Invoice.created_at >= start_date if start_date is not None else true()
-
-    revenue_data = db.query(
-        grouping_func.label("period"),
-        func.sum(Invoice.total_value).label("total_revenue")
-    ).filter(start_date_filter).group_by("period").order_by("period").all()
-
-    delivery_data = db.query(
-        grouping_func.label("period"),
-        func.count(Invoice.id).label("total_deliveries")
-    ).filter(Invoice.is_delivery == True, start_date_filter).group_by("period").order_by("period").all()
-
-    revenue_subq = db.query(
-        grouping_func.label("period"),
-        func.sum(Invoice.total_value).label("total_revenue")
-    ).filter(start_date_filter).group_by("period").subquery()
-
-    cost_subq = db.query(
-        grouping_func.label("period"),
-        func.sum(InvoiceItem.quantity * Product.price_import).label("total_cost")
-    ).join(InvoiceItem, InvoiceItem.invoice_id == Invoice.id)\
-     .join(Product, Product.id == InvoiceItem.product_id)\
-     .filter(start_date_filter)\
-     .group_by("period").subquery()
-
-    profit_query = db.query(
-        revenue_subq.c.period,
-        (revenue_subq.c.total_revenue - func.coalesce(cost_subq.c.total_cost, 0)).label("total_profit")
-    ).outerjoin(cost_subq, revenue_subq.c.period == cost_subq.c.period)\
-     .order_by(revenue_subq.c.period)
-
-    profit_data = profit_query.all()
+        grain = "month"
+        rollup_start = ""
+        period_of = lambda bucket: bucket[:4]
+        fact_period = func.substr(SalesFact.day, 1, 4)
+        date_labels = None
+
+    rollups = db.query(RevenueRollup).filter(RevenueRollup.grain == grain, RevenueRollup.bucket >= rollup_start).all()
+    revenue_by_period = {}
+    delivery_by_period = {}
+    for row in rollups:
+        period = period_of(row.bucket)
+        revenue_by_period[period] = revenue_by_period.get(period, 0) + row.revenue
+        if row.is_delivery:
+            delivery_by_period[period] = delivery_by_period.get(period, 0) + row.invoice_count
+
+    if date_labels is None:
+        years = sorted({int(row.bucket[:4]) for row in rollups})
+        date_labels = [str(year) for year in range(years[0], years[-1] + 1)] if years else []
+
+    fact_start = start_date.strftime('%Y-%m-%d') if start_date is not None else ""
+    if date == 1:
+        # sales_facts theo ngày, giá vốn theo giờ của hôm nay lấy trực tiếp (chỉ quét hóa đơn trong ngày)
+        cost_data = db.query(
+            func.strftime('%H:00', Invoice.created_at).label("period"),
+            func.sum(InvoiceItem.quantity * func.coalesce(InvoiceItem.cost, 0)).label("total_cost")
+        ).join(InvoiceItem, InvoiceItem.invoice_id == Invoice.id)\
+         .filter(Invoice.created_at >= start_date)\
+         .group_by("period").all()
+    else:
+        cost_data = db.query(
+            fact_period.label("period"),
+            func.sum(SalesFact.cost).label("total_cost")
+        ).filter(SalesFact.day >= fact_start).group_by("period").all()
+    cost_by_period = {period: total_cost or 0 for period, total_cost in cost_data}
 
     top_products = (
-        db.query(Product.name.label("product"), func.sum(InvoiceItem.quantity).label("quantity"))
-        .distinct(InvoiceItem.product_id)
-        .join(InvoiceItem, InvoiceItem.product_id == Product.id)
-        .join(Invoice, InvoiceItem.invoice_id == Invoice.id)
-        .filter(start_date_filter)
+        db.query(Product.name.label("product"), func.sum(SalesFact.quantity).label("quantity"))
+        .join(SalesFact, SalesFact.product_id == Product.id)
+        .filter(SalesFact.day >= fact_start)
         .group_by(Product.name)
         .order_by(desc("quantity"))
         .limit(5)
         .all()
     )
 
+    revenue_data = sorted(revenue_by_period.items())
+    delivery_data = sorted(delivery_by_period.items())
+    profit_data = [
+        (period, total_revenue - cost_by_period.get(period, 0))
+        for period, total_revenue in revenue_data
+    ]
+
     revenue_dict = {label: 0 for label in date_labels}
     delivery_dict = {label: 0 for label in date_labels}
     profit_dict = {label: 0 for label in date_labels}
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Text, Index
 from sqlalchemy.orm import relationship
 from database.main import Base
 from sqlalchemy.sql import func
@@ -14,9 +14,16 @@ from typing import Optional
 vietnam_tz = pytz.timezone("Asia/Ho_Chi_Minh")
 class Invoice(Base):
     __tablename__ = "invoices"
+    # lọc theo trạng thái/chi nhánh/khách rồi sắp xếp theo ngày tạo
+    __table_args__ = (
+        Index("ix_invoices_payment_status_created_at", "payment_status", "created_at"),
+        Index("ix_invoices_status_created_at", "status", "created_at"),
+        Index("ix_invoices_branch_created_at", "branch", "created_at"),
+        Index("ix_invoices_customer_id_created_at", "customer_id", "created_at"),
+    )
 
     id = Column(String, primary_key=True, index=True)
-    created_at = Column(DateTime, default=lambda: datetime.now(vietnam_tz))
+    created_at = Column(DateTime, default=lambda: datetime.now(vietnam_tz), index=True)
     updated_at = Column(DateTime, default=lambda: datetime.now(vietnam_tz), onupdate=lambda: datetime.now(vietnam_tz))
     customer_id = Column(String, ForeignKey("customers.id"), nullable=True)
     user_id = Column(String, ForeignKey("users.id"), nullable=True)
@@ -39,7 +46,7 @@ class Invoice(Base):
     expected_delivery = Column(DateTime, nullable=True)
     extraCost = Column(Float, nullable=True) 
     items = relationship("InvoiceItem", back_populates="invoice", cascade="all, delete-orphan")  # 1 đơn hàng có nhiều InvoiceItem
-    service_items = relationship("InvoiceServiceItem", back_populates="invoice", cascade="all, delete-orphan", lazy="joined")
+    service_items = relationship("InvoiceServiceItem", back_populates="invoice", cascade="all, delete-orphan", lazy="selectin")
     user = relationship("User", back_populates="invoices")
     customer = relationship("Customer", back_populates="invoices")
     delivery = relationship("Delivery", uselist=False, back_populates="invoice", cascade="all, delete-orphan")
@@ -49,14 +56,15 @@ class InvoiceItem(Base):
     __tablename__ = "invoice_items"
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    invoice_id = Column(String, ForeignKey("invoices.id", ondelete="CASCADE"), nullable=False)
-    product_id = Column(String, ForeignKey("products.id", ondelete="SET NULL"), nullable=True)
+    invoice_id = Column(String, ForeignKey("invoices.id", ondelete="CASCADE"), nullable=False, index=True)
+    product_id = Column(String, ForeignKey("products.id", ondelete="SET NULL"), nullable=True, index=True)
     quantity = Column(Integer, default=1)
     price = Column(Float, default=0.0)
     discount_type = Column(String, default="%", nullable=False) 
     discount = Column(Float, default=0.0)  # chiết khấu riêng dòng 
+    cost = Column(Float, nullable=True)  # giá vốn 1 đơn vị (price_import) tại thời điểm bán
     invoice = relationship("Invoice", back_populates="items")
-    product = relationship("Product", back_populates="invoice_items", lazy="joined")
+    product = relationship("Product", back_populates="invoice_items", lazy="selectin")
     
     @validates('quantity')
     def validate_quantity(self, key, value):
@@ -68,11 +76,59 @@ class InvoiceServiceItem(Base):
     __tablename__ = "invoice_service_items"
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    invoice_id = Column(String, ForeignKey("invoices.id", ondelete="CASCADE"), nullable=False)
+    invoice_id = Column(String, ForeignKey("invoices.id", ondelete="CASCADE"), nullable=False, index=True)
     product_id = Column(String, nullable=True)
     name = Column(String, nullable=False)
     quantity = Column(Integer, default=1)
     price = Column(Float, default=0.0)
     discount = Column(Float, default=0.0)
 
-    invoice = relationship("Invoice", back_populates="service_items")
\ No newline at end of file
+    invoice = relationship("Invoice", back_populates="service_items")
+class RevenueRollup(Base):
+    # Doanh thu cộng dồn theo giờ / ngày / tháng, cập nhật cùng transaction với hóa đơn (invoice/rollup.py)
+    __tablename__ = "revenue_rollups"
+
+    grain = Column(String, primary_key=True)  # "hour" | "day" | "month"
+    bucket = Column(String, primary_key=True)  # "2025-01-31 14" | "2025-01-31" | "2025-01"
+    branch = Column(String, primary_key=True, default="")
+    payment_status = Column(String, primary_key=True)
+    cancelled = Column(Boolean, primary_key=True, default=False)
+    is_delivery = Column(Boolean, primary_key=True, default=False)
+    revenue = Column(Float, default=0.0)
+    invoice_count = Column(Integer, default=0)
+
+class RevenueRollupCustomer(Base):
+    # số hóa đơn của từng khách trong mỗi bucket, để đếm khách hàng (distinct) không cần quét invoices
+    __tablename__ = "revenue_rollup_customers"
+
+    grain = Column(String, primary_key=True)
+    bucket = Column(String, primary_key=True)
+    customer_id = Column(String, primary_key=True, default="")
+    invoice_count = Column(Integer, default=0)
+
+class SalesFact(Base):
+    # số lượng / doanh thu / giá vốn theo sản phẩm x ngày x chi nhánh (invoice/rollup.py)
+    __tablename__ = "sales_facts"
+
+    day = Column(String, primary_key=True)  # "2025-01-31"
+    branch = Column(String, primary_key=True, default="")
+    product_id = Column(String, primary_key=True, default="")
+    quantity = Column(Integer, default=0)
+    revenue = Column(Float, default=0.0)  # tổng tiền dòng sau chiết khấu dòng
+    cost = Column(Float, default=0.0)
+
+class DeliveryEvent(Base):
+    # hàng đợi callback trạng thái đơn của hãng vận chuyển (invoice/delivery_events.py), event_id unique để bỏ trùng
+    __tablename__ = "delivery_events"
+    __table_args__ = (
+        Index("ix_delivery_events_applied_at_id", "applied_at", "id"),
+        Index("ix_delivery_events_order_code_event_time", "order_code", "event_time"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    event_id = Column(String, nullable=False, unique=True)
+    order_code = Column(String, nullable=False)
+    status = Column(String, nullable=False)
+    event_time = Column(DateTime, nullable=False)  # thời điểm đổi trạng thái phía hãng, giờ Việt Nam
+    received_at = Column(DateTime, default=lambda: datetime.now(vietnam_tz))
+    applied_at = Column(DateTime, nullable=True)  # NULL = chưa áp dụng
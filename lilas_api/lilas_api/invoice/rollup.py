@@ -0,0 +1,280 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+import logging
+
+from sqlalchemy import event, select, update, insert, delete, text, bindparam
+from database.main import engine, SessionLocal
+from invoice.models import Invoice, InvoiceItem, RevenueRollup, RevenueRollupCustomer, SalesFact
+from products.models import Product
+
+logger = logging.getLogger(__name__)
+
+GRAINS = {
+    "hour": "%Y-%m-%d %H",
+    "day": "%Y-%m-%d",
+    "month": "%Y-%m",
+}
+
+# các cột của hóa đơn ảnh hưởng tới rollup
+TRACKED_COLUMNS = ["created_at", "branch", "payment_status", "status", "is_delivery", "total_value", "customer_id"]
+
+
+def _contribution(values):
+    """Đóng góp của 1 hóa đơn vào rollup: [(grain, bucket, key, customer_id)]"""
+    created_at = values["created_at"]
+    if created_at is None:
+        return []
+    if isinstance(created_at, str):
+        created_at = datetime.fromisoformat(created_at)
+
+    key = (
+        values["branch"] or "",
+        values["payment_status"],
+        values["status"] == "cancel",
+        bool(values["is_delivery"]),
+    )
+    return [
+        (grain, created_at.strftime(fmt), key, values["customer_id"] or "")
+        for grain, fmt in GRAINS.items()
+    ]
+
+
+def _add_delta(deltas, customer_deltas, values, sign):
+    revenue = (values["total_value"] or 0) * sign
+    for grain, bucket, key, customer_id in _contribution(values):
+        row = deltas[(grain, bucket) + key]
+        row[0] += revenue
+        row[1] += sign
+        customer_deltas[(grain, bucket, customer_id)] += sign
+
+
+def _apply_deltas(connection, deltas, customer_deltas):
+    table = RevenueRollup.__table__
+    for (grain, bucket, branch, payment_status, cancelled, is_delivery), (revenue, count) in deltas.items():
+        if not revenue and not count:
+            continue
+        where = (
+            (table.c.grain == grain) & (table.c.bucket == bucket) & (table.c.branch == branch)
+            & (table.c.payment_status == payment_status) & (table.c.cancelled == cancelled)
+            & (table.c.is_delivery == is_delivery)
+        )
+        result = connection.execute(
+            update(table).where(where).values(
+                revenue=table.c.revenue + revenue,
+                invoice_count=table.c.invoice_count + count,
+            )
+        )
+        if result.rowcount == 0:
+            connection.execute(insert(table).values(
+                grain=grain, bucket=bucket, branch=branch, payment_status=payment_status,
+                cancelled=cancelled, is_delivery=is_delivery, revenue=revenue, invoice_count=count,
+            ))
+        connection.execute(delete(table).where(where, table.c.invoice_count <= 0))
+
+    table = RevenueRollupCustomer.__table__
+    for (grain, bucket, customer_id), count in customer_deltas.items():
+        if not count:
+            continue
+        where = (table.c.grain == grain) & (table.c.bucket == bucket) & (table.c.customer_id == customer_id)
+        result = connection.execute(update(table).where(where).values(invoice_count=table.c.invoice_count + count))
+        if result.rowcount == 0:
+            connection.execute(insert(table).values(grain=grain, bucket=bucket, customer_id=customer_id, invoice_count=count))
+        connection.execute(delete(table).where(where, table.c.invoice_count <= 0))
+
+
+@event.listens_for(SessionLocal, "before_flush")
+def snapshot_invoices(session, flush_context, instances):
+    """Đọc giá trị cũ trong DB của các hóa đơn sắp bị sửa/xóa (trước khi flush ghi đè)."""
+    ids = [obj.id for obj in list(session.dirty) + list(session.deleted) if isinstance(obj, Invoice) and obj.id]
+    snapshot = session.info.setdefault("revenue_rollup_snapshot", {})
+    ids = [i for i in ids if i not in snapshot]
+    if ids:
+        columns = [Invoice.__table__.c[name] for name in TRACKED_COLUMNS]
+        rows = session.connection().execute(
+            select(Invoice.__table__.c.id, *columns).where(Invoice.__table__.c.id.in_(ids))
+        )
+        for row in rows.mappings():
+            snapshot[row["id"]] = dict(row)
+
+    # giá vốn được chốt lúc bán, không phụ thuộc price_import thay đổi về sau
+    for obj in session.new:
+        if isinstance(obj, InvoiceItem) and obj.cost is None and obj.product_id:
+            product = session.get(Product, obj.product_id)
+            obj.cost = product.price_import if product else None
+
+    # các ô sales_facts đang chứa dòng sắp bị sửa/xóa
+    item_ids = [obj.id for obj in list(session.dirty) + list(session.deleted) if isinstance(obj, InvoiceItem) and obj.id]
+    cells = session.info.setdefault("sales_fact_cells", set())
+    cells.update(_fact_cells(session.connection(), item_ids, ids))
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def update_revenue_rollups(session, flush_context):
+    snapshot = session.info.pop("revenue_rollup_snapshot", {})
+    deltas = defaultdict(lambda: [0.0, 0])
+    customer_deltas = defaultdict(int)
+
+    for obj in session.new:
+        if isinstance(obj, Invoice):
+            _add_delta(deltas, customer_deltas, {name: getattr(obj, name) for name in TRACKED_COLUMNS}, 1)
+
+    for obj in session.dirty:
+        if isinstance(obj, Invoice) and obj.id in snapshot:
+            old = snapshot[obj.id]
+            new = {name: getattr(obj, name) for name in TRACKED_COLUMNS}
+            if _contribution(old) != _contribution(new) or (old["total_value"] or 0) != (new["total_value"] or 0):
+                _add_delta(deltas, customer_deltas, old, -1)
+                _add_delta(deltas, customer_deltas, new, 1)
+
+    for obj in session.deleted:
+        if isinstance(obj, Invoice) and obj.id in snapshot:
+            _add_delta(deltas, customer_deltas, snapshot[obj.id], -1)
+
+    if deltas or customer_deltas:
+        _apply_deltas(session.connection(), deltas, customer_deltas)
+
+    cells = session.info.pop("sales_fact_cells", set())
+    item_ids = [
+        obj.id for obj in list(session.new) + list(session.dirty)
+        if isinstance(obj, InvoiceItem) and obj.id
+    ]
+    invoice_ids = [obj.id for obj in session.dirty if isinstance(obj, Invoice)]
+    cells.update(_fact_cells(session.connection(), item_ids, invoice_ids))
+    if cells:
+        refresh_sales_facts(session.connection(), cells)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def clear_snapshot(session):
+    session.info.pop("revenue_rollup_snapshot", None)
+    session.info.pop("sales_fact_cells", None)
+
+
+# tiền 1 dòng sau chiết khấu, giống users.utils.calculate_invoice_total_and_status
+LINE_REVENUE_SQL = """
+    max(CASE WHEN i.discount_type = '%'
+             THEN i.price * i.quantity * (1 - coalesce(i.discount, 0) / 100.0)
+             ELSE i.price * i.quantity - coalesce(i.discount, 0) END, 0)
+"""
+
+SALES_FACTS_SELECT = f"""
+    SELECT strftime('%Y-%m-%d', v.created_at) AS day, coalesce(v.branch, '') AS branch,
+           coalesce(i.product_id, '') AS product_id, sum(i.quantity) AS quantity, sum({LINE_REVENUE_SQL}) AS revenue,
+           sum(i.quantity * coalesce(i.cost, 0)) AS cost
+    FROM invoice_items i JOIN invoices v ON v.id = i.invoice_id
+    WHERE v.created_at IS NOT NULL
+"""
+
+
+def _fact_cells(connection, item_ids, invoice_ids):
+    """Các ô (day, branch, product_id) chứa các dòng hàng / hóa đơn đã cho."""
+    if not item_ids and not invoice_ids:
+        return set()
+    rows = connection.execute(text("""
+        SELECT DISTINCT strftime('%Y-%m-%d', v.created_at), coalesce(v.branch, ''), coalesce(i.product_id, '')
+        FROM invoice_items i JOIN invoices v ON v.id = i.invoice_id
+        WHERE v.created_at IS NOT NULL AND (i.id IN :item_ids OR i.invoice_id IN :invoice_ids)
+    """).bindparams(bindparam("item_ids", expanding=True), bindparam("invoice_ids", expanding=True)),
+        {"item_ids": list(item_ids) or [-1], "invoice_ids": list(invoice_ids) or [""]})
+    return {tuple(row) for row in rows}
+
+
+def refresh_sales_facts(connection, cells):
+    """Tính lại các ô sales_facts; mỗi ô chỉ quét hóa đơn của 1 ngày (index created_at)."""
+    table = SalesFact.__table__
+    for day, branch, product_id in cells:
+        connection.execute(delete(table).where(
+            table.c.day == day, table.c.branch == branch, table.c.product_id == product_id
+        ))
+        next_day = (datetime.strptime(day, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+        connection.execute(text(f"""
+            INSERT INTO sales_facts (day, branch, product_id, quantity, revenue, cost)
+            {SALES_FACTS_SELECT}
+              AND v.created_at >= :day AND v.created_at < :next_day
+              AND coalesce(v.branch, '') = :branch AND coalesce(i.product_id, '') = :product_id
+            GROUP BY 1, 2, 3
+        """), {"day": day, "next_day": next_day, "branch": branch, "product_id": product_id})
+
+
+def rebuild_revenue_rollups(connection):
+    """Tính lại toàn bộ rollup từ bảng invoices (backfill / sửa lệch)."""
+    connection.execute(delete(RevenueRollup.__table__))
+    connection.execute(delete(RevenueRollupCustomer.__table__))
+    for grain, fmt in GRAINS.items():
+        connection.execute(text("""
+            INSERT INTO revenue_rollups (grain, bucket, branch, payment_status, cancelled, is_delivery, revenue, invoice_count)
+            SELECT :grain, strftime(:fmt, created_at), coalesce(branch, ''), payment_status,
+                   status = 'cancel', coalesce(is_delivery, 0), sum(coalesce(total_value, 0)), count(*)
+            FROM invoices
+            WHERE created_at IS NOT NULL
+            GROUP BY 2, 3, 4, 5, 6
+        """), {"grain": grain, "fmt": fmt})
+        connection.execute(text("""
+            INSERT INTO revenue_rollup_customers (grain, bucket, customer_id, invoice_count)
+            SELECT :grain, strftime(:fmt, created_at), coalesce(customer_id, ''), count(*)
+            FROM invoices
+            WHERE created_at IS NOT NULL
+            GROUP BY 2, 3
+        """), {"grain": grain, "fmt": fmt})
+
+
+def rebuild_sales_facts(connection):
+    connection.execute(delete(SalesFact.__table__))
+    connection.execute(text(f"""
+        INSERT INTO sales_facts (day, branch, product_id, quantity, revenue, cost)
+        {SALES_FACTS_SELECT}
+        GROUP BY 1, 2, 3
+    """))
+
+
+def _mismatched(expected, actual):
+    return sorted(
+        month for month in set(expected) | set(actual)
+        if expected.get(month, (0, 0))[0] != actual.get(month, (0, 0))[0]
+        or abs((expected.get(month, (0, 0))[1] or 0) - (actual.get(month, (0, 0))[1] or 0)) > 0.01
+    )
+
+
+def check_revenue_rollups(bind=engine, fix=True):
+    """
+    So revenue_rollups (grain tháng) và sales_facts với số tính thẳng từ invoices theo từng tháng,
+    lệch thì log và dựng lại bảng đó. Trả về số tháng lệch.
+    """
+    with bind.begin() as connection:
+        expected = {row[0]: row[1:] for row in connection.execute(text("""
+            SELECT strftime('%Y-%m', created_at), count(*), sum(coalesce(total_value, 0))
+            FROM invoices WHERE created_at IS NOT NULL GROUP BY 1
+        """))}
+        actual = {row[0]: row[1:] for row in connection.execute(text("""
+            SELECT bucket, sum(invoice_count), sum(revenue) FROM revenue_rollups WHERE grain = 'month' GROUP BY 1
+        """))}
+        rollup_months = _mismatched(expected, actual)
+
+        expected = {row[0]: row[1:] for row in connection.execute(text(f"""
+            SELECT substr(day, 1, 7), sum(quantity), sum(revenue) FROM ({SALES_FACTS_SELECT} GROUP BY 1, 2, 3) GROUP BY 1
+        """))}
+        actual = {row[0]: row[1:] for row in connection.execute(text("""
+            SELECT substr(day, 1, 7), sum(quantity), sum(revenue) FROM sales_facts GROUP BY 1
+        """))}
+        fact_months = _mismatched(expected, actual)
+
+        if rollup_months:
+            logger.warning("revenue_rollups lệch hóa đơn ở các tháng %s", rollup_months)
+            if fix:
+                rebuild_revenue_rollups(connection)
+        if fact_months:
+            logger.warning("sales_facts lệch hóa đơn ở các tháng %s", fact_months)
+            if fix:
+                rebuild_sales_facts(connection)
+    return len(rollup_months) + len(fact_months)
+
+
+if __name__ == "__main__":
+    # python -m invoice.rollup : tính lại toàn bộ rollup doanh thu + sales_facts
+    logging.basicConfig(level=logging.INFO)
+    from database.migrations import upgrade
+    upgrade(engine)
+    with engine.begin() as connection:
+        rebuild_revenue_rollups(connection)
+        rebuild_sales_facts(connection)
+    logger.info("Đã dựng lại bảng revenue_rollups, sales_facts")
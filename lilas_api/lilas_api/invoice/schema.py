@@ -122,3 +122,11 @@ class InvoiceListResponse(BaseModel):
     invoices: List[InvoiceResponse]
 
 
+
+
+class DeliveryCallback(BaseModel):
+    # payload callback trạng thái đơn của GHN (chỉ các trường cần dùng)
+    OrderCode: str
+    Status: str
+    Time: datetime
+    Type: Optional[str] = None
@@ -1,6 +1,6 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from static_files import CachedStaticFiles
 from users.main import router as user_router
 from customers.main_cus import router as customer_router
 from suppliers.main_sup import router as supplier_router
@@ -8,16 +8,40 @@ from invoice.main_invoice import router as invoice_router
 from products.main_pro import router as product_router
 from imports_inspection.main_i_d import router as import_bill_router
 from delivery.main_de import router as delivery_router
+from invoice.delivery_events import router as delivery_event_router
 from contextlib import asynccontextmanager
-from scheduler import start_scheduler, stop_scheduler
+import os
+import anyio
+import logging
+import database.main as database
+from database.cache import check_workers
+from scheduler import start_scheduler, stop_scheduler, SCHEDULER_MODE
+from database.migrations import upgrade, pending_migrations
+from users import ghn
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup event
-    start_scheduler()
+    # số thread cho các handler `def` (mặc định của anyio là 40)
+    anyio.to_thread.current_default_thread_limiter().total_tokens = int(os.getenv("THREADPOOL_SIZE", "40"))
+    check_workers()
+    # schema được nâng cấp bằng `python -m database.migrations` trước khi chạy uvicorn,
+    # DB_AUTO_MIGRATE=1 để tự chạy lúc khởi động (dev, 1 worker)
+    if os.getenv("DB_AUTO_MIGRATE", "0") == "1":
+        upgrade()
+    elif pending_migrations():
+        raise RuntimeError("Schema chưa được nâng cấp, chạy: python -m database.migrations")
+    logging.getLogger(__name__).info("SQLite settings: %s", database.sqlite_settings())
+    database.optimize_sqlite()
+    if SCHEDULER_MODE != "off":
+        start_scheduler()
     yield
     # Shutdown event
-    stop_scheduler()
+    if SCHEDULER_MODE != "off":
+        stop_scheduler()
+    await ghn.aclose()
+    if database.async_engine is not None:
+        await database.async_engine.dispose()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -31,7 +55,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
 
 app.include_router(user_router, prefix="/users", tags=["Users"])
 app.include_router(customer_router, prefix="/customers", tags=["Customers"])
@@ -40,6 +64,7 @@ app.include_router(product_router, prefix="/products", tags=["Products"])
 app.include_router(import_bill_router, prefix="/import_inspection", tags=["Import And Inspection"])
 app.include_router(invoice_router, prefix="/invoices", tags=["Invoices"])
 app.include_router(delivery_router, prefix="/deliveries", tags=["Deliveries"])
+app.include_router(delivery_event_router, prefix="/deliveries", tags=["Deliveries"])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,212 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from fastapi import UploadFile
+from sqlalchemy.orm import Session
+from products.models import ProductImage
+
+logger = logging.getLogger(__name__)
+
+IMAGE_DIR = "static/images"
+MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5MB
+CHUNK_SIZE = 64 * 1024
+# cạnh dài tối đa (px) của các bản thu nhỏ, lưu dạng WebP: cột <variant>_url của ProductImage
+VARIANTS = {"thumbnail": 160, "list": 480, "detail": 1200}
+# số thread xử lý ảnh (ghi file, resize), tách khỏi event loop và threadpool request
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+# định dạng nhận diện qua magic bytes -> đuôi file
+SIGNATURES = [
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+]
+
+_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="images")
+
+
+class ImageError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code  # "INVALID_FORMAT" | "TOO_LARGE"
+
+
+def detect_format(header: bytes):
+    for signature, extension in SIGNATURES:
+        if header.startswith(signature):
+            return extension
+    return None
+
+
+def _make_variants(path, name):
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        logger.warning("Chưa cài Pillow, bỏ qua tạo ảnh thu nhỏ")
+        return {}
+
+    urls = {}
+    with Image.open(path) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        for variant, size in VARIANTS.items():
+            file_name = f"{name}_{variant}.webp"
+            target = os.path.join(IMAGE_DIR, file_name)
+            if not os.path.exists(target):
+                resized = image.copy()
+                resized.thumbnail((size, size))
+                resized.save(target + ".part", "WEBP", quality=80, method=4)
+                os.replace(target + ".part", target)
+            urls[f"{variant}_url"] = f"/static/images/{file_name}"
+    return urls
+
+
+def ingest_image(file):
+    """
+    Ghi ảnh từ file object vào IMAGE_DIR theo từng chunk, đặt tên theo sha256 nội dung
+    (cùng ảnh upload nhiều lần chỉ lưu 1 file) và tạo các bản thu nhỏ.
+    Trả về dict cột của ProductImage: url, thumbnail_url, list_url, detail_url.
+    """
+    file.seek(0)
+    chunk = file.read(CHUNK_SIZE)
+    extension = detect_format(chunk[:16])
+    if extension is None:
+        raise ImageError("INVALID_FORMAT")
+
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=IMAGE_DIR, suffix=".part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while chunk:
+                size += len(chunk)
+                if size > MAX_IMAGE_SIZE:
+                    raise ImageError("TOO_LARGE")
+                digest.update(chunk)
+                out.write(chunk)
+                chunk = file.read(CHUNK_SIZE)
+        name = digest.hexdigest()[:32]
+        path = os.path.join(IMAGE_DIR, f"{name}.{extension}")
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    urls = {"url": f"/static/images/{name}.{extension}"}
+    try:
+        urls.update(_make_variants(path, name))
+    except Exception as e:
+        logger.warning("Không tạo được ảnh thu nhỏ cho %s: %s", path, e)
+    return urls
+
+
+async def store_upload(upload: UploadFile):
+    # UploadFile đã được Starlette spool ra file tạm, phần đọc/ghi/resize chạy trên thread riêng
+    return await asyncio.get_running_loop().run_in_executor(_executor, ingest_image, upload.file)
+
+
+def remove_image_files(db: Session, image: ProductImage):
+    # file được đặt tên theo nội dung nên có thể dùng chung giữa nhiều sản phẩm
+    shared = db.query(ProductImage.id).filter(ProductImage.url == image.url, ProductImage.id != image.id).first()
+    if shared:
+        return
+    for url in (image.url, image.thumbnail_url, image.list_url, image.detail_url):
+        if not url:
+            continue
+        file_path = os.path.join(IMAGE_DIR, os.path.basename(url))
+        try:
+            os.remove(file_path)
+            logger.info(f"Đã xóa ảnh: {file_path}")
+        except FileNotFoundError:
+            logger.warning(f"Không tìm thấy ảnh: {file_path}")
+        except Exception as e:
+            logger.error(f"Lỗi khi xóa ảnh {file_path}: {str(e)}")
+
+
+def version_legacy_images(db: Session, static_dir="static"):
+    """
+    Đổi ảnh cũ (SP100_1742280246_1.png...) sang tên theo hash nội dung để được cache vĩnh viễn,
+    tạo ảnh thu nhỏ, cập nhật ProductImage/Product.image_url và ghi URL cũ -> mới vào static/manifest.json.
+    """
+    from products.models import Product
+
+    manifest_path = os.path.join(static_dir, "manifest.json")
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {}
+
+    renamed = {}
+    originals = []  # file cũ chỉ xóa sau khi DB và manifest đã trỏ sang file mới
+    for image in db.query(ProductImage).filter(ProductImage.thumbnail_url.is_(None)).all():
+        old_url = image.url
+        if old_url not in renamed:
+            path = os.path.join(IMAGE_DIR, os.path.basename(old_url))
+            if not os.path.isfile(path):
+                continue
+            with open(path, "rb") as f:
+                extension = detect_format(f.read(16))
+            if extension is None:
+                logger.warning("Bỏ qua %s: không phải ảnh jpg/png", path)
+                continue
+            try:
+                with open(path, "rb") as f:
+                    renamed[old_url] = ingest_image(f)
+            except ImageError as e:
+                logger.warning("Bỏ qua %s: %s", path, e.code)
+                continue
+            if os.path.basename(renamed[old_url]["url"]) != os.path.basename(old_url):
+                originals.append(path)
+                manifest[old_url.removeprefix("/static/")] = renamed[old_url]["url"].removeprefix("/static/")
+        for key, value in renamed[old_url].items():
+            setattr(image, key, value)
+
+    for product in db.query(Product).filter(Product.image_url.isnot(None)).all():
+        urls = product.image_url.split("\n")
+        if any(url in renamed for url in urls):
+            product.image_url = "\n".join(renamed[url]["url"] if url in renamed else url for url in urls)
+
+    db.commit()
+    with open(manifest_path + ".part", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=0)
+    os.replace(manifest_path + ".part", manifest_path)
+    for path in originals:
+        os.remove(path)
+    return len(renamed)
+
+
+def precompress_static(static_dir="static", extensions=(".svg", ".json", ".css", ".js", ".txt")):
+    # ảnh jpg/png/webp đã nén sẵn, chỉ gzip các file dạng text (CachedStaticFiles trả file .gz nếu client nhận gzip)
+    count = 0
+    for root, _, files in os.walk(static_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if not name.endswith(extensions) or os.path.exists(path + ".gz") and os.path.getmtime(path + ".gz") >= os.path.getmtime(path):
+                continue
+            with open(path, "rb") as src, gzip.open(path + ".gz", "wb", compresslevel=9) as out:
+                shutil.copyfileobj(src, out)
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    # python -m products.images : đổi tên ảnh cũ theo hash, tạo ảnh thu nhỏ, manifest và file .gz nén sẵn
+    import database.migrations  # noqa: F401  (nạp đủ model)
+    from database.main import SessionLocal
+    logging.basicConfig(level=logging.INFO)
+    with SessionLocal() as db:
+        logger.info("Đã chuyển %s ảnh cũ", version_legacy_images(db))
+    logger.info("Đã nén %s file tĩnh", precompress_static())
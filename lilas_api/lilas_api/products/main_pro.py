@@ -1,68 +1,55 @@
 from fastapi import APIRouter, Depends, HTTPException, Security, Query, UploadFile, File, Form
-from sqlalchemy.orm import Session
-from products.models import Product, ProductGroup, ProductImage, Base, TransactionTranfers, TransactionTranferItems
+from sqlalchemy.orm import Session, selectinload
+from products.models import Product, ProductGroup, ProductImage, TransactionTranfers, TransactionTranferItems, vietnam_tz
 from users.main import role_required 
 from users.models import User
 
 from invoice.models import InvoiceItem
 from fastapi.security import HTTPBearer
 from sqlalchemy import func, desc
-from database.main import engine  
+from database.search import search_ids, refresh_search_index
+from database.sequences import next_id
+from database.cache import cached
+from products.images import ImageError, store_upload, remove_image_files
+from database.export import keyset_batches, export_response
+from products.stock import WAREHOUSES, FIELDS, Move, apply_moves, stock_column, stock_as_of
 from users.dependencies import get_db 
-from sqlalchemy import or_, func
-from typing import Optional, List
+from sqlalchemy import or_, func, case, literal, select
+from typing import Optional, List, Union
 from sqlalchemy import Integer 
 from users.models import Account
 import json
-import os
 from products.schema import (ProductCreate, ProductResponse, ProductListResponse, ProductUpdate, TransactionTranferCreate, ProductGroupCreate, ProductGroupResponse, ProductGroupListResponse,
                             TransactionTranferResponse, TransactionTranferListResponse, TransactionTranferUpdate, edit_product)
-from datetime import datetime
+from datetime import datetime, timedelta, date, time
 
-Base.metadata.create_all(bind=engine)
 security_scheme = HTTPBearer()
 
 router = APIRouter()
 
+
+def transfer_not_enough(product, warehouse, field):
+    return f"{product.name}_{WAREHOUSES[warehouse].upper()}_STOCK_NOT_ENOUGH"
+
 @router.put("/edit_stock/{product_id}", dependencies=[Security(security_scheme)])
 def edit_stock(product_id: str, stock: edit_product, db: Session = Depends(get_db), current_user: Account = role_required(["developer"])):
     product = db.query(Product).filter(Product.id == product_id).first()
     if not product:
         raise HTTPException(status_code=404, detail="NOT_FOUND")
 
-    product.thonhuom_can_sell = stock.thonhuom_can_sell
-    product.terra_can_sell = stock.terra_can_sell
-    product.thonhuom_stock = stock.thonhuom_stock
-    product.terra_stock = stock.terra_stock
+    # sửa tay cũng ghi vào sổ tồn kho dưới dạng điều chỉnh chênh lệch
+    moves = []
+    for warehouse in WAREHOUSES:
+        for field in ("stock", "can_sell"):
+            value = getattr(stock, stock_column(warehouse, field))
+            if value is not None:
+                moves.append(Move(product.id, warehouse, field, value - (getattr(product, stock_column(warehouse, field)) or 0)))
+    apply_moves(db, moves, f"edit_stock:{current_user.username}", "manual_adjust")
     db.commit()
     db.refresh(product)
     return product
 
 
-def transfer_stock(product_id: str, from_warehouse: str, to_warehouse: str, quantity: int, db: Session):
-    product = db.query(Product).filter(Product.id == product_id).first()
-    if not product:
-        raise HTTPException(status_code=404, detail="NOT_FOUND")
-
-    if from_warehouse == "Terra" and product.terra_stock < quantity:
-        raise HTTPException(status_code=400, detail=f"{product.name}_TERRA_STOCK_NOT_ENOUGH")
-    if from_warehouse == "Thợ Nhuộm" and product.thonhuom_stock < quantity:
-        raise HTTPException(status_code=400, detail=f"{product.name}_THONHUOM_STOCK_NOT_ENOUGH")
-
-    if from_warehouse == "Terra":
-        product.terra_stock -= quantity
-    elif from_warehouse == "Thợ Nhuộm":
-        product.thonhuom_stock -= quantity
-
-    if to_warehouse == "Terra":
-        product.terra_stock += quantity
-    elif to_warehouse == "Thợ Nhuộm":
-        product.thonhuom_stock += quantity
-
-    db.commit()
-    db.refresh(product)
-    return product
-
 @router.post("/products", response_model=ProductResponse, dependencies=[Security(security_scheme)])
 async def create_product(
     # product: ProductCreate = Depends(), 
@@ -90,12 +77,7 @@ async def create_product(
         if not product_group:
             raise HTTPException(status_code=400, detail="GROUP_NAME_NOT_FOUND")
     
-    last_id = db.query(func.max(func.cast(func.substr(Product.id, 3), Integer))).scalar()
-
-    if last_id: 
-        new_id = f"SP{last_id + 1}"
-    else:
-        new_id = "SP1"
+    new_id = next_id(db, "SP", Product)
         
     # # if product.barcode is None:
     # if product_create.barcode is None:
@@ -107,12 +89,6 @@ async def create_product(
     db.commit()
     db.refresh(new_product)
 
-    allowed_extensions = ["image/jpeg", "image/png"]
-    max_size = 5 * 1024 * 1024 
-    image_dir = "static/images"
-
-    if not os.path.exists(image_dir):
-        os.makedirs(image_dir, exist_ok=True)
     try:
         existing_images_count = db.query(ProductImage).filter(ProductImage.product_id == new_product.id).count()
         if existing_images_count + len(images) > 50:
@@ -121,26 +97,19 @@ async def create_product(
         pass
     image_urls = []  
     if images: 
-        timestamp = int(datetime.now().timestamp())
-        counter = 1
-
         for img in images:
-            if img.content_type not in allowed_extensions:
+            try:
+                stored = await store_upload(img)
+            except ImageError as e:
+                if e.code == "TOO_LARGE":
+                    raise HTTPException(status_code=400, detail=f"File {img.filename} vượt quá kích thước 5MB.")
                 raise HTTPException(status_code=400, detail=f"File {img.filename} không đúng định dạng (chỉ jpg hoặc png).")
-            contents = await img.read()
-            if len(contents) > max_size:
-                raise HTTPException(status_code=400, detail=f"File {img.filename} vượt quá kích thước 5MB.")
-
-            file_name = f"{new_product.id}_{timestamp}_{counter}.png"
-            file_path = os.path.join(image_dir, file_name)
-            with open(file_path, "wb") as f:
-                f.write(contents)
-
-            url = f"/static/images/{file_name}"
-            image_urls.append(url)
-            product_image = ProductImage(product_id=new_product.id, url=url)
+            if stored["url"] in image_urls:
+                continue  # cùng 1 ảnh upload 2 lần
+
+            image_urls.append(stored["url"])
+            product_image = ProductImage(product_id=new_product.id, **stored)
             db.add(product_image)
-            counter += 1
 
     
         new_product.image_url = "\n".join(image_urls)
@@ -160,14 +129,11 @@ def get_products_name_import(
  ):
     query = db.query(Product).filter(Product.dry_stock == True)
  
-    products = query.order_by(desc(Product.created_at)).all()
- 
     if search:
-        search_normalized = normalize(search)
-        products = [product for product in products if search_normalized in normalize(product.name)]
+        query = query.filter(Product.id.in_(search_ids("products", normalize(search), ["name"])))
  
-    total_products = len(products)
-    products = products[skip: skip + limit]
+    total_products = query.count()
+    products = query.options(selectinload(Product.images)).order_by(desc(Product.created_at)).offset(skip).limit(limit).all()
  
     for product in products:
         if product.group:
@@ -193,14 +159,11 @@ def get_products_name(
     query = db.query(Product).filter(Product.dry_stock == True)
     query = query.filter(or_(Product.thonhuom_can_sell > 0, Product.terra_can_sell > 0))
  
-    products = query.order_by(desc(Product.created_at)).all()
-
     if search:
-        search_normalized = normalize(search)
-        products = [product for product in products if search_normalized in normalize(product.name)]
+        query = query.filter(Product.id.in_(search_ids("products", normalize(search), ["name"])))
 
-    total_products = len(products)
-    products = products[skip: skip + limit]
+    total_products = query.count()
+    products = query.options(selectinload(Product.images)).order_by(desc(Product.created_at)).offset(skip).limit(limit).all()
 
     for product in products:
         if product.group:
@@ -233,24 +196,16 @@ def get_products(
     }
 
     query = db.query(Product)
-    products = query.all()  
 
     if search:
         search_normalized = normalize(search)
-        products = [
-            product for product in products
-            if search_normalized in normalize(product.name)
-            # or search_normalized in normalize(product.description)
-            or search_normalized in normalize(product.brand)
-            or search_normalized in normalize(product.barcode)
-            or search_normalized in normalize(product.group_name)
-            or (search_normalized in ROLE_MAPPING and product.dry_stock == ROLE_MAPPING[search_normalized])
-        ]
-
-    sorted_products = sorted(products, key=lambda product: product.created_at, reverse=True)
-  
-    total_products = len(products)
-    products = sorted_products[skip: skip + limit]  
+        conditions = [Product.id.in_(search_ids("products", search_normalized))]
+        if search_normalized in ROLE_MAPPING:
+            conditions.append(Product.dry_stock == ROLE_MAPPING[search_normalized])
+        query = query.filter(or_(*conditions))
+
+    total_products = query.count()
+    products = query.options(selectinload(Product.images)).order_by(desc(Product.created_at)).offset(skip).limit(limit).all()
 
     for product in products:
         if product.group:
@@ -331,18 +286,10 @@ async def update_product(
 
     if removed_ids:
         images_to_remove = db.query(ProductImage).filter(ProductImage.product_id == product.id, ProductImage.id.in_(removed_ids)).all()
-        image_dir = "static/images"
 
         for img_obj in images_to_remove:
             if img_obj.url:
-                file_path = os.path.join(image_dir, os.path.basename(img_obj.url))
-                try:
-                    os.remove(file_path)  
-                    logger.info(f"Đã xóa ảnh: {file_path}")
-                except FileNotFoundError:
-                    logger.warning(f"Không tìm thấy ảnh: {file_path}")
-                except Exception as e:
-                    logger.error(f"Lỗi khi xóa ảnh {file_path}: {str(e)}")
+                remove_image_files(db, img_obj)
 
             db.delete(img_obj)
 
@@ -359,39 +306,24 @@ async def update_product(
         raise HTTPException(status_code=400, detail="PRODUCTS_EXCEED_50_IMG")
 
     if images:
-        allowed_extensions = ["image/jpeg", "image/png"]
-        max_size = 5 * 1024 * 1024  # 5MB
-        timestamp = int(datetime.now().timestamp())
-        counter = 1
-
-        image_dir = "static/images"
-        os.makedirs(image_dir, exist_ok=True)
-
         new_image_urls = set()
 
         for img in images:
-            if img.content_type not in allowed_extensions:
+            try:
+                stored = await store_upload(img)
+            except ImageError as e:
+                if e.code == "TOO_LARGE":
+                    raise HTTPException(status_code=400, detail=f"{img.filename} EXCEEDS THE 5MB FILE SIZE LIMIT.")
                 raise HTTPException(status_code=400, detail=f"INVALID FILE FORMAT FOR {img.filename}. ONLY JPG AND PNG ARE ALLOWED.")
+            new_image_url = stored["url"]
 
-            file_name = f"{product.id}_{timestamp}_{counter}.png"
-            file_path = os.path.join(image_dir, file_name)
-            new_image_url = f"/static/images/{file_name}"
-
-            if new_image_url in existing_image_urls:
+            if new_image_url in existing_image_urls or new_image_url in new_image_urls:
                 logger.info(f"Ảnh {new_image_url} đã tồn tại, bỏ qua.")
                 continue
 
-            contents = await img.read()
-            if len(contents) > max_size:
-                raise HTTPException(status_code=400, detail=f"{img.filename} EXCEEDS THE 5MB FILE SIZE LIMIT.")
-
-            with open(file_path, "wb") as f:
-                f.write(contents)
-
-            new_image = ProductImage(product_id=product.id, url=new_image_url)
+            new_image = ProductImage(product_id=product.id, **stored)
             db.add(new_image)
             new_image_urls.add(new_image_url)
-            counter += 1
 
         if new_image_urls:
             all_image_urls = existing_image_urls.union(new_image_urls)
@@ -455,25 +387,13 @@ def transfer_stock_create(
             raise HTTPException(status_code=400, detail="INVALID_TOTAL_QUANTITY")
 
         transaction_items = []
+        moves = []
         for item in data.items:
-            product = db.query(Product).filter(Product.id == item.product_id).first()
-            if not product:
-                raise HTTPException(status_code=404, detail=f"NOT_FOUND_PRODUCT: {item.product_id}")
-
             if item.quantity <= 0:
                 raise HTTPException(status_code=400, detail="INVALID_QUANTITY")
 
-            if data.from_warehouse == "Thợ Nhuộm" and data.to_warehouse == "Terra":
-                if product.thonhuom_can_sell < item.quantity:
-                    raise HTTPException(status_code=400, detail=f"{product.name}_THONHUOM_STOCK_NOT_ENOUGH")
-                product.thonhuom_can_sell -= item.quantity
-                product.out_for_delivery_thonhuom += item.quantity
-            elif data.from_warehouse == "Terra" and data.to_warehouse == "Thợ Nhuộm":
-                if product.terra_can_sell < item.quantity:
-                    raise HTTPException(status_code=400, detail=f"{product.name}_TERRA_STOCK_NOT_ENOUGH")
-                product.terra_can_sell -= item.quantity
-                product.out_for_delivery_terra += item.quantity
-
+            moves.append(Move(item.product_id, data.from_warehouse, "can_sell", -item.quantity))
+            moves.append(Move(item.product_id, data.from_warehouse, "out_for_delivery", item.quantity))
             transaction_items.append(TransactionTranferItems(
                 tranfer_id=None,  
                 product_id=item.product_id,
@@ -490,12 +410,8 @@ def transfer_stock_create(
             created_at=datetime.now(),
         )
 
-        last_id = db.query(func.max(func.cast(func.substr(TransactionTranfers.id, 3), Integer))).scalar()
-        if last_id:
-            new_id = f"PC{last_id + 1}"
-        else:
-            new_id = "PC1"
-        transaction.id = new_id
+        transaction.id = next_id(db, "PC", TransactionTranfers)
+        apply_moves(db, moves, transaction.id, "transfer_create", not_enough=transfer_not_enough)
         db.add(transaction)
 
         for item in transaction_items:
@@ -530,22 +446,13 @@ def get_transfer_stock(
     query = db.query(TransactionTranfers)
     
     if search:
-        transactions = query.all()
-        search_normalized = normalize(search)
-        filtered_transactions = [
-            transaction for transaction in transactions
-            if search_normalized in normalize(transaction.from_warehouse)
-            or search_normalized in normalize(transaction.to_warehouse)
-            or search_normalized in normalize(transaction.note)
-            or search_normalized in normalize(transaction.id)
-            or search_normalized in normalize(transaction.user_id)
-        ]
-    else:
-        filtered_transactions = query.all()
+        query = query.filter(TransactionTranfers.id.in_(search_ids("transaction_tranfers", normalize(search))))
 
-    sorted_transactions = sorted(filtered_transactions, key=lambda transaction: transaction.created_at, reverse=True)
-    total_transactions = len(filtered_transactions)
-    transactions = sorted_transactions[skip: skip + limit]
+    total_transactions = query.count()
+    transactions = query.options(
+        selectinload(TransactionTranfers.user),
+        selectinload(TransactionTranfers.items).selectinload(TransactionTranferItems.product).selectinload(Product.images)
+    ).order_by(desc(TransactionTranfers.created_at)).offset(skip).limit(limit).all()
     
     return {
          "total_transactions": total_transactions,
@@ -589,40 +496,22 @@ def update_transfer_stock(
     if not transaction_update.items or len(transaction_update.items) == 0:
         raise HTTPException(status_code=400, detail="ITEMS_REQUIRED")
 
+    # trả lại hàng của phiếu cũ rồi giữ hàng cho phiếu mới, kiểm tra trên số tồn sau khi gộp
+    moves = []
     for item in transaction.items:
-        product = db.query(Product).filter(Product.id == item.product_id).first()
-        if product:
-            if transaction.from_warehouse == "Thợ Nhuộm":
-                product.thonhuom_can_sell += item.quantity
-                product.out_for_delivery_thonhuom -= item.quantity
-            elif transaction.from_warehouse == "Terra":
-                product.terra_can_sell += item.quantity
-                product.out_for_delivery_terra -= item.quantity
+        moves.append(Move(item.product_id, transaction.from_warehouse, "can_sell", item.quantity))
+        moves.append(Move(item.product_id, transaction.from_warehouse, "out_for_delivery", -item.quantity))
 
 
     db.query(TransactionTranferItems).filter(TransactionTranferItems.tranfer_id == transaction.id).delete()
 
     total_quantity = 0
     for item in transaction_update.items:
-        product = db.query(Product).filter(Product.id == item.product_id).first()
-        if not product:
-            raise HTTPException(status_code=404, detail=f"NOT_FOUND_PRODUCT: {item.product_id}")
-
         if item.quantity <= 0:
             raise HTTPException(status_code=400, detail="INVALID_QUANTITY")
 
-        if transaction_update.from_warehouse == "Thợ Nhuộm" and product.thonhuom_can_sell < item.quantity:
-            raise HTTPException(status_code=400, detail=f"{product.name}_THONHUOM_STOCK_NOT_ENOUGH")
-        elif transaction_update.from_warehouse == "Terra" and product.terra_can_sell < item.quantity:
-            raise HTTPException(status_code=400, detail=f"{product.name}_TERRA_STOCK_NOT_ENOUGH")
-
-        if transaction_update.from_warehouse == "Thợ Nhuộm":
-            product.thonhuom_can_sell -= item.quantity
-            product.out_for_delivery_thonhuom += item.quantity
-        elif transaction_update.from_warehouse == "Terra":
-            product.terra_can_sell -= item.quantity
-            product.out_for_delivery_terra += item.quantity
-
+        moves.append(Move(item.product_id, transaction_update.from_warehouse, "can_sell", -item.quantity))
+        moves.append(Move(item.product_id, transaction_update.from_warehouse, "out_for_delivery", item.quantity))
         new_item = TransactionTranferItems(
             tranfer_id=transaction.id,
             product_id=item.product_id,
@@ -631,6 +520,7 @@ def update_transfer_stock(
         db.add(new_item)
         total_quantity += item.quantity
 
+    apply_moves(db, moves, transaction.id, "transfer_update", not_enough=transfer_not_enough)
     transaction.user_id = transaction_update.user_id
     transaction.from_warehouse = transaction_update.from_warehouse
     transaction.to_warehouse = transaction_update.to_warehouse
@@ -680,28 +570,15 @@ def complete_transfer_stock(
     if transaction.to_warehouse == transaction.from_warehouse:
         raise HTTPException(status_code=400, detail="SAME_WAREHOUSE")
 
-    # Duyệt từng sản phẩm trong giao dịch và cập nhật tồn kho
+    # Chuyển hàng đang giao từ kho nguồn sang tồn + có thể bán của kho đích
+    moves = []
     for item in transaction.items:
-        product = db.query(Product).filter(Product.id == item.product_id).first()
-        if not product:
-            raise HTTPException(status_code=404, detail=f"PRODUCT_NOT_FOUND: {item.product_id}")
-        
-        if transaction.from_warehouse == "Thợ Nhuộm":
-            if product.thonhuom_stock < item.quantity:
-                raise HTTPException(status_code=400, detail=f"{product.name}_THONHUOM_STOCK_NOT_ENOUGH")
-            product.thonhuom_stock -= item.quantity
-            product.terra_stock += item.quantity
-            product.terra_can_sell += item.quantity
-            product.out_for_delivery_thonhuom -= item.quantity
-        
-        elif transaction.from_warehouse == "Terra":
-            if product.terra_stock < item.quantity:
-                raise HTTPException(status_code=400, detail=f"{product.name}_TERRA_STOCK_NOT_ENOUGH")
-            product.terra_stock -= item.quantity
-            product.thonhuom_stock += item.quantity
-            product.thonhuom_can_sell += item.quantity
-            product.out_for_delivery_terra -= item.quantity
-    
+        moves.append(Move(item.product_id, transaction.from_warehouse, "stock", -item.quantity))
+        moves.append(Move(item.product_id, transaction.from_warehouse, "out_for_delivery", -item.quantity))
+        moves.append(Move(item.product_id, transaction.to_warehouse, "stock", item.quantity))
+        moves.append(Move(item.product_id, transaction.to_warehouse, "can_sell", item.quantity))
+    apply_moves(db, moves, transaction.id, "transfer_complete", not_enough=transfer_not_enough)
+
     # Đánh dấu giao dịch là hoàn tất
     # transaction.active = False
     transaction.updated_at = datetime.now()
@@ -730,15 +607,12 @@ def cancel_transfer_stock(
         if not transaction:
             raise HTTPException(status_code=404, detail="TRANSACTION_NOT_FOUND")
 
-        for item in transaction.items:
-            product = db.query(Product).filter(Product.id == item.product_id).first()
-            if not product:
-                raise HTTPException(status_code=404, detail=f"PRODUCT_NOT_FOUND: {item.product_id}")
-
-            if transaction.from_warehouse == "Thợ Nhuộm":
-                product.thonhuom_can_sell += item.quantity
-            elif transaction.from_warehouse == "Terra":
-                product.terra_can_sell += item.quantity
+        apply_moves(
+            db,
+            [Move(item.product_id, transaction.from_warehouse, "can_sell", item.quantity) for item in transaction.items],
+            transaction.id,
+            "transfer_cancel",
+        )
 
         transaction.status = "cancelled"
         transaction.active = False
@@ -750,35 +624,139 @@ def cancel_transfer_stock(
         db.rollback()
         raise e
 
+@router.get("/stock_as_of", dependencies=[Security(security_scheme)])
+def get_stock_as_of(
+    as_of: Union[datetime, date] = Query(..., description="Thời điểm cần xem tồn, vd 2025-03-31T18:00:00 hoặc 2025-03-31 (= cuối ngày)"),
+    product_id: Optional[str] = Query(None),
+    db: Session = Depends(get_db),
+    current_user: Account = role_required(["admin", "warehouse_staff"])
+):
+    if not isinstance(as_of, datetime):
+        as_of = datetime.combine(as_of, time.max)
+    elif as_of.tzinfo is not None:
+        as_of = as_of.astimezone(vietnam_tz).replace(tzinfo=None)  # created_at lưu giờ Việt Nam, không kèm múi giờ
+    snapshot, balances = stock_as_of(db, as_of, product_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="NO_STOCK_SNAPSHOT_BEFORE_DATE")
+
+    items = {}
+    for (pid, warehouse, field), balance in balances.items():
+        item = items.setdefault((pid, warehouse), {"product_id": pid, "warehouse": warehouse, **{name: 0 for name in FIELDS}})
+        item[field] = balance
+    return {
+        "as_of": as_of,
+        "snapshot_at": snapshot.taken_at,
+        "items": sorted(items.values(), key=lambda item: (item["product_id"], item["warehouse"])),
+    }
+
+# tên cột tồn kho trong file xuất: stock_column -> tiêu đề
+STOCK_EXPORT_COLUMNS = {
+    stock_column(warehouse, field): f"{label} {warehouse}"
+    for warehouse in WAREHOUSES
+    for field, label in {"stock": "Tồn kho", "can_sell": "Có thể bán", "pending_arrival": "Hàng đang về", "out_for_delivery": "Đang giao"}.items()
+}
+
+@router.get("/products/export", dependencies=[Security(security_scheme)])
+def export_products(
+    format: str = Query("csv", description="csv | xlsx"),
+    current_user: Account = role_required(["admin", "warehouse_staff"])
+):
+    statement = select(
+        Product.id, Product.name, Product.barcode, Product.brand, Product.group_name,
+        Product.price_retail, Product.price_wholesale, Product.price_import, Product.weight, Product.expiration_date,
+        *[getattr(Product, column) for column in STOCK_EXPORT_COLUMNS], Product.created_at,
+    ).where(Product.active == True)
+    header = [
+        "Mã sản phẩm", "Tên sản phẩm", "Mã vạch", "Thương hiệu", "Nhóm", "Giá bán lẻ", "Giá bán sỉ", "Giá vốn",
+        "Khối lượng", "Hạn sử dụng", *STOCK_EXPORT_COLUMNS.values(), "Ngày tạo",
+    ]
+
+    def rows():
+        for products in keyset_batches(statement, (Product.created_at, Product.id)):
+            yield from products
+
+    return export_response("san_pham", format, header, rows())
+
 @router.get("/total_inventory_value")
+@cached("total_inventory_value", depends_on=("products",))
 def total_inventory_value(
     warehouse: Optional[str] = Query(None, description="Tên kho: 'thonhuom_stock' hoặc 'terra_stock'"),
+    group_by: Optional[str] = Query(None, description="Chia nhỏ theo 'group' (nhóm sản phẩm), 'brand' hoặc 'expiry' (hạn sử dụng)"),
     db: Session = Depends(get_db),
 ):
-
-    products = db.query(Product).all()  
-    query = db.query(Product)
-    total_stock = 0
-    total_stock_value = 0
-    for product in products:
+    today = datetime.now().date()
+    if group_by == "group":
+        group_key = Product.group_name
+    elif group_by == "brand":
+        group_key = Product.brand
+    elif group_by == "expiry":
+        group_key = case(
+            (Product.expiration_date.is_(None), "no_expiry"),
+            (Product.expiration_date < today, "expired"),
+            (Product.expiration_date <= today + timedelta(days=30), "within_30_days"),
+            (Product.expiration_date <= today + timedelta(days=90), "within_90_days"),
+            else_="later"
+        )
+    elif group_by is None:
+        group_key = literal(None)
+    else:
+        raise HTTPException(status_code=400, detail="INVALID_GROUP_BY")
+
+    thonhuom_stock = func.coalesce(Product.thonhuom_stock, 0)
+    terra_stock = func.coalesce(Product.terra_stock, 0)
+    price_import = func.coalesce(Product.price_import, 0)
+
+    # 1 truy vấn gộp cho cả 2 kho (và từng nhóm nếu có group_by)
+    rows = db.query(
+        group_key.label("key"),
+        func.count(Product.id).label("total_products"),
+        func.sum(thonhuom_stock).label("thonhuom_stock"),
+        func.sum(terra_stock).label("terra_stock"),
+        func.sum(thonhuom_stock * price_import).label("thonhuom_value"),
+        func.sum(terra_stock * price_import).label("terra_value"),
+    ).group_by(group_key).all()
+
+    def stock_and_value(row):
         if warehouse == "thonhuom_stock":
-            stock = product.thonhuom_stock or 0
+            return row.thonhuom_stock or 0, row.thonhuom_value or 0
         elif warehouse == "terra_stock":
-            stock = product.terra_stock or 0
-        else:
-            stock = (product.thonhuom_stock or 0) + (product.terra_stock or 0) 
+            return row.terra_stock or 0, row.terra_value or 0
+        return (row.thonhuom_stock or 0) + (row.terra_stock or 0), (row.thonhuom_value or 0) + (row.terra_value or 0)
 
-        stock_value = stock * (product.price_import or 0) 
+    total_products = sum(row.total_products for row in rows)
+    total_stock = 0
+    total_stock_value = 0
+    breakdown = []
+    for row in rows:
+        stock, value = stock_and_value(row)
         total_stock += stock
-        total_stock_value += stock_value
-    total_products = query.count()
-
-    return {
+        total_stock_value += value
+        breakdown.append({
+            "key": row.key,
+            "total_products": row.total_products,
+            "total_stock": stock,
+            "total_stock_value": value
+        })
+
+    result = {
         "warehouse": warehouse if warehouse else "all",
         "total_products": total_products,
         "total_stock": total_stock,
-        "total_stock_value": total_stock_value
+        "total_stock_value": total_stock_value,
+        "per_warehouse": {
+            "thonhuom_stock": {
+                "total_stock": sum(row.thonhuom_stock or 0 for row in rows),
+                "total_stock_value": sum(row.thonhuom_value or 0 for row in rows)
+            },
+            "terra_stock": {
+                "total_stock": sum(row.terra_stock or 0 for row in rows),
+                "total_stock_value": sum(row.terra_value or 0 for row in rows)
+            }
+        }
     }
+    if group_by:
+        result["breakdown"] = sorted(breakdown, key=lambda item: item["total_stock_value"], reverse=True)
+    return result
 
 
 
@@ -818,6 +796,10 @@ def get_groups_product(
 ):
     query = db.query(ProductGroup)
 
+    if search:
+        query = query.filter(ProductGroup.name.in_(search_ids("product_groups", normalize(search))))
+
+    total_groups = query.count()
     groups = query.outerjoin(
         Product, Product.group_name == ProductGroup.name
     ).outerjoin(
@@ -827,18 +809,8 @@ def get_groups_product(
         ProductGroup.description,
         ProductGroup.created_at,
         ProductGroup.updated_at).add_columns(func.count(InvoiceItem.id).label('total_orders')
-    ).order_by(desc(ProductGroup.created_at)).all()
+    ).order_by(desc(ProductGroup.created_at)).offset(skip).limit(limit).all()
 
-    if search:
-        search_normalized = normalize(search)
-        groups = [
-            (group, total_orders) for group, total_orders in groups
-            if search_normalized in normalize(group.name)
-            or search_normalized in normalize(group.description)
-        ]
-
-    total_groups = len(groups)
-    groups = groups[skip: skip + limit] 
     result = [
         ProductGroupResponse(
             name=group.name,
@@ -889,10 +861,13 @@ def delete_group_product(group_name: str, db: Session = Depends(get_db),
         db.add(default_group)
         db.commit()
         db.refresh(default_group)
+    moved_ids = [product_id for (product_id,) in db.query(Product.id).filter(Product.group_name.ilike(group_name))]
     db.query(Product).filter(Product.group_name.ilike(group_name)).update(
         {"group_name": default_group.name},
         synchronize_session=False
     )
+    # update hàng loạt không qua ORM nên phải tự cập nhật index tìm kiếm
+    refresh_search_index(db.connection(), "products", moved_ids)
     db.delete(db_group)
     db.commit()
     return db_group
\ No newline at end of file
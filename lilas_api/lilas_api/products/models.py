@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Text, Date
+from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Text, Date, Index
 from sqlalchemy.orm import relationship
 from database.main import Base
 from sqlalchemy.sql import func
@@ -17,10 +17,16 @@ class ProductImage(Base):
     id = Column(Integer, primary_key=True, index=True)
     product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
     url = Column(String, nullable=False)
+    # bản thu nhỏ WebP (products/images.py), ảnh cũ chưa có thì để trống
+    thumbnail_url = Column(String, nullable=True)
+    list_url = Column(String, nullable=True)
+    detail_url = Column(String, nullable=True)
     product = relationship("Product", back_populates="images")       
 
 class Product(Base):
     __tablename__ = "products"
+    # phân trang keyset khi xuất file (database/export.py)
+    __table_args__ = (Index("ix_products_created_at_id", "created_at", "id"),)
 
     id = Column(String, primary_key=True, index=True)
     name = Column(String, nullable=False, unique=True)  
@@ -45,11 +51,11 @@ class Product(Base):
     pending_arrival_terra = Column(Integer, default=0)
     out_for_delivery_terra = Column(Integer, default=0)
 
-    invoice_items = relationship("InvoiceItem", back_populates="product", lazy="joined") 
-    tranfers_items = relationship("TransactionTranferItems", back_populates="product", lazy="joined")
-    group_name = Column(String, ForeignKey("product_groups.name", ondelete="SET NULL"), nullable=True)
+    invoice_items = relationship("InvoiceItem", back_populates="product", lazy="raise") 
+    tranfers_items = relationship("TransactionTranferItems", back_populates="product", lazy="raise")
+    group_name = Column(String, ForeignKey("product_groups.name", ondelete="SET NULL"), nullable=True, index=True)
     group = relationship("ProductGroup", back_populates="products")
-    barcode = Column(String, nullable=True) 
+    barcode = Column(String, nullable=True, index=True)
     weight = Column(Float, nullable=False)
     created_at = Column(DateTime, default=lambda: datetime.now(vietnam_tz))
 
@@ -108,4 +114,36 @@ class TransactionTranferItems(Base):
     quantity = Column(Integer, default=0) 
 
     tranfer = relationship("TransactionTranfers", back_populates="items")
-    product = relationship("Product", lazy="joined")
\ No newline at end of file
+    product = relationship("Product", lazy="selectin")
+
+
+class StockMovement(Base):
+    # sổ biến động tồn kho (products/stock.py), chỉ thêm dòng mới, không sửa/xóa
+    __tablename__ = "stock_movements"
+
+    id = Column(Integer, primary_key=True, index=True)
+    document_id = Column(String, nullable=False, index=True)  # DH..., PC..., PN..., phiếu kiểm, phiếu trả
+    reason = Column(String, nullable=False)  # "invoice_confirm", "transfer_complete", ...
+    product_id = Column(String, ForeignKey("products.id"), nullable=False, index=True)
+    warehouse = Column(String, nullable=False)
+    field = Column(String, nullable=False)  # stock | can_sell | pending_arrival | out_for_delivery
+    delta = Column(Integer, nullable=False)
+    balance_after = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=lambda: datetime.now(vietnam_tz), index=True)
+
+class StockSnapshot(Base):
+    # tồn kho chốt định kỳ (products/stock.py): tồn tại 1 thời điểm = snapshot gần nhất + các movement sau nó
+    __tablename__ = "stock_snapshots"
+
+    id = Column(Integer, primary_key=True, index=True)
+    taken_at = Column(DateTime, nullable=False, index=True)
+    last_movement_id = Column(Integer, nullable=False)  # đã gộp các stock_movements có id <= giá trị này
+
+class StockSnapshotItem(Base):
+    __tablename__ = "stock_snapshot_items"
+
+    snapshot_id = Column(Integer, ForeignKey("stock_snapshots.id", ondelete="CASCADE"), primary_key=True)
+    product_id = Column(String, primary_key=True)
+    warehouse = Column(String, primary_key=True)
+    field = Column(String, primary_key=True)
+    balance = Column(Integer, nullable=False)  # chỉ lưu dòng khác 0
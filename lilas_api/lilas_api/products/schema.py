@@ -105,6 +105,9 @@ class ProductGroupListResponse(BaseModel):
 class ProductImageResponse(BaseModel):
     id: int
     url: str
+    thumbnail_url: Optional[str] = None
+    list_url: Optional[str] = None
+    detail_url: Optional[str] = None
 
     class Config:
         orm_mode = True
@@ -0,0 +1,251 @@
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+import logging
+import os
+import sys
+
+from fastapi import HTTPException
+from sqlalchemy import case, func, insert, update
+from sqlalchemy.orm import Session
+from products.models import Product, StockMovement, StockSnapshot, StockSnapshotItem, vietnam_tz
+
+logger = logging.getLogger(__name__)
+
+# chi nhánh -> phần tên cột tồn kho trong bảng products
+WAREHOUSES = {"Terra": "terra", "Thợ Nhuộm": "thonhuom"}
+FIELDS = {
+    "stock": "{}_stock",
+    "can_sell": "{}_can_sell",
+    "pending_arrival": "pending_arrival_{}",
+    "out_for_delivery": "out_for_delivery_{}",
+}
+# các cột không được âm sau khi áp dụng
+CHECKED_FIELDS = {"stock", "can_sell"}
+# giữ mọi snapshot trong STOCK_SNAPSHOT_KEEP_DAYS ngày, cũ hơn thì chỉ giữ snapshot cuối mỗi tháng
+STOCK_SNAPSHOT_KEEP_DAYS = int(os.getenv("STOCK_SNAPSHOT_KEEP_DAYS", "90"))
+
+# 1 dòng thay đổi tồn: cộng delta (âm = trừ) vào cột `field` của `warehouse`
+Move = namedtuple("Move", ["product_id", "warehouse", "field", "delta"])
+
+
+def stock_column(warehouse, field):
+    if warehouse not in WAREHOUSES:
+        raise HTTPException(status_code=400, detail="BRANCH_NOT_FOUND")
+    return FIELDS[field].format(WAREHOUSES[warehouse])
+
+
+def _not_enough(product, warehouse, field):
+    return f"PRODUCT_{product.name}_NOT_ENOUGH_IN_{warehouse}"
+
+
+def apply_moves(db: Session, moves, document_id, reason, clamp=False, not_enough=_not_enough):
+    """
+    Áp dụng các Move của 1 chứng từ trong transaction hiện tại (không commit, người gọi commit 1 lần):
+    gộp delta theo sản phẩm/cột, kiểm tra với tồn hiện tại, mỗi cột 1 câu UPDATE ... CASE
+    và ghi sổ stock_movements. Cột stock/can_sell thiếu hàng thì lỗi 400 `not_enough(product, warehouse, field)`,
+    hoặc về 0 nếu clamp=True. Trả về {product_id: Product}.
+    """
+    totals = defaultdict(int)
+    for move in moves:
+        if move.delta:
+            totals[(move.product_id, move.warehouse, move.field)] += move.delta
+    if not totals:
+        return {}
+    columns = {key: stock_column(key[1], key[2]) for key in totals}
+
+    # session autoflush=False: ghi các thay đổi đang chờ (vd price_import) trước khi populate_existing đọc lại Product
+    db.flush()
+    products = {
+        product.id: product
+        for product in db.query(Product)
+        .filter(Product.id.in_({product_id for product_id, _, _ in totals}))
+        .with_for_update()
+        .populate_existing()
+        .all()
+    }
+    before = {}
+    for key, delta in totals.items():
+        product_id, warehouse, field = key
+        product = products.get(product_id)
+        if product is None:
+            raise HTTPException(status_code=404, detail=f"PRODUCT_NOT_FOUND: {product_id}")
+        before[key] = getattr(product, columns[key]) or 0
+        if field in CHECKED_FIELDS and not clamp and before[key] + delta < 0:
+            raise HTTPException(status_code=400, detail=not_enough(product, warehouse, field))
+
+    by_column = defaultdict(dict)
+    for key, delta in totals.items():
+        by_column[columns[key]][key[0]] = delta
+
+    balances = {}
+    for column, deltas in by_column.items():
+        attribute = getattr(Product, column)
+        value = attribute + case(deltas, value=Product.id, else_=0)
+        if clamp:
+            value = case((value < 0, 0), else_=value)
+        rows = db.execute(
+            update(Product)
+            .where(Product.id.in_(deltas))
+            .values({column: value})
+            .returning(Product.id, attribute)
+            .execution_options(synchronize_session=False)
+        )
+        for product_id, balance in rows:
+            balances[(product_id, column)] = balance
+
+    movements = []
+    for key, delta in totals.items():
+        product_id, warehouse, field = key
+        balance = balances[(product_id, columns[key])]
+        # request khác vừa trừ cùng sản phẩm giữa lúc đọc và lúc ghi
+        if field in CHECKED_FIELDS and delta < 0 and balance < 0:
+            raise HTTPException(status_code=400, detail=not_enough(products[product_id], warehouse, field))
+        movements.append({
+            "document_id": document_id,
+            "reason": reason,
+            "product_id": product_id,
+            "warehouse": warehouse,
+            "field": field,
+            "delta": balance - before[key] if clamp else delta,
+            "balance_after": balance,
+        })
+    db.execute(insert(StockMovement), movements)
+
+    for product in products.values():
+        db.expire(product, list(by_column))
+    return products
+
+
+def _counter_balances(db: Session, product_id=None):
+    # số tồn đang lưu trên products: {(product_id, warehouse, field): balance}, bỏ các dòng bằng 0
+    keys = [(warehouse, field) for warehouse in WAREHOUSES for field in FIELDS]
+    query = db.query(Product.id, *[getattr(Product, stock_column(warehouse, field)) for warehouse, field in keys])
+    if product_id:
+        query = query.filter(Product.id == product_id)
+    balances = {}
+    for row in query:
+        for (warehouse, field), value in zip(keys, row[1:]):
+            if value:
+                balances[(row[0], warehouse, field)] = value
+    return balances
+
+
+def _ledger_balances(db: Session, snapshot, until=None, until_id=None, product_id=None):
+    # số tồn theo sổ: snapshot + tổng delta các movement sau snapshot (đến thời điểm `until` / id `until_id`)
+    balances = defaultdict(int)
+    items = db.query(StockSnapshotItem).filter(StockSnapshotItem.snapshot_id == snapshot.id)
+    if product_id:
+        items = items.filter(StockSnapshotItem.product_id == product_id)
+    for item in items:
+        balances[(item.product_id, item.warehouse, item.field)] = item.balance
+
+    deltas = db.query(
+        StockMovement.product_id, StockMovement.warehouse, StockMovement.field, func.sum(StockMovement.delta)
+    ).filter(StockMovement.id > snapshot.last_movement_id)
+    if until is not None:
+        deltas = deltas.filter(StockMovement.created_at <= until)
+    if until_id is not None:
+        deltas = deltas.filter(StockMovement.id <= until_id)
+    if product_id:
+        deltas = deltas.filter(StockMovement.product_id == product_id)
+    for product_id_, warehouse, field, delta in deltas.group_by(StockMovement.product_id, StockMovement.warehouse, StockMovement.field):
+        balances[(product_id_, warehouse, field)] += delta
+    return {key: balance for key, balance in balances.items() if balance}
+
+
+def latest_snapshot(db: Session, before=None):
+    query = db.query(StockSnapshot)
+    if before is not None:
+        query = query.filter(StockSnapshot.taken_at <= before)
+    return query.order_by(StockSnapshot.taken_at.desc(), StockSnapshot.id.desc()).first()
+
+
+def take_snapshot(db: Session):
+    """
+    Chốt tồn kho hiện tại vào stock_snapshots. Lần đầu lấy số tồn trên products làm số dư đầu kỳ của sổ,
+    các lần sau tính từ snapshot trước + movement mới (không đọc lại products).
+    """
+    previous = latest_snapshot(db)
+    last_movement_id = db.query(func.max(StockMovement.id)).scalar() or 0
+    if previous is None:
+        balances = _counter_balances(db)
+    else:
+        balances = _ledger_balances(db, previous, until_id=last_movement_id)
+
+    snapshot = StockSnapshot(taken_at=datetime.now(vietnam_tz), last_movement_id=last_movement_id)
+    db.add(snapshot)
+    db.flush()
+    if balances:
+        db.execute(insert(StockSnapshotItem), [
+            {"snapshot_id": snapshot.id, "product_id": product_id, "warehouse": warehouse, "field": field, "balance": balance}
+            for (product_id, warehouse, field), balance in balances.items()
+        ])
+    db.commit()
+    return snapshot
+
+
+def compact_snapshots(db: Session, keep_days=STOCK_SNAPSHOT_KEEP_DAYS):
+    # movement không bao giờ bị xóa nên bỏ snapshot chỉ làm lượt quét delta dài hơn, không mất lịch sử
+    cutoff = datetime.now(vietnam_tz) - timedelta(days=keep_days)
+    snapshots = db.query(StockSnapshot.id, StockSnapshot.taken_at).order_by(StockSnapshot.taken_at, StockSnapshot.id).all()
+    if not snapshots:
+        return 0
+    keep = {snapshots[0].id}  # snapshot đầu tiên giữ số dư đầu kỳ
+    month_end = {}
+    for snapshot_id, taken_at in snapshots:
+        month_end[taken_at.strftime("%Y-%m")] = snapshot_id
+    keep.update(month_end.values())
+    removed = [snapshot_id for snapshot_id, taken_at in snapshots if taken_at < cutoff.replace(tzinfo=None) and snapshot_id not in keep]
+    if removed:
+        db.query(StockSnapshotItem).filter(StockSnapshotItem.snapshot_id.in_(removed)).delete(synchronize_session=False)
+        db.query(StockSnapshot).filter(StockSnapshot.id.in_(removed)).delete(synchronize_session=False)
+        db.commit()
+    return len(removed)
+
+
+def stock_as_of(db: Session, when, product_id=None):
+    """
+    Tồn kho tại thời điểm `when` = snapshot gần nhất trước `when` + movement sau snapshot đến `when`.
+    Trả về (snapshot, {(product_id, warehouse, field): balance}); snapshot None nếu `when` trước snapshot đầu tiên.
+    """
+    snapshot = latest_snapshot(db, before=when)
+    if snapshot is None:
+        return None, {}
+    return snapshot, _ledger_balances(db, snapshot, until=when, product_id=product_id)
+
+
+def reconcile(db: Session, fix=False):
+    """
+    So số tồn trên products với sổ (snapshot mới nhất + movement sau đó). Trả về danh sách dòng lệch.
+    fix=True: ghi movement "reconcile" để sổ khớp với số tồn hiện tại (số trên products là số đang dùng để bán).
+    """
+    snapshot = latest_snapshot(db) or take_snapshot(db)
+    ledger = _ledger_balances(db, snapshot)
+    counters = _counter_balances(db)
+    mismatches = []
+    for key in sorted(set(ledger) | set(counters)):
+        if counters.get(key, 0) != ledger.get(key, 0):
+            product_id, warehouse, field = key
+            mismatches.append({"product_id": product_id, "warehouse": warehouse, "field": field,
+                               "counter": counters.get(key, 0), "ledger": ledger.get(key, 0)})
+    if fix and mismatches:
+        db.execute(insert(StockMovement), [
+            {"document_id": "reconcile", "reason": "reconcile", "product_id": row["product_id"],
+             "warehouse": row["warehouse"], "field": row["field"],
+             "delta": row["counter"] - row["ledger"], "balance_after": row["counter"]}
+            for row in mismatches
+        ])
+        db.commit()
+    return mismatches
+
+
+if __name__ == "__main__":
+    # python -m products.stock [--fix] : đối soát số tồn trên products với sổ stock_movements
+    import database.migrations  # noqa: F401  (nạp đủ model)
+    from database.main import SessionLocal
+    logging.basicConfig(level=logging.INFO)
+    with SessionLocal() as db:
+        rows = reconcile(db, fix="--fix" in sys.argv)
+    for row in rows:
+        logger.warning("%(product_id)s %(warehouse)s %(field)s: products=%(counter)s, sổ=%(ledger)s", row)
+    logger.info("%s dòng lệch%s", len(rows), " (đã ghi điều chỉnh)" if rows and "--fix" in sys.argv else "")
@@ -2,19 +2,140 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from sqlalchemy.orm import Session
 from delivery.main_de import update_all_statuses
 from users.dependencies import get_db
+from database.main import optimize_sqlite
+from database.leases import acquire_lease, release_lease
+from products.stock import take_snapshot, compact_snapshots, reconcile
+from invoice.rollup import check_revenue_rollups
+from database.search import check_search_indexes
+from users.revocation import revocation_store
+from invoice.delivery_events import apply_delivery_events, prune_delivery_events, DELIVERY_WEBHOOK_SECRET
+from uuid import uuid4
+import logging
+import os
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+# SCHEDULER_MODE=leader: mọi worker chạy scheduler nhưng chỉ process giữ lease "scheduler" mới chạy job
+# SCHEDULER_MODE=off: worker web không chạy job, dùng process riêng `python -m scheduler`
+SCHEDULER_MODE = os.getenv("SCHEDULER_MODE", "leader")
+SCHEDULER_LEASE_SECONDS = int(os.getenv("SCHEDULER_LEASE_SECONDS", "60"))
+# trạng thái giao hàng đến qua callback (invoice/delivery_events.py), áp dụng mỗi DELIVERY_EVENT_SECONDS giây;
+# polling GHN chỉ để đối soát callback bị lỡ, chạy thưa khi đã cấu hình DELIVERY_WEBHOOK_SECRET
+DELIVERY_EVENT_SECONDS = int(os.getenv("DELIVERY_EVENT_SECONDS", "15"))
+DELIVERY_SYNC_MINUTES = int(os.getenv("DELIVERY_SYNC_MINUTES", "360" if DELIVERY_WEBHOOK_SECRET else "30"))
+# giờ chốt tồn kho hằng đêm (giờ máy chủ)
+STOCK_SNAPSHOT_HOUR = int(os.getenv("STOCK_SNAPSHOT_HOUR", "1"))
+
+scheduler = BackgroundScheduler(job_defaults={
+    "coalesce": True,  # lỡ nhiều lần (máy bận/ngủ) thì chỉ chạy bù 1 lần
+    "max_instances": 1,
+    "misfire_grace_time": 300,
+})
+
+owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+is_leader = False
+
+# số liệu các lần chạy job gần nhất trong process này: job id -> {...}
+job_stats = {}
+
+
+def renew_leadership():
+    global is_leader
+    try:
+        leader = acquire_lease("scheduler", owner, SCHEDULER_LEASE_SECONDS)
+    except Exception as e:
+        logger.warning("Không gia hạn được lease scheduler: %s", e)
+        leader = False
+    if leader != is_leader:
+        logger.info("Scheduler %s: %s", owner, "leader" if leader else "standby")
+    is_leader = leader
+
+
+def leader_job(job_id, func):
+    """Chỉ chạy trên leader; ghi lại thời gian chạy và số bản ghi xử lý (nếu func trả về số)."""
+    def run():
+        if not is_leader:
+            return
+        started = time.monotonic()
+        stats = job_stats.setdefault(job_id, {"runs": 0, "failures": 0})
+        try:
+            items = func()
+            stats["last_items"] = items if isinstance(items, int) else None
+            stats["last_error"] = None
+        except Exception as e:
+            stats["failures"] += 1
+            stats["last_error"] = str(e)
+            logger.exception("Job %s lỗi", job_id)
+        finally:
+            stats["runs"] += 1
+            stats["last_run_at"] = time.time()
+            stats["last_duration"] = round(time.monotonic() - started, 3)
+            logger.info("Job %s: %.3fs, %s bản ghi", job_id, stats["last_duration"], stats.get("last_items"))
+    return run
 
-scheduler = BackgroundScheduler()
 
 def update_all_statuses_job():
     db = next(get_db())
     try:
-        update_all_statuses(db)
+        return update_all_statuses(db)
+    finally:
+        db.close()
+
+def apply_delivery_events_job():
+    db = next(get_db())
+    try:
+        return apply_delivery_events(db)
+    finally:
+        db.close()
+
+def prune_delivery_events_job():
+    db = next(get_db())
+    try:
+        return prune_delivery_events(db)
+    finally:
+        db.close()
+
+def stock_snapshot_job():
+    db = next(get_db())
+    try:
+        take_snapshot(db)
+        compact_snapshots(db)
+        mismatches = reconcile(db)
+        if mismatches:
+            logger.warning("Tồn kho trên products lệch sổ ở %s dòng, ví dụ: %s", len(mismatches), mismatches[:5])
+        return len(mismatches)
     finally:
         db.close()
 
 def start_scheduler():
-    scheduler.add_job(update_all_statuses_job, 'interval', minutes=30)
+    renew_leadership()
+    scheduler.add_job(renew_leadership, 'interval', seconds=max(SCHEDULER_LEASE_SECONDS // 3, 1), id="renew_leadership")
+    scheduler.add_job(leader_job("apply_delivery_events", apply_delivery_events_job), 'interval', seconds=DELIVERY_EVENT_SECONDS, id="apply_delivery_events")
+    scheduler.add_job(leader_job("update_all_statuses", update_all_statuses_job), 'interval', minutes=DELIVERY_SYNC_MINUTES, id="update_all_statuses")
+    scheduler.add_job(leader_job("optimize_sqlite", optimize_sqlite), 'interval', hours=6, id="optimize_sqlite")
+    scheduler.add_job(leader_job("prune_revoked_tokens", revocation_store.prune_expired), 'interval', hours=1, id="prune_revoked_tokens")
+    scheduler.add_job(leader_job("stock_snapshot", stock_snapshot_job), 'cron', hour=STOCK_SNAPSHOT_HOUR, id="stock_snapshot")
+    scheduler.add_job(leader_job("check_revenue_rollups", check_revenue_rollups), 'cron', hour=STOCK_SNAPSHOT_HOUR, minute=30, id="check_revenue_rollups")
+    scheduler.add_job(leader_job("check_search_indexes", check_search_indexes), 'cron', hour=STOCK_SNAPSHOT_HOUR, minute=45, id="check_search_indexes")
+    scheduler.add_job(leader_job("prune_delivery_events", prune_delivery_events_job), 'cron', hour=STOCK_SNAPSHOT_HOUR, minute=50, id="prune_delivery_events")
     scheduler.start()
 
 def stop_scheduler():
     scheduler.shutdown()
+    if is_leader:
+        # nhường lease ngay để process khác không phải chờ hết hạn
+        release_lease("scheduler", owner)
+
+
+if __name__ == "__main__":
+    # python -m scheduler : chạy job nền trong 1 process riêng (đặt SCHEDULER_MODE=off cho các worker web)
+    import database.migrations  # noqa: F401  (nạp đủ model)
+    logging.basicConfig(level=logging.INFO)
+    start_scheduler()
+    try:
+        while True:
+            time.sleep(3600)
+    except (KeyboardInterrupt, SystemExit):
+        stop_scheduler()
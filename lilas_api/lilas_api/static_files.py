@@ -0,0 +1,82 @@
+import json
+import mimetypes
+import os
+import re
+
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, RedirectResponse
+from starlette.staticfiles import NotModifiedResponse
+
+# ảnh đặt tên theo sha256 nội dung (products/images.py): <32 hex>[_variant].<ext>, nội dung không bao giờ đổi
+CONTENT_ADDRESSED = re.compile(r"^(?P<hash>[0-9a-f]{32})(?P<variant>_[a-z]+)?\.[a-z0-9]+$")
+IMMUTABLE = "public, max-age=31536000, immutable"
+# file tên cố định: cho cache nhưng luôn hỏi lại server (thường nhận 304)
+REVALIDATE = "public, no-cache"
+# file nén sẵn cạnh file gốc: <file>.gz
+PRECOMPRESSED = {"gzip": ".gz"}
+MANIFEST_NAME = "manifest.json"
+
+
+class CachedStaticFiles(StaticFiles):
+    """
+    StaticFiles có Cache-Control theo loại tên file, ETag mạnh cho file theo hash, phục vụ file .gz nén sẵn
+    và chuyển hướng URL cũ sang URL có version theo static/manifest.json. Range request do FileResponse xử lý.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._manifest = {}
+        self._manifest_mtime = None
+
+    def manifest(self):
+        path = os.path.join(self.directory, MANIFEST_NAME)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return {}
+        if mtime != self._manifest_mtime:
+            with open(path, encoding="utf-8") as f:
+                self._manifest = json.load(f)
+            self._manifest_mtime = mtime
+        return self._manifest
+
+    async def get_response(self, path, scope):
+        try:
+            return await super().get_response(path, scope)
+        except HTTPException as exc:
+            if exc.status_code != 404:
+                raise
+            target = self.manifest().get(path.replace(os.sep, "/"))
+            if target is None:
+                raise
+            return RedirectResponse(url=scope["path"][:-len(path)] + target, status_code=301)
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        name = os.path.basename(full_path)
+        headers = {"vary": "accept-encoding"}
+        match = CONTENT_ADDRESSED.match(name)
+        if match:
+            headers["cache-control"] = IMMUTABLE
+            headers["etag"] = f'"{match.group("hash")}{match.group("variant") or ""}"'
+        else:
+            headers["cache-control"] = REVALIDATE
+
+        media_type = None
+        accepted = request_headers.get("accept-encoding", "")
+        for encoding, suffix in PRECOMPRESSED.items():
+            if encoding in accepted and os.path.isfile(full_path + suffix):
+                media_type = mimetypes.guess_type(full_path)[0]
+                full_path = full_path + suffix
+                stat_result = os.stat(full_path)
+                headers["content-encoding"] = encoding
+                if "etag" in headers:
+                    headers["etag"] = headers["etag"][:-1] + f'-{encoding}"'
+                break
+
+        response = FileResponse(full_path, status_code=status_code, headers=headers, media_type=media_type, stat_result=stat_result)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -1,17 +1,18 @@
 from fastapi import APIRouter, Depends, HTTPException, Security, Query
 from sqlalchemy.orm import Session
-from suppliers.models_sup import Supplier, Base, SupplierTransaction
+from suppliers.models_sup import Supplier, SupplierTransaction
 from suppliers.schema_sup import SupplierCreate, SupplierResponse,SupplierlistResponse
 from users.main import role_required 
 from users.models import User, Account
 from fastapi.security import HTTPBearer
-from sqlalchemy import func, Integer, desc, or_
-from database.main import engine  
-from users.dependencies import get_db 
+from sqlalchemy import func, Integer, desc, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.search import search_ids
+from database.sequences import next_id
+from users.dependencies import get_db, get_async_db
 from typing import Optional
 from decimal import Decimal
 
-Base.metadata.create_all(bind=engine)
 security_scheme = HTTPBearer()
 
 router = APIRouter()
@@ -48,9 +49,7 @@ def create_supplier(supplier: SupplierCreate,
         if existing_email_supplier:
             raise HTTPException(status_code=400, detail="EMAIL_ALREADY_USED")
 
-    last_id = db.query(func.max(func.cast(func.substr(Supplier.id, 4), Integer))).scalar()
-
-    new_id = f"NCC{(last_id + 1) if last_id else 1}"
+    new_id = next_id(db, "NCC", Supplier)
 
     new_supplier = Supplier(id = new_id, **supplier.dict())
     db.add(new_supplier)
@@ -65,28 +64,19 @@ def normalize(text):
 
 
 @router.get("/suppliers", response_model=SupplierlistResponse, dependencies=[Security(security_scheme)])
-def get_suppliers(skip: int = 0, 
+async def get_suppliers(skip: int = 0, 
                 limit: int = 10, 
-                db: Session = Depends(get_db),
+                db: AsyncSession = Depends(get_async_db),
                 current_user: Account = role_required(["admin", "warehouse_staff"]),
                 search: Optional[str] = Query(None, description="Tìm kiếm nhà cung cấp theo tên, số điện thoại hoặc email")
                 ):
-    query = db.query(Supplier).filter(Supplier.active == True)
-
-    suppliers = query.order_by(desc(Supplier.created_at)).all()
+    query = select(Supplier).filter(Supplier.active == True)
 
     if search:
-        search_normalized = normalize(search)
-        suppliers = [
-            supplier for supplier in suppliers
-            if search_normalized in normalize(supplier.contact_name)
-            or search_normalized in normalize(supplier.phone)
-            or search_normalized in normalize(supplier.email)
-            or search_normalized in normalize(supplier.address)
-        ]
-
-    total_suppliers = len(suppliers)
-    suppliers = suppliers[skip: skip + limit] 
+        query = query.filter(Supplier.id.in_(search_ids("suppliers", normalize(search))))
+
+    total_suppliers = await db.scalar(select(func.count()).select_from(query.subquery()))
+    suppliers = (await db.scalars(query.order_by(desc(Supplier.created_at)).offset(skip).limit(limit))).all()
 
     return {"total_suppliers": total_suppliers, "suppliers": suppliers}
 
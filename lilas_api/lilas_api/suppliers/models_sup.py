@@ -28,7 +28,7 @@ class Supplier(Base):
     # established_date = Column(DateTime, default=datetime)
     created_at = Column(DateTime, default=lambda: datetime.now(vietnam_tz))
     updated_at = Column(DateTime, default=lambda: datetime.now(vietnam_tz), onupdate=lambda: datetime.now(vietnam_tz))
-    import_bills = relationship("ImportBill", back_populates="supplier", lazy="joined")
+    import_bills = relationship("ImportBill", back_populates="supplier", lazy="raise")
     transactions = relationship("SupplierTransaction", back_populates="supplier", cascade="all, delete-orphan")
     return_bills = relationship("ReturnBill", back_populates="supplier")
 
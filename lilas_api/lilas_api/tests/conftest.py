@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+
+# cấu hình phải có trước khi import app: DB SQLite tạm, không chạy scheduler, hash mật khẩu nhanh
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="lilas_test_"), "test.db")
+os.environ["SCHEDULER_MODE"] = "off"
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.chdir(APP_DIR)  # app mount thư mục "static" theo đường dẫn tương đối
+sys.path.insert(0, APP_DIR)
+
+import pytest
+from fastapi.testclient import TestClient
+
+from database.migrations import upgrade
+
+upgrade()
+
+import mainAPI
+from database.main import SessionLocal
+from users.main import get_password_hash
+from users.models import Account
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture(scope="session")
+def client():
+    with SessionLocal() as session:
+        session.add(Account(id="TK_TEST", username="test_admin", password=get_password_hash("test123"), role=1, active=True))
+        session.commit()
+    with TestClient(mainAPI.app) as c:
+        token = c.post("/users/signin", json={"username": "test_admin", "password": "test123"}).json()["access_token"]
+        c.headers["Authorization"] = f"Bearer {token}"
+        yield c
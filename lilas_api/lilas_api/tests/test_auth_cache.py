@@ -0,0 +1,37 @@
+import pytest
+
+from database import cache
+from users.main import get_password_hash
+from users.models import Account
+
+
+def as_worker(monkeypatch, backend):
+    # mỗi worker uvicorn có cache.backend riêng khi không có Redis
+    monkeypatch.setattr(cache, "backend", backend)
+
+
+def test_deactivated_account_rejected_by_other_worker(client, db, monkeypatch):
+    db.add(Account(id="TK_AUTH", username="pos_auth", password=get_password_hash("secret"), role=2, active=True))
+    db.commit()
+    token = client.post("/users/signin", json={"username": "pos_auth", "password": "secret"}).json()["access_token"]
+    staff = {"Authorization": f"Bearer {token}"}
+    worker_a, worker_b = cache.MemoryBackend(16), cache.MemoryBackend(16)
+
+    as_worker(monkeypatch, worker_b)
+    assert client.get("/invoices/invoices?limit=1", headers=staff).status_code == 200
+
+    as_worker(monkeypatch, worker_a)
+    assert client.put("/users/delete_account/TK_AUTH").status_code == 200
+
+    as_worker(monkeypatch, worker_b)
+    assert client.get("/invoices/invoices?limit=1", headers=staff).status_code == 403
+
+
+def test_multiple_workers_require_shared_cache(monkeypatch):
+    monkeypatch.setattr(cache, "backend", cache.MemoryBackend(16))
+    monkeypatch.setattr(cache, "WEB_CONCURRENCY", 4)
+    with pytest.raises(RuntimeError):
+        cache.check_workers()
+
+    monkeypatch.setattr(cache, "WEB_CONCURRENCY", 1)
+    cache.check_workers()
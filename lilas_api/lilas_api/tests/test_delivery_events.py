@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+import invoice.delivery_events as delivery_events
+from customers.models_cus import Customer
+from delivery.models import Delivery
+from invoice.delivery_events import apply_delivery_events
+from invoice.models import DeliveryEvent, Invoice
+
+SECRET = "test-secret"
+
+
+@pytest.fixture(autouse=True)
+def secret(monkeypatch):
+    monkeypatch.setattr(delivery_events, "DELIVERY_WEBHOOK_SECRET", SECRET)
+
+
+def callback(client, order_code, status, time):
+    body = json.dumps({"OrderCode": order_code, "Status": status, "Time": time, "Type": "switch_status"}).encode()
+    return client.post("/deliveries/ghn/callback", content=body, headers={"X-Signature": delivery_events.sign(body, SECRET)})
+
+
+def add_delivery(db, invoice_id, order_code):
+    db.merge(Customer(id="KH_E1", full_name="Giao hàng", phone="0966666666"))
+    db.add(Invoice(id=invoice_id, customer_id="KH_E1", status="ready_to_pick", is_delivery=True))
+    db.add(Delivery(invoice_id=invoice_id, order_code=order_code, status="ready_to_pick"))
+    db.commit()
+
+
+def statuses(db, invoice_id):
+    db.expire_all()
+    delivery = db.query(Delivery).filter(Delivery.invoice_id == invoice_id).one()
+    return delivery.status, db.get(Invoice, invoice_id).status
+
+
+def test_rejects_bad_signature(client):
+    body = json.dumps({"OrderCode": "GHN_X", "Status": "delivered", "Time": "2025-01-01T10:00:00Z"}).encode()
+    response = client.post("/deliveries/ghn/callback", content=body, headers={"X-Signature": "0" * 64})
+    assert response.status_code == 401
+
+
+def test_duplicate_events_are_queued_once(client, db):
+    add_delivery(db, "HD_E1", "GHN_E1")
+
+    first = callback(client, "GHN_E1", "picking", "2025-01-01T03:00:00Z")
+    again = callback(client, "GHN_E1", "picking", "2025-01-01T03:00:00Z")
+    assert (first.status_code, first.json()) == (200, {"queued": True})
+    assert (again.status_code, again.json()) == (200, {"queued": False})
+    assert db.query(DeliveryEvent).filter(DeliveryEvent.order_code == "GHN_E1").count() == 1
+
+    assert apply_delivery_events(db) == 1
+    assert statuses(db, "HD_E1") == ("picking", "picking")
+    assert apply_delivery_events(db) == 0
+
+
+def test_out_of_order_events_keep_latest_status(client, db):
+    add_delivery(db, "HD_E2", "GHN_E2")
+
+    # cùng 1 lô, nhiều lô nhỏ: event đến sau nhưng xảy ra trước không được ghi đè
+    callback(client, "GHN_E2", "delivering", "2025-01-01T05:00:00Z")
+    callback(client, "GHN_E2", "picked", "2025-01-01T04:00:00Z")
+    assert apply_delivery_events(db, batch_size=1) == 2
+    assert statuses(db, "HD_E2") == ("delivering", "delivering")
+
+    callback(client, "GHN_E2", "delivered", "2025-01-01T07:00:00Z")
+    callback(client, "GHN_E2", "storing", "2025-01-01T06:00:00Z")
+    assert apply_delivery_events(db) == 2
+    assert statuses(db, "HD_E2") == ("delivered", "delivered")
+
+    callback(client, "GHN_E2", "transporting", "2025-01-01T06:30:00Z")
+    assert apply_delivery_events(db) == 1
+    assert statuses(db, "HD_E2") == ("delivered", "delivered")
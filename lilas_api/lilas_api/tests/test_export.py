@@ -0,0 +1,41 @@
+from datetime import datetime
+
+from sqlalchemy import select, update
+
+from customers.models_cus import Customer
+from database.export import keyset_batches
+from database.main import engine
+
+
+def test_keyset_batches_include_null_keys(db):
+    for n in range(5):
+        db.add(Customer(id=f"KH_X{n}", full_name=f"Xuất {n}", phone=f"091000000{n}"))
+    for n in range(5, 8):
+        db.add(Customer(id=f"KH_X{n}", full_name=f"Xuất {n}", phone=f"091000000{n}", created_at=datetime(2024, 1, n)))
+    db.flush()
+    # khách nhập từ hệ thống cũ không có ngày tạo
+    db.execute(update(Customer).where(Customer.id.in_([f"KH_X{n}" for n in range(5)])).values(created_at=None))
+    db.commit()
+    statement = select(Customer.id, Customer.created_at).where(Customer.id.like("KH_X%"))
+
+    batches = list(keyset_batches(statement, (Customer.created_at, Customer.id), batch_size=2))
+
+    assert [row.id for batch in batches for row in batch] == [f"KH_X{n}" for n in range(8)]
+    assert len(batches) == 4
+
+
+def test_keyset_batches_close_session_before_yield(db):
+    for n in range(3):
+        db.add(Customer(id=f"KH_Y{n}", full_name=f"Xuất {n}", phone=f"092000000{n}", created_at=datetime(2024, 2, n + 1)))
+    db.commit()
+    db.close()
+    statement = select(Customer.id, Customer.created_at).where(Customer.id.like("KH_Y%"))
+
+    def details(db, rows):
+        return [(row.id, db.get(Customer, row.id).phone) for row in rows]
+
+    seen = []
+    for batch in keyset_batches(statement, (Customer.created_at, Customer.id), details, batch_size=2):
+        assert engine.pool.checkedout() == 0
+        seen.extend(batch)
+    assert seen == [(f"KH_Y{n}", f"092000000{n}") for n in range(3)]
@@ -0,0 +1,63 @@
+import io
+import json
+import os
+
+import pytest
+from PIL import Image
+
+import products.images as images
+from products.models import Product, ProductImage
+
+
+@pytest.fixture
+def legacy(db, tmp_path, monkeypatch):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    monkeypatch.setattr(images, "IMAGE_DIR", str(image_dir))
+
+    def add(product_id, color, size=(300, 300)):
+        buffer = io.BytesIO()
+        Image.new("RGB", size, color).save(buffer, "PNG")
+        name = f"{product_id}_1_1.png"
+        (image_dir / name).write_bytes(buffer.getvalue())
+        url = f"/static/images/{name}"
+        db.add(Product(id=product_id, name=f"Legacy {product_id}", price_retail=1, price_import=1, price_wholesale=1, weight=1, image_url=url))
+        db.add(ProductImage(product_id=product_id, url=url))
+        db.commit()
+        return image_dir / name
+
+    return add
+
+
+def test_originals_removed_after_commit_and_manifest(db, tmp_path, legacy):
+    original = legacy("SP_L1", "red")
+
+    assert images.version_legacy_images(db, str(tmp_path)) == 1
+    assert not original.exists()
+    new_url = db.get(Product, "SP_L1").image_url
+    assert os.path.exists(os.path.join(images.IMAGE_DIR, os.path.basename(new_url)))
+    manifest = json.loads((tmp_path / "manifest.json").read_text(encoding="utf-8"))
+    assert manifest["images/SP_L1_1_1.png"] == new_url.removeprefix("/static/")
+
+
+def test_too_large_image_is_skipped(db, tmp_path, legacy, monkeypatch):
+    small = legacy("SP_L2", "green")
+    large = legacy("SP_L3", "blue", size=(2000, 2000))
+    monkeypatch.setattr(images, "MAX_IMAGE_SIZE", small.stat().st_size + 1024)
+
+    assert images.version_legacy_images(db, str(tmp_path)) == 1
+    assert not small.exists()
+    assert large.exists()
+    assert db.get(Product, "SP_L3").image_url == "/static/images/SP_L3_1_1.png"
+
+
+def test_originals_kept_when_commit_fails(db, tmp_path, legacy, monkeypatch):
+    original = legacy("SP_L4", "yellow")
+
+    def fail():
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(db, "commit", fail)
+    with pytest.raises(RuntimeError):
+        images.version_legacy_images(db, str(tmp_path))
+    assert original.exists()
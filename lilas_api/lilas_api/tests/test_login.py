@@ -0,0 +1,24 @@
+from users.main import get_password_hash
+from users.models import Account
+from users.passwords import LOGIN_RATE_LIMIT
+
+
+def signin(client, username, password):
+    return client.post("/users/signin", json={"username": username, "password": password}).status_code
+
+
+def test_successful_logins_are_not_limited(client):
+    # tài khoản dùng chung ở quầy đăng nhập lại nhiều lần trong 1 cửa sổ
+    for _ in range(LOGIN_RATE_LIMIT + 2):
+        assert signin(client, "test_admin", "test123") == 200
+
+
+def test_failed_logins_are_limited(client, db):
+    db.add(Account(id="TK_LOGIN", username="pos_login", password=get_password_hash("right"), role=1, active=True))
+    db.commit()
+
+    assert signin(client, "pos_login", "wrong") == 401
+    assert signin(client, "pos_login", "right") == 200  # đăng nhập đúng xóa bộ đếm
+    for _ in range(LOGIN_RATE_LIMIT):
+        assert signin(client, "pos_login", "wrong") == 401
+    assert signin(client, "pos_login", "right") == 429
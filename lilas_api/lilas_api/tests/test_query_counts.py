@@ -0,0 +1,83 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from customers.models_cus import Customer
+from database.main import engine, SessionLocal
+from imports_inspection.models import ImportBill, ImportBillItem
+from invoice.models import Invoice, InvoiceItem
+from products.models import Product
+from suppliers.models_sup import Supplier
+
+# số câu SQL và số object ORM nạp cho mỗi request không được tăng theo lịch sử bán/nhập
+ENDPOINTS = [
+    "/products/products?limit=5",
+    "/products/product/SP_Q1",
+    "/invoices/invoices?limit=5",
+    "/invoices/invoices/HD_Q0",
+    "/import_inspection/import_bills?limit=5",
+]
+
+
+@contextmanager
+def counting():
+    stats = {"statements": 0, "objects": 0}
+
+    def on_execute(*args):
+        stats["statements"] += 1
+
+    def on_load(session, instance):
+        stats["objects"] += 1
+
+    event.listen(engine, "before_cursor_execute", on_execute)
+    event.listen(SessionLocal, "loaded_as_persistent", on_load)
+    try:
+        yield stats
+    finally:
+        event.remove(engine, "before_cursor_execute", on_execute)
+        event.remove(SessionLocal, "loaded_as_persistent", on_load)
+
+
+def measure(client):
+    result = {}
+    for path in ENDPOINTS:
+        with counting() as stats:
+            response = client.get(path)
+        assert response.status_code == 200, (path, response.text)
+        result[path] = stats
+    return result
+
+
+def add_history(db, start, count):
+    # mỗi hóa đơn / phiếu nhập 2 dòng của cùng 2 sản phẩm
+    created_at = datetime(2021, 1, 1) + timedelta(minutes=start)
+    for n in range(start, start + count):
+        created_at += timedelta(minutes=1)
+        db.add(Invoice(id=f"HD_Q{n}", created_at=created_at, customer_id="KH_Q1", branch="Terra", total_value=300, items=[
+            InvoiceItem(product_id="SP_Q1", quantity=1, price=100),
+            InvoiceItem(product_id="SP_Q2", quantity=1, price=200),
+        ]))
+        db.add(ImportBill(id=f"PN_Q{n}", created_at=created_at, supplier_id="NCC_Q1", branch="Terra", items=[
+            ImportBillItem(product_id="SP_Q1", quantity=5, price=50),
+            ImportBillItem(product_id="SP_Q2", quantity=5, price=80),
+        ]))
+    db.commit()
+
+
+def test_queries_do_not_grow_with_history(client, db):
+    for product_id in ("SP_Q1", "SP_Q2"):
+        db.add(Product(id=product_id, name=f"Query {product_id}", price_retail=200, price_import=100, price_wholesale=150, weight=1))
+    db.add(Supplier(id="NCC_Q1", contact_name="Query supplier", email="q@x.vn"))
+    db.add(Customer(id="KH_Q1", full_name="Query customer", phone="0955555555"))
+    db.commit()
+    add_history(db, 0, 5)
+    measure(client)  # nạp cache xác thực trước khi đo
+
+    before = measure(client)
+    add_history(db, 5, 50)
+    after = measure(client)
+
+    assert after == before
+    for path, stats in after.items():
+        assert stats["statements"] <= 10, (path, stats)
@@ -0,0 +1,59 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import and_, desc, text
+
+from customers.models_cus import Customer
+from invoice.models import Invoice, InvoiceItem, RevenueRollup
+from products.models import Product
+
+SINCE = datetime(2025, 1, 1)
+
+# (truy vấn như trong các endpoint, index phải được dùng)
+PLANS = [
+    # hóa đơn theo trạng thái thanh toán / trạng thái / chi nhánh / khách, sắp theo ngày tạo
+    (lambda db: db.query(Invoice).filter(and_(Invoice.payment_status == "unpaid", Invoice.status != "cancel")).order_by(desc(Invoice.created_at)),
+     "ix_invoices_payment_status_created_at"),
+    (lambda db: db.query(Invoice).filter(Invoice.status == "delivered", Invoice.created_at >= SINCE).order_by(Invoice.created_at),
+     "ix_invoices_status_created_at"),
+    (lambda db: db.query(Invoice).filter(Invoice.branch == "Terra", Invoice.created_at >= SINCE).order_by(Invoice.created_at),
+     "ix_invoices_branch_created_at"),
+    (lambda db: db.query(Invoice).filter(Invoice.customer_id == "KH1").order_by(desc(Invoice.created_at)),
+     "ix_invoices_customer_id_created_at"),
+    (lambda db: db.query(Invoice).order_by(desc(Invoice.created_at)).limit(10),
+     "ix_invoices_created_at"),
+    (lambda db: db.query(InvoiceItem).filter(InvoiceItem.invoice_id.in_(["DH1", "DH2"])),
+     "ix_invoice_items_invoice_id"),
+    (lambda db: db.query(InvoiceItem).filter(InvoiceItem.product_id == "SP1"),
+     "ix_invoice_items_product_id"),
+    # /revenue, /top_revenue đọc rollup theo khóa chính (grain, bucket, ...)
+    (lambda db: db.query(RevenueRollup).filter(RevenueRollup.grain == "day", RevenueRollup.bucket >= "2025-01-01"),
+     "sqlite_autoindex_revenue_rollups_1"),
+    # kiểm tra trùng số điện thoại khi tạo/sửa khách, tra mã vạch
+    (lambda db: db.query(Customer).filter(Customer.phone == "0900000000"),
+     "ix_customers_phone"),
+    (lambda db: db.query(Product).filter(Product.barcode == "8930000000000"),
+     "ix_products_barcode"),
+]
+
+
+@pytest.fixture(autouse=True)
+def without_small_table_stats(db):
+    # PRAGMA optimize lúc app khởi động có thể đã ANALYZE các bảng chỉ vài dòng của DB test, planner sẽ chọn SCAN;
+    # bỏ thống kê trong transaction của test rồi rollback
+    if db.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")).first():
+        db.execute(text("DELETE FROM sqlite_stat1"))
+        db.execute(text("ANALYZE sqlite_master"))  # nạp lại thống kê cho kết nối này
+    yield
+    db.rollback()
+
+
+def query_plan(db, query):
+    sql = query.statement.compile(db.bind, compile_kwargs={"literal_binds": True})
+    return " | ".join(row[-1] for row in db.execute(text(f"EXPLAIN QUERY PLAN {sql}")))
+
+
+@pytest.mark.parametrize("build, index", PLANS, ids=[index for _, index in PLANS])
+def test_query_uses_index(db, build, index):
+    plan = query_plan(db, build(db))
+    assert f"INDEX {index}" in plan, plan
@@ -0,0 +1,43 @@
+import time
+
+from sqlalchemy import event, select, func
+
+from database.main import engine
+from users.models import RevokedToken
+from users.revocation import SqlRevocationStore
+
+
+def count_statements(run):
+    statements = []
+
+    def on_execute(*args):
+        statements.append(1)
+
+    event.listen(engine, "before_cursor_execute", on_execute)
+    try:
+        run()
+    finally:
+        event.remove(engine, "before_cursor_execute", on_execute)
+    return len(statements)
+
+
+def test_is_revoked_cached():
+    store = SqlRevocationStore(cache_ttl=60)
+    assert count_statements(lambda: store.is_revoked("jti_live")) == 1
+    assert count_statements(lambda: [store.is_revoked("jti_live") for _ in range(5)]) == 0
+
+    store.revoke("jti_out", time.time() + 3600)
+    assert count_statements(lambda: store.is_revoked("jti_out")) == 0
+    assert store.is_revoked("jti_out")
+    # worker khác chưa từng thấy jti này đọc từ DB
+    assert SqlRevocationStore(cache_ttl=60).is_revoked("jti_out")
+
+
+def test_revoke_does_not_prune_expired(db):
+    store = SqlRevocationStore()
+    store.revoke("jti_old", time.time() - 10)
+    store.revoke("jti_new", time.time() + 3600)
+    assert db.execute(select(func.count()).select_from(RevokedToken).where(RevokedToken.jti == "jti_old")).scalar() == 1
+
+    assert store.prune_expired() >= 1
+    assert db.execute(select(RevokedToken.jti).where(RevokedToken.jti.in_(["jti_old", "jti_new"]))).scalars().all() == ["jti_new"]
@@ -0,0 +1,35 @@
+from datetime import datetime
+
+from sqlalchemy import delete
+
+from invoice.models import Invoice, RevenueRollup
+from invoice.rollup import check_revenue_rollups
+
+
+def month_rollup(db, bucket):
+    rows = db.query(RevenueRollup).filter(RevenueRollup.grain == "month", RevenueRollup.bucket == bucket).all()
+    return sum(row.invoice_count for row in rows), sum(row.revenue for row in rows)
+
+
+def test_rollup_updated_outside_web_lifespan(db):
+    # session thường (như process scheduler), không qua lifespan của app
+    db.add(Invoice(id="HD_R1", created_at=datetime(2020, 1, 5, 9), branch="Terra", total_value=300))
+    db.commit()
+    assert month_rollup(db, "2020-01") == (1, 300)
+
+    invoice = db.get(Invoice, "HD_R1")
+    invoice.total_value = 500
+    db.commit()
+    assert month_rollup(db, "2020-01") == (1, 500)
+    assert check_revenue_rollups() == 0
+
+
+def test_check_revenue_rollups_rebuilds_drift(db):
+    db.add(Invoice(id="HD_R2", created_at=datetime(2020, 2, 5, 9), branch="Terra", total_value=200))
+    db.commit()
+    db.execute(delete(RevenueRollup).where(RevenueRollup.bucket.like("2020-02%")))
+    db.commit()
+
+    assert check_revenue_rollups() == 1
+    assert month_rollup(db, "2020-02") == (1, 200)
+    assert check_revenue_rollups() == 0
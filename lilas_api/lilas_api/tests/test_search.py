@@ -0,0 +1,56 @@
+from sqlalchemy import text
+
+from customers.models_cus import Customer, CustomerGroup
+from database.search import check_search_indexes, search_ids
+from invoice.models import Invoice
+
+
+def find(db, term, index="customers"):
+    return {row[0] for row in db.execute(search_ids(index, term))}
+
+
+def test_index_updated_outside_web_lifespan(db):
+    db.add(Customer(id="KH_S1", full_name="Phạm Thị Hồng", phone="0933333333"))
+    db.commit()
+    assert "KH_S1" in find(db, "hong")
+
+    db.get(Customer, "KH_S1").full_name = "Phạm Thị Lan"
+    db.commit()
+    assert "KH_S1" not in find(db, "hong")
+    assert "KH_S1" in find(db, "lan")
+
+
+def test_check_search_indexes_repairs_stale_index(db):
+    db.add(Customer(id="KH_S2", full_name="Võ Văn Tùng", phone="0944444444"))
+    db.commit()
+    db.execute(text("DELETE FROM customers_fts WHERE id = 'KH_S2'"))
+    db.commit()
+    assert "KH_S2" not in find(db, "tung")
+
+    assert check_search_indexes() == 1
+    assert "KH_S2" in find(db, "tung")
+    assert check_search_indexes() == 0
+
+
+def test_invoice_index_follows_customer(client, db):
+    db.add(Customer(id="KH_S3", full_name="Đặng Thu Trang", phone="0977777777"))
+    db.add(Invoice(id="HD_S3", customer_id="KH_S3", branch="Terra", note="giao buổi sáng"))
+    db.commit()
+    assert "HD_S3" in find(db, "thu trang", "invoices")
+    assert "HD_S3" in find(db, "buoi sang", "invoices")
+
+    db.get(Customer, "KH_S3").full_name = "Đặng Thu Hà"
+    db.commit()
+    assert "HD_S3" not in find(db, "thu trang", "invoices")
+
+    response = client.get("/invoices/invoices", params={"search": "Thu Hà"})
+    assert [invoice["id"] for invoice in response.json()["invoices"]] == ["HD_S3"]
+
+
+def test_customer_search_matches_group_name(client, db):
+    db.add(CustomerGroup(id=90, name="Đại lý miền Tây"))
+    db.add(Customer(id="KH_S4", full_name="Lý Văn Nam", phone="0988888888", group_id=90))
+    db.commit()
+
+    response = client.get("/customers/customers", params={"search": "mien tay"})
+    assert [customer["id"] for customer in response.json()["customers"]] == ["KH_S4"]
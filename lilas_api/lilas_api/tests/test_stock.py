@@ -0,0 +1,23 @@
+from products.models import Product, StockMovement
+from products.stock import Move, apply_moves
+
+
+def make_product(db, product_id, **stock):
+    db.add(Product(id=product_id, name=f"Test {product_id}", price_retail=200, price_import=100, price_wholesale=150, weight=1, **stock))
+    db.commit()
+
+
+def test_apply_moves_keeps_pending_product_edits(db):
+    make_product(db, "SP_T1", terra_stock=10, terra_can_sell=10)
+
+    product = db.get(Product, "SP_T1")
+    product.price_import = 555  # như reduce_price_import_for_product trước khi trừ kho
+    apply_moves(db, [Move("SP_T1", "Terra", "stock", -2)], "TEST1", "test", clamp=True)
+    db.commit()
+
+    db.expire_all()
+    product = db.get(Product, "SP_T1")
+    assert product.price_import == 555
+    assert product.terra_stock == 8
+    movement = db.query(StockMovement).filter(StockMovement.document_id == "TEST1").one()
+    assert (movement.delta, movement.balance_after) == (-2, 8)
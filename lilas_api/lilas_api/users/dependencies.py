@@ -1,4 +1,4 @@
-from database.main import SessionLocal
+from database.main import SessionLocal, get_async_sessionmaker
 
 def get_db():
     db = SessionLocal()
@@ -6,4 +6,7 @@ def get_db():
         yield db
     finally:
         db.close()
-        
\ No newline at end of file
+
+async def get_async_db():
+    async with get_async_sessionmaker()() as db:
+        yield db
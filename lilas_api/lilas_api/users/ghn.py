@@ -1,6 +1,15 @@
-import requests
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import random
+import time
+
+import httpx
 from fastapi import HTTPException
 from dotenv import load_dotenv, find_dotenv
+from sqlalchemy.exc import IntegrityError
+from database.main import SessionLocal, get_async_sessionmaker
+from users.models import GhnMasterData
 import os
 import logging
 
@@ -15,6 +24,13 @@ GHN_API_URL_CREATE = os.getenv("GHN_API_URL_CREATE")
 GHN_TOKEN = os.getenv("GHN_TOKEN")
 GHN_API_URL_GET_ADDRESS = os.getenv("GHN_API_URL_GET_ADDRESS")
 GHN_PICKSHIFT_URL = os.getenv("GHN_PICKSHIFT_URL")
+GHN_ORDER_DETAIL_URL = os.getenv("GHN_ORDER_DETAIL_URL")
+GHN_TIMEOUT = float(os.getenv("GHN_TIMEOUT", "10"))  # giây
+GHN_RETRIES = int(os.getenv("GHN_RETRIES", "3"))
+# số request tra cứu đơn gửi song song tới GHN khi đồng bộ trạng thái
+GHN_SYNC_CONCURRENCY = int(os.getenv("GHN_SYNC_CONCURRENCY", "8"))
+# tỉnh/quận/phường gần như không đổi: lấy lại ngầm sau GHN_MASTER_DATA_REFRESH giây, trong lúc đó vẫn trả dữ liệu cũ
+GHN_MASTER_DATA_REFRESH = int(os.getenv("GHN_MASTER_DATA_REFRESH", str(7 * 24 * 3600)))
 # Configure logging
 logger = logging.getLogger("ghn_logger")
 logging.basicConfig(level=logging.INFO)
@@ -23,75 +39,202 @@ logging.basicConfig(level=logging.INFO)
 if not GHN_API_URL_CREATE or not GHN_TOKEN:
     logger.error("GHN_API_URL hoặc GHN_TOKEN không được tải đúng cách từ tệp .env")
     raise ValueError("GHN_API_URL hoặc GHN_TOKEN không được tải đúng cách từ tệp .env")
+if not GHN_ORDER_DETAIL_URL:
+    # .../shipping-order/create -> .../shipping-order/detail
+    GHN_ORDER_DETAIL_URL = GHN_API_URL_CREATE.rsplit("/", 1)[0] + "/detail"
 
-def get_pick_shifts():
-    url = GHN_PICKSHIFT_URL
-    headers = {"Token": GHN_TOKEN}
-    response = requests.get(url, headers=headers)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# client dùng chung để giữ kết nối keep-alive tới GHN
+_limits = httpx.Limits(max_connections=20, max_keepalive_connections=10)
+client = httpx.Client(headers={"Token": GHN_TOKEN}, timeout=GHN_TIMEOUT, limits=_limits)
+async_client = httpx.AsyncClient(headers={"Token": GHN_TOKEN}, timeout=GHN_TIMEOUT, limits=_limits)
+
+_refresh_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ghn-refresh")
+_refreshing = set()
+
+
+def _backoff(attempt):
+    return min(0.5 * 2 ** attempt, 8) + random.uniform(0, 0.1)
+
+
+def _data(response, detail=None):
     if response.status_code != 200:
+        logger.error("GHN %s trả về %s", response.request.url.path, response.status_code)
+        try:
+            message = response.json().get("message")
+        except ValueError:
+            message = None
         raise HTTPException(
             status_code=response.status_code,
-            detail=response.json().get("message", "Lỗi không xác định từ GHN API")
+            detail=detail or message or "Lỗi không xác định từ GHN API"
         )
     return response.json().get("data", [])
 
+
+def _get(url, params=None, headers=None):
+    for attempt in range(GHN_RETRIES + 1):
+        try:
+            response = client.get(url, params=params, headers=headers)
+            if response.status_code not in RETRY_STATUSES or attempt == GHN_RETRIES:
+                return response
+        except httpx.TransportError as e:
+            if attempt == GHN_RETRIES:
+                logger.error("Lỗi khi kết nối tới GHN API: %s", str(e))
+                raise HTTPException(status_code=500, detail="Lỗi khi kết nối tới GHN API")
+        time.sleep(_backoff(attempt))
+
+
+async def _arequest(method, url, http=None, **kwargs):
+    for attempt in range(GHN_RETRIES + 1):
+        try:
+            response = await (http or async_client).request(method, url, **kwargs)
+            if response.status_code not in RETRY_STATUSES or attempt == GHN_RETRIES:
+                return response
+        except httpx.TransportError as e:
+            if attempt == GHN_RETRIES:
+                logger.error("Lỗi khi kết nối tới GHN API: %s", str(e))
+                raise HTTPException(status_code=500, detail="Lỗi khi kết nối tới GHN API")
+        await asyncio.sleep(_backoff(attempt))
+
+
+async def _aget(url, params=None, headers=None):
+    return await _arequest("GET", url, params=params, headers=headers)
+
+
+# dữ liệu danh mục (tỉnh/quận/phường): key -> (url, params, headers, detail lỗi)
+def _master_data_request(key):
+    kind, _, parent = key.partition(":")
+    url = f"{GHN_API_URL_GET_ADDRESS}/master-data/{kind}"
+    if kind == "district":
+        return url, {"province_id": parent}, None, None
+    if kind == "ward":
+        return url, {"district_id": parent}, {"User-Agent": "PostmanRuntime/7.43.0"}, "Không thể lấy danh sách phường/xã."
+    return url, None, None, None
+
+
+def _fetch(key):
+    url, params, headers, detail = _master_data_request(key)
+    data = _data(_get(url, params, headers), detail)
+    with SessionLocal() as db:
+        entry = db.get(GhnMasterData, key)
+        if entry is None:
+            db.add(GhnMasterData(key=key, data=json.dumps(data), fetched_at=int(time.time())))
+        else:
+            entry.data, entry.fetched_at = json.dumps(data), int(time.time())
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()  # request khác vừa lưu cùng key
+    return data
+
+
+async def _afetch(key):
+    url, params, headers, detail = _master_data_request(key)
+    data = _data(await _aget(url, params, headers), detail)
+    async with get_async_sessionmaker()() as db:
+        entry = await db.get(GhnMasterData, key)
+        if entry is None:
+            db.add(GhnMasterData(key=key, data=json.dumps(data), fetched_at=int(time.time())))
+        else:
+            entry.data, entry.fetched_at = json.dumps(data), int(time.time())
+        try:
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+    return data
+
+
+def _refresh_in_background(key):
+    if key in _refreshing:
+        return
+    _refreshing.add(key)
+
+    def run():
+        try:
+            _fetch(key)
+        except Exception as e:
+            logger.warning("Không làm mới được %s từ GHN: %s", key, e)
+        finally:
+            _refreshing.discard(key)
+    _refresh_executor.submit(run)
+
+
+def get_master_data(key):
+    with SessionLocal() as db:
+        entry = db.get(GhnMasterData, key)
+    if entry is None:
+        return _fetch(key)
+    if time.time() - entry.fetched_at > GHN_MASTER_DATA_REFRESH:
+        _refresh_in_background(key)
+    return json.loads(entry.data)
+
+
+async def aget_master_data(key):
+    async with get_async_sessionmaker()() as db:
+        entry = await db.get(GhnMasterData, key)
+    if entry is None:
+        return await _afetch(key)
+    if time.time() - entry.fetched_at > GHN_MASTER_DATA_REFRESH:
+        _refresh_in_background(key)
+    return json.loads(entry.data)
+
+
+def get_pick_shifts():
+    return _data(_get(GHN_PICKSHIFT_URL))
+
 def get_provinces():
-    logger.info("Bắt đầu gọi API lấy danh sách tỉnh/thành phố từ GHN.")
-
-    url = f"{GHN_API_URL_GET_ADDRESS}/master-data/province"
-    headers = {"Token": GHN_TOKEN}
-    
-    logger.info("GHN_TOKEN: %s", GHN_TOKEN)
-    logger.info("Headers được gửi: %s", headers)
-    logger.info("URL được gọi: %s", url)
-
-    try:
-        response = requests.get(url, headers=headers)
-        logger.info("Response nhận được: %s", response.text)
-
-        if response.status_code != 200:
-            logger.error("Không thể lấy danh sách tỉnh/thành phố: %s", response.json())
-            raise HTTPException(
-                status_code=response.status_code,
-                detail=response.json().get("message", "Lỗi không xác định từ GHN API")
-            )
-
-        data = response.json().get("data", [])
-        logger.info("Lấy danh sách tỉnh/thành phố thành công.")
-        return data
-
-    except requests.exceptions.RequestException as e:
-        logger.error("Lỗi khi kết nối tới GHN API: %s", str(e))
-        raise HTTPException(
-            status_code=500,
-            detail="Lỗi khi kết nối tới GHN API"
-        )
+    return get_master_data("province")
 
 def get_districts(province_id):
-    url = f"{GHN_API_URL_GET_ADDRESS}/master-data/district"
-    headers = {"Token": GHN_TOKEN}
-    params = {"province_id": province_id}
-    
-    response = requests.get(url, headers=headers, params=params)
+    return get_master_data(f"district:{province_id}")
 
-    if response.status_code != 200:
-        raise HTTPException(
-            status_code=response.status_code, 
-            detail=response.json().get("message", "Lỗi không xác định từ GHN API")
-        )
+def get_wards(district_id):
+    return get_master_data(f"ward:{district_id}")
 
-    return response.json().get("data", [])
 
-def get_wards(district_id):
-    url = f"{GHN_API_URL_GET_ADDRESS}/master-data/ward"
-    headers = {"Token": GHN_TOKEN, "User-Agent": "PostmanRuntime/7.43.0"}
-    response = requests.get(url, headers=headers, params={"district_id": district_id})
-    if response.status_code != 200:
-        logger.error("Không thể lấy danh sách phường/xã: %s", response.json())
-        raise HTTPException(
-            status_code=response.status_code, detail="Không thể lấy danh sách phường/xã."
-        )
-    logger.info("Lấy danh sách phường/xã thành công.")
-    return response.json().get("data", [])
+async def aget_pick_shifts():
+    return _data(await _aget(GHN_PICKSHIFT_URL))
+
+async def aget_provinces():
+    return await aget_master_data("province")
+
+async def aget_districts(province_id):
+    return await aget_master_data(f"district:{province_id}")
+
+async def aget_wards(district_id):
+    return await aget_master_data(f"ward:{district_id}")
+
+
+async def aget_order_details(order_codes, concurrency=GHN_SYNC_CONCURRENCY, http=None):
+    """
+    Tra cứu nhiều đơn GHN song song (tối đa `concurrency` request cùng lúc).
+    Trả về {order_code: data}; đơn lỗi được log và bỏ qua để lần đồng bộ sau thử lại.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(order_code):
+        async with semaphore:
+            try:
+                response = await _arequest("POST", GHN_ORDER_DETAIL_URL, http=http, json={"order_code": order_code})
+                return order_code, _data(response)
+            except HTTPException as e:
+                logger.warning("Không lấy được đơn GHN %s: %s", order_code, e.detail)
+                return order_code, None
+
+    results = await asyncio.gather(*(fetch(code) for code in dict.fromkeys(order_codes)))
+    return {code: data for code, data in results if data is not None}
+
+
+def get_order_details(order_codes, concurrency=GHN_SYNC_CONCURRENCY):
+    # dùng từ job scheduler (thread riêng, không có event loop): client riêng cho event loop của lần chạy này
+    async def run():
+        async with httpx.AsyncClient(headers={"Token": GHN_TOKEN}, timeout=GHN_TIMEOUT, limits=_limits) as http:
+            return await aget_order_details(order_codes, concurrency, http)
+    return asyncio.run(run())
 
 
+async def aclose():
+    client.close()
+    await async_client.aclose()
+    _refresh_executor.shutdown(wait=False)
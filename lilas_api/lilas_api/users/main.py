@@ -4,28 +4,32 @@ from fastapi_jwt_auth import AuthJWT
 from fastapi.security import HTTPBearer
 from fastapi_jwt_auth.exceptions import AuthJWTException
 from sqlalchemy.orm import Session
-from users.models import (Base, User, Account )
-from database.main import engine
+from users.models import (User, Account )
+from database.sequences import next_id
 from users.schema import (
     UserCreate, LoginModel, UserUpdate, UserResponse, PasswordChange,UserListResponse,
     AccountListResponse, AccountCreate, AccountResponse, AccountUpdate
 )
 from invoice.models import Invoice
-from passlib.context import CryptContext
 import json
-from users.dependencies import get_db
+from users.dependencies import get_db, get_async_db
+from users.passwords import (
+    pwd_context, get_password_hash, verify_password, get_password_hash_async, verify_and_update_async, login_allowed,
+    record_failed_login, reset_failed_logins
+)
+from database import cache
 from typing import List, Optional, Set
+from types import SimpleNamespace
 from pydantic import BaseSettings
 from datetime import timedelta, datetime
 
 from uuid import uuid4
 import os
-import redis
+from users.revocation import revocation_store
 from sqlalchemy import desc, cast
-from sqlalchemy import or_, func, Integer
-
+from sqlalchemy import or_, func, Integer, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-Base.metadata.create_all(bind=engine)
 
 router = APIRouter()
 
@@ -40,22 +44,55 @@ ROLE_MAPPING = {
     4: "warehouse_staff"
 }
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-def get_password_hash(password):
-    return pwd_context.hash(password)
-
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
 class Settings(BaseSettings):
     authjwt_secret_key: str = "f36ebe9fe7caef64452001ff8a5ef83136f8d6dc4c5531f1e3214f7d4157b769"
     authjwt_access_token_expires: timedelta = timedelta(days=7)
+    authjwt_denylist_enabled: bool = True
+    authjwt_denylist_token_checks: set = {"access"}
 
 @AuthJWT.load_config
 def get_config():
     return Settings()
 
+# jwt_required() từ chối token đã signout (tra theo jti, dùng chung giữa các worker)
+@AuthJWT.token_in_denylist_loader
+def check_if_token_revoked(decrypted_token):
+    return revocation_store.is_revoked(decrypted_token["jti"])
+
+# tài khoản đăng nhập được cache theo username để không phải query DB ở mỗi request, chỉ khi cache dùng chung (Redis):
+# cache trong process thì khóa tài khoản ở worker này, worker khác vẫn cho qua tới AUTH_CACHE_TTL giây
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "60"))
+
+
+def invalidate_principal(*usernames):
+    for username in usernames:
+        try:
+            cache.backend.delete(f"auth:{username}")
+        except Exception as e:
+            logger.warning("Không xóa được cache tài khoản %s: %s", username, e)
+
+
+def load_principal(db: Session, username: str):
+    key = f"auth:{username}"
+    principal = None
+    if cache.backend.shared:
+        try:
+            principal = cache.backend.get(key)
+        except Exception as e:
+            logger.warning("Cache không khả dụng (%s), đọc tài khoản từ DB", e)
+    if principal is None:
+        user = db.query(Account).filter(Account.username == username).first()
+        if user is None:
+            return None
+        principal = {"id": user.id, "username": user.username, "role": user.role, "active": user.active}
+        if cache.backend.shared:
+            try:
+                cache.backend.set(key, principal, AUTH_CACHE_TTL)
+            except Exception as e:
+                logger.warning("Không ghi được cache tài khoản %s: %s", username, e)
+    return SimpleNamespace(**principal)
+
+
 def get_current_user(Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     try:
         Authorize.jwt_required()
@@ -64,12 +101,14 @@ def get_current_user(Authorize: AuthJWT = Depends(), db: Session = Depends(get_d
 
             raise HTTPException(status_code=401, detail="INVALID_OR_EXPIRED_TOKEN")
         current_user_info = json.loads(subject)
-        user = db.query(Account).filter(Account.username == current_user_info["username"]).first()
+        user = load_principal(db, current_user_info["username"])
         if user is None:
             raise HTTPException(status_code=404, detail="USER_NOT_FOUND")
         if not user.active:
             raise HTTPException(status_code=403, detail="USER_DELETED_OR_DISABLED ")
         return user
+    except HTTPException as http_exc:
+        raise http_exc
     except AuthJWTException as e:
         raise HTTPException(status_code=e.status_code, detail=e.message)
     except Exception as e:
@@ -85,15 +124,20 @@ def role_required(required_roles: List[str]):
 
 
 @router.post("/signin")
-def signin(
+async def signin(
     response: Response,
     user: LoginModel,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     Authorize: AuthJWT = Depends()
 ):
-    db_account = db.query(Account).filter(Account.username == user.username).first()
+    if not login_allowed(user.username):
+        logger.warning(f"Đăng nhập thất bại: Tài khoản '{user.username}' đăng nhập quá nhiều lần.")
+        raise HTTPException(status_code=429, detail="TOO_MANY_LOGIN_ATTEMPTS")
+
+    db_account = (await db.execute(select(Account).where(Account.username == user.username))).scalars().first()
 
     if not db_account:
+        record_failed_login(user.username)
         logger.warning(f"Đăng nhập thất bại: Tài khoản '{user.username}' không tồn tại.")
         raise HTTPException(status_code=401, detail="INVALID_CREDENTIALS")
 
@@ -101,9 +145,16 @@ def signin(
         logger.warning(f"Đăng nhập thất bại: Tài khoản '{user.username}' đã bị vô hiệu hóa hoặc xóa.")
         raise HTTPException(status_code=403, detail="ACCOUNT_DELETED_OR_DISABLED")
 
-    if not verify_password(user.password, db_account.password):
+    verified, new_hash = await verify_and_update_async(user.password, db_account.password)
+    if not verified:
+        record_failed_login(user.username)
         logger.warning(f"Đăng nhập thất bại: Sai mật khẩu cho tài khoản '{user.username}'.")
         raise HTTPException(status_code=401, detail="INVALID_CREDENTIALS")
+    reset_failed_logins(user.username)
+    if new_hash:
+        # hash cũ (cost thấp hơn BCRYPT_ROUNDS) được thay khi có mật khẩu gốc
+        db_account.password = new_hash
+        await db.commit()
 
     subject = json.dumps({"username": db_account.username, "role": ROLE_MAPPING.get(db_account.role, "unknown")})
     access_token = Authorize.create_access_token(subject=subject)
@@ -125,13 +176,13 @@ def signin(
     }
 
 @router.post("/signup")
-def signup(
+async def signup(
     account: AccountCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     Authorize: AuthJWT = Depends()
 ):
     try:
-        existing_user = db.query(Account).filter(Account.username == account.username).first()
+        existing_user = (await db.execute(select(Account).where(Account.username == account.username))).scalars().first()
         if existing_user:
             raise HTTPException(status_code=400, detail="USERNAME_ALREADY_EXISTS ")
 
@@ -141,23 +192,18 @@ def signup(
                 detail="ROLE_MUST_BE_1_(admin)_2(staff)_3_(collaborator)_4_(warehouse_staff)"
             )
 
-        last_id = db.query(func.max(func.cast(func.substr(Account.id, 3), Integer))).scalar()
-
-        if last_id: 
-            new_id = f"TK{last_id + 1}"
-        else:
-            new_id = "TK1"
+        password = await get_password_hash_async(account.password)
+        new_id = await db.run_sync(lambda session: next_id(session, "TK", Account))
 
         new_user = Account(
             id=new_id,
             username=account.username,
-            password=get_password_hash(account.password),
+            password=password,
             role=account.role,
             active=True
         )
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
 
         subject = json.dumps({"username": new_user.username, "role": ROLE_MAPPING.get(new_user.role, "unknown")})
         access_token = Authorize.create_access_token(subject=subject)
@@ -173,7 +219,7 @@ def signup(
     except HTTPException as http_exc:
         raise http_exc 
     except Exception as e:
-        db.rollback() 
+        await db.rollback() 
 
         return {
             "msg": "CREATE_ACCOUNT_SUCCESS",
@@ -183,45 +229,27 @@ def signup(
             "access_token": access_token
         }
     except Exception as e:
-        db.rollback()  
+        await db.rollback()  
         raise HTTPException(status_code=500, detail=str(e))
 
 
 
 
-blacklist_tokens: Set[str] = set()  
-def is_token_blacklisted(token: str) -> bool:
-    return token in blacklist_tokens
-
-def blacklist_token(token: str):
-    blacklist_tokens.add(token)
-
-def remove_token_from_blacklist(token: str):
-    blacklist_tokens.discard(token)
-
 def token_required(Authorize: AuthJWT = Depends()):
     try:
-        Authorize.jwt_required()  
-        token = Authorize.get_raw_jwt()
-        if is_token_blacklisted(token):
-
-            raise HTTPException(status_code=401, detail="TOKEN_BLACKLISTED")
+        Authorize.jwt_required()  # token đã thu hồi bị từ chối qua check_if_token_revoked
         return Authorize
     except Exception:
         raise HTTPException(status_code=401, detail="TOKEN_INVALID_OR_EXPIRED")
 
-r = redis.Redis(host='localhost', port=5000, db=0)
-
-def add_to_blacklist(token: str):
-    r.set(token, True, ex=3600)  # Blacklist token trong 1 giờ
-
 @router.post("/signout")
 def signout(response: Response, Authorize: AuthJWT = Depends()):
     token = Authorize.get_raw_jwt()
     
-    # Thêm token vào blacklist
+    # Thu hồi token đến hết hạn
     if token:
-        blacklist_token(token)    
+        expires_at = token.get("exp") or (datetime.now() + Settings().authjwt_access_token_expires).timestamp()
+        revocation_store.revoke(token["jti"], expires_at)
     response.delete_cookie(
         key="access_token", 
         path="/",  
@@ -274,6 +302,7 @@ def update_account(
 
             raise HTTPException(status_code=404, detail="NOT_FOUND")
         
+        old_username = account.username
         for key, value in account_data.dict(exclude_unset=True).items():
             if key == "password":
                 value = get_password_hash(value)  
@@ -281,6 +310,7 @@ def update_account(
 
         db.commit()
         db.refresh(account)
+        invalidate_principal(old_username, account.username)
 
         return account
     except HTTPException as http_exc:
@@ -296,17 +326,19 @@ def change_password(
     current_account: Account = Depends(get_current_user)
 ):
     try:
-        if not verify_password(password_change.current_password, current_account.password):
+        account = db.query(Account).filter(Account.id == current_account.id).first()
+        if not verify_password(password_change.current_password, account.password):
             raise HTTPException(status_code=400, detail="THAT_PASSWORD_IS_INCORRECT")
         
         if password_change.new_password != password_change.confirm_new_password:
             raise HTTPException(status_code=400, detail="NEW_PASSWORD_AND_CONFIRM_NEW_PASSWORD_DO_NOT_MATCH")
         
-        current_account.password = get_password_hash(password_change.new_password)
+        account.password = get_password_hash(password_change.new_password)
         db.commit()
-        db.refresh(current_account)
+        db.refresh(account)
+        invalidate_principal(account.username)
         
-        return current_account
+        return account
     except HTTPException as http_exc:
         raise http_exc 
     except Exception as e:
@@ -324,6 +356,7 @@ def delete_account(user_id: str, db: Session = Depends(get_db), current_user: Ac
             raise HTTPException(status_code=403, detail="CAN_NOT_DELETE_YOURSELF")
         account.active = False
         db.commit()
+        invalidate_principal(account.username)
         return {"msg": "THE_ACCOUNT_HAS_BEEN_DELETED"}
     except HTTPException as http_exc:
         raise http_exc 
@@ -352,8 +385,7 @@ def create_user(
             if existing_phone_user:
                 raise HTTPException(status_code=400, detail="PHONE_NUMBER_ALREADY_EXISTS")
             
-        last_id = db.query(func.max(cast(func.substr(User.id, 3), Integer))).scalar()
-        new_id = f"NV{(last_id + 1) if last_id else 1}"
+        new_id = next_id(db, "NV", User)
 
         new_user = User(id=new_id, **user.dict(exclude={"id"}))  # Exclude the id field
         db.add(new_user)
@@ -51,10 +51,10 @@ class User(Base):
     total_orders = Column(Integer, default=0)
     total_revenue = Column(Float, default=0.0)
     created_at = Column(DateTime, default=lambda: datetime.now(vietnam_tz))
-    import_bills = relationship("ImportBill", back_populates="user", lazy="joined")
-    inspection_reports = relationship("InspectionReport", back_populates="user", lazy="joined")
+    import_bills = relationship("ImportBill", back_populates="user", lazy="raise")
+    inspection_reports = relationship("InspectionReport", back_populates="user", lazy="raise")
     return_bills = relationship("ReturnBill", back_populates="user")  
-    tranfers = relationship("TransactionTranfers", back_populates="user", lazy="joined")
+    tranfers = relationship("TransactionTranfers", back_populates="user", lazy="raise")
 
     @validates('role')
     def validate_role(self, key, value):
@@ -69,3 +69,18 @@ class User(Base):
         orm_mode = True
         str_strip_whitespace = True
         str_min_length = 1
+
+
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+
+    jti = Column(String, primary_key=True)
+    expires_at = Column(Integer, nullable=False, index=True)  # unix timestamp = exp của token
+
+
+class GhnMasterData(Base):
+    __tablename__ = "ghn_master_data"
+
+    key = Column(String, primary_key=True)  # "province", "district:202", "ward:1442"
+    data = Column(Text, nullable=False)  # JSON trả về từ GHN
+    fetched_at = Column(Integer, nullable=False)  # unix timestamp
@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+import os
+
+from passlib.context import CryptContext
+from database import cache
+
+logger = logging.getLogger(__name__)
+
+# cost của bcrypt (2^rounds vòng), hash cũ có cost thấp hơn sẽ được hash lại khi đăng nhập
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# số thread dành riêng cho bcrypt, tách khỏi threadpool xử lý request
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+# số lần đăng nhập sai tối đa cho 1 username trong LOGIN_RATE_WINDOW giây
+LOGIN_RATE_LIMIT = int(os.getenv("LOGIN_RATE_LIMIT", "10"))
+LOGIN_RATE_WINDOW = int(os.getenv("LOGIN_RATE_WINDOW", "60"))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+)
+
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+
+
+def get_password_hash(password):
+    return pwd_context.hash(password)
+
+
+def verify_password(plain_password, hashed_password):
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+async def get_password_hash_async(password):
+    return await asyncio.get_running_loop().run_in_executor(_executor, pwd_context.hash, password)
+
+
+async def verify_and_update_async(plain_password, hashed_password):
+    """(đúng mật khẩu?, hash mới nếu hash cũ cần nâng cấp hoặc None)"""
+    return await asyncio.get_running_loop().run_in_executor(
+        _executor, pwd_context.verify_and_update, plain_password, hashed_password
+    )
+
+
+def _login_key(username):
+    return f"login:{username.lower()}"
+
+
+def login_allowed(username):
+    # chỉ đếm lần đăng nhập sai (tài khoản dùng chung ở quầy đăng nhập đúng nhiều lần vẫn được),
+    # cửa sổ cố định, dùng chung backend cache (Redis thì áp dụng cho mọi worker)
+    try:
+        return (cache.backend.get(_login_key(username)) or 0) < LOGIN_RATE_LIMIT
+    except Exception as e:
+        logger.warning("Không kiểm tra được giới hạn đăng nhập: %s", e)
+        return True
+
+
+def record_failed_login(username):
+    try:
+        cache.backend.incr(_login_key(username), LOGIN_RATE_WINDOW)
+    except Exception as e:
+        logger.warning("Không ghi được lần đăng nhập sai: %s", e)
+
+
+def reset_failed_logins(username):
+    try:
+        cache.backend.delete(_login_key(username))
+    except Exception as e:
+        logger.warning("Không xóa được bộ đếm đăng nhập sai: %s", e)
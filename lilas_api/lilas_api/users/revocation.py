@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+
+from sqlalchemy import select, insert, delete
+from sqlalchemy.exc import IntegrityError
+from database.main import engine
+from database.cache import REDIS_URL, MemoryBackend
+from users.models import RevokedToken
+
+# TOKEN_REVOCATION_BACKEND=memory|sql|redis, mặc định redis nếu có REDIS_URL, không thì bảng revoked_tokens
+TOKEN_REVOCATION_BACKEND = os.getenv("TOKEN_REVOCATION_BACKEND", "redis" if REDIS_URL else "sql")
+# backend sql: kết quả "chưa thu hồi" được nhớ trong process TOKEN_REVOCATION_CACHE_TTL giây,
+# nên token signout ở worker khác còn dùng được tối đa chừng ấy giây
+TOKEN_REVOCATION_CACHE_TTL = int(os.getenv("TOKEN_REVOCATION_CACHE_TTL", "5"))
+TOKEN_REVOCATION_CACHE_ENTRIES = int(os.getenv("TOKEN_REVOCATION_CACHE_ENTRIES", "4096"))
+
+
+class MemoryRevocationStore:
+    """Chỉ dùng khi chạy 1 worker: mỗi process có danh sách riêng."""
+
+    def __init__(self):
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def revoke(self, jti, expires_at):
+        with self.lock:
+            self.tokens[jti] = expires_at
+        self.prune_expired()
+
+    def prune_expired(self):
+        now = time.time()
+        with self.lock:
+            expired = [k for k, exp in self.tokens.items() if exp < now]
+            for key in expired:
+                del self.tokens[key]
+        return len(expired)
+
+    def is_revoked(self, jti):
+        expires_at = self.tokens.get(jti)
+        return expires_at is not None and expires_at >= time.time()
+
+
+class SqlRevocationStore:
+    def __init__(self, bind=engine, cache_ttl=TOKEN_REVOCATION_CACHE_TTL):
+        self.bind = bind
+        self.cache_ttl = cache_ttl
+        # jti -> expires_at (đã thu hồi, nhớ tới khi hết hạn) hoặc 0 (chưa thu hồi, nhớ cache_ttl giây)
+        self.cache = MemoryBackend(TOKEN_REVOCATION_CACHE_ENTRIES)
+
+    def revoke(self, jti, expires_at):
+        try:
+            with self.bind.begin() as connection:
+                connection.execute(insert(RevokedToken).values(jti=jti, expires_at=int(expires_at)))
+        except IntegrityError:
+            pass  # token đã bị thu hồi trước đó
+        self.cache.set(jti, int(expires_at), max(expires_at - time.time(), 0))
+
+    def prune_expired(self):
+        # token hết hạn thì tự bị từ chối, không cần giữ trong bảng (job prune_revoked_tokens trong scheduler)
+        with self.bind.begin() as connection:
+            return connection.execute(delete(RevokedToken).where(RevokedToken.expires_at < int(time.time()))).rowcount
+
+    def is_revoked(self, jti):
+        expires_at = self.cache.get(jti)
+        if expires_at is None:
+            with self.bind.connect() as connection:
+                expires_at = connection.execute(select(RevokedToken.expires_at).where(RevokedToken.jti == jti)).scalar() or 0
+            ttl = expires_at - time.time() if expires_at else self.cache_ttl
+            if ttl > 0:
+                self.cache.set(jti, expires_at, ttl)
+        return expires_at >= time.time()
+
+
+class RedisRevocationStore:
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+
+    def revoke(self, jti, expires_at):
+        self.client.set(f"revoked:{jti}", 1, exat=int(expires_at))
+
+    def prune_expired(self):
+        return 0  # key tự hết hạn (exat)
+
+    def is_revoked(self, jti):
+        return self.client.exists(f"revoked:{jti}") == 1
+
+
+def create_store(name=TOKEN_REVOCATION_BACKEND):
+    if name == "memory":
+        return MemoryRevocationStore()
+    if name == "redis":
+        return RedisRevocationStore(REDIS_URL)
+    if name == "sql":
+        return SqlRevocationStore()
+    raise ValueError(f"TOKEN_REVOCATION_BACKEND không hợp lệ: {name}")
+
+
+revocation_store = create_store()
@@ -141,8 +141,6 @@ def update_price_import_for_product(db, product: Product, qty_in: int, cost_in:
     print(f"→ New Price Import = ({A} + {B}) / {C} = {new_price}")
 
     product.price_import = float(new_price)
-    db.commit()
-    db.refresh(product)
 
 
 def reduce_price_import_for_product(db, product: Product, qty_out: int, cost_out: float):
@@ -167,8 +165,6 @@ def reduce_price_import_for_product(db, product: Product, qty_out: int, cost_out
         new_price = cost_out
         print(f"→ new_stock <= 0, New Price Import: {new_price}")
         product.price_import = float(new_price)
-        db.commit()
-        db.refresh(product)
         return
 
     A = Decimal(str(old_stock)) * Decimal(str(old_price))
@@ -182,5 +178,3 @@ def reduce_price_import_for_product(db, product: Product, qty_out: int, cost_out
     print(f"→ New Price Import = (A - B) / C = ({A} - {B}) / {C} = {new_price}")
 
     product.price_import = float(new_price)
-    db.commit()
-    db.refresh(product)